@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the commutativity toolkit. Run from this directory:
+
+  ./bench.py                            # all benchmarks, results in bench_results.json
+  ./bench.py --baseline baseline.json   # fails if a benchmark got slower than in the baseline
+  ./bench.py --parsers                  # parse throughput of the grammar variants
+  ./bench.py --scaling                  # cost against flow table size, on synthetic rule sets
+
+A results file can be used as the baseline of later runs. The switch benchmarks run against
+the OVS sandbox if there is one, otherwise against the simulated switch (see --backend).
+"""
+import sys
+import os
+import re
+import time
+import timeit
+import json
+import argparse
+import itertools
+import datetime
+import random
+import math
+from collections import OrderedDict
+
+from test import (FlowDescription, LRUCache, _build_flowdesc_parser, _build_actions_parser, Cmd, Command,
+                  SwitchDesc, OvsSwitch, OpenFlowSwitch, SimulatedSwitch, BridgePool, FlowComparator,
+                  AnalyticalFlowComparator, SdnRacerCommutativityChecker, CommutativityTestSuite, FlowIndex, TernaryMatchEngine,
+                  numpy, ovs_rundir)
+
+# Flows as they appear in the testcases and in ovs-ofctl dump-flows output
+SAMPLE_FLOWS = [
+    'table=0, priority=0 actions=drop',
+    'table=0, priority=5, tcp,nw_dst=10.0.0.1 actions=output:1',
+    'table=0, priority=5, tcp,nw_dst=10.0.0.0/8 actions=output:2',
+    'table=0, priority=5, tcp,nw_dst=10.0.0.0/24 actions=output:3',
+    'table=0, tcp,nw_dst=10.0.0.1 actions=output:6',
+    'tcp,nw_src=192.168.1.0,nw_dst=192.168.1.1',
+    'table=0, priority=1, tcp,nw_src=192.168.0.0/16, dl_vlan=20 actions=2',
+    'cookie=0x0, duration=3.12s, table=0, n_packets=0, n_bytes=0, idle_age=3, priority=5,tcp,nw_dst=10.0.0.0/24 actions=output:3',
+    'cookie=0x0, duration=3.12s, table=0, n_packets=0, n_bytes=0, idle_age=3, priority=10,tcp actions=drop',
+    'table=0 cookie=0 priority=5,tcp,nw_dst=10.0.0.0/16',
+]
+
+# Flow table the switch benchmarks start from
+INITIAL_FLOWS = [
+    'table=0, priority=0, tcp, actions=drop',
+    'table=0, priority=10, tcp, nw_dst=10.0.0.0/8 actions=output:1',
+    'table=0, priority=5, tcp, nw_dst=10.0.0.0/24 actions=output:2',
+    'table=0, priority=5, tcp, nw_dst=10.0.1.0/24 actions=output:3',
+    'table=0, priority=5, tcp, nw_dst=10.0.2.0/24 actions=output:4',
+]
+
+# Commands of the testcases in the scaling benchmark, run against a synthetic initial flow table
+SCALING_COMMANDS = [
+    ('TRACE', 'tcp,nw_dst=10.0.0.1'),
+    ('TRACE', 'tcp,nw_src=192.168.1.1,nw_dst=10.1.2.3'),
+    ('OF_ADD', 'table=0, priority=5, tcp,nw_dst=10.0.0.0/24 actions=output:3'),
+    ('OF_ADD', 'table=0, priority=20, tcp,nw_dst=10.1.0.0/16 actions=output:6'),
+    ('OF_DEL', 'table=0, tcp,nw_dst=10.0.0.0/24'),
+    ('OF_MOD', 'table=0, tcp,nw_dst=10.0.0.1 actions=output:7'),
+]
+
+# Flow compared against the synthetic flow table by the comparator set queries
+SCALING_PROBE = 'table=0, priority=5, tcp,nw_dst=10.1.0.0/16 actions=output:1'
+
+SCALING_SIZES = [10, 100, 1000, 10000, 100000]
+
+def _prefix(rnd,first_octets,ranges,lengths):
+    """Random network address and prefix length. The octets after first_octets are drawn from the
+    given ranges, so that the prefixes of different lengths nest.
+    :rtype: (str, int)
+    """
+    length = rnd.choice(lengths)
+    octets = list(first_octets) + [rnd.randrange(n) for n in ranges]
+    octets = [o if 8*i < length else 0 for i,o in enumerate(octets)]
+    address = '.'.join([str(o) for o in octets])
+    return (address if length == 32 else '{0}/{1}'.format(address,length), length)
+
+def synthetic_rules(count,seed=0):
+    """count distinct flows for table 0: nested CIDR hierarchies on nw_dst (10.0.0.0/8 down to hosts)
+    and nw_src (192.168.0.0/16 down to hosts), mixed priorities and many distinct actions.
+    The same count and seed always give the same flows.
+    :rtype: list[str]
+    """
+    rnd = random.Random(seed)
+    rules = []
+    seen = set()
+    while len(rules) < count:
+        dst,dst_len = _prefix(rnd,(10,),(4,16,256),(8,16,24,32))
+        match = 'tcp,nw_dst=' + dst
+        src_len = 0
+        if rnd.random() < 0.5:
+            src,src_len = _prefix(rnd,(192,168),(16,256),(16,24,32))
+            match = 'tcp,nw_src={0},nw_dst={1}'.format(src,dst)
+        if rnd.random() < 0.5:
+            priority = dst_len + src_len # longest prefix first
+        else:
+            priority = rnd.randrange(1,1000)
+        if (priority,match) in seen:
+            continue
+        seen.add((priority,match))
+        if rnd.random() < 0.1:
+            actions = 'drop'
+        else:
+            actions = 'output:{0}'.format(rnd.randrange(1,4096))
+        rules.append('table=0, priority={0}, {1} actions={2}'.format(priority,match,actions))
+    return rules
+
+def _parse_rebuilt(s):
+    """Parse like FlowDescription did before its grammars were compiled once."""
+    s = ' '.join(s.split())
+    parsed = _build_flowdesc_parser().parseString(s)
+    fields = dict([(i[0],(None if len(i) < 2 else i[1])) for i in parsed.fields.asList()])
+    if 'actions' in fields:
+        _build_actions_parser().parseString(fields['actions'])
+
+def _parse(s):
+    FlowDescription(s)
+
+def _throughput(func,flows,repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        for f in flows:
+            func(f)
+    elapsed = time.time() - start
+    return (repeat * len(flows)) / elapsed
+
+def bench_parse(repeat=200):
+    """Flow parse throughput: grammar rebuilt per flow, compiled grammar, compiled grammar with cache.
+    """
+    results = []
+    results.append(('rebuilt grammar (previous)', _throughput(_parse_rebuilt,SAMPLE_FLOWS,max(1,repeat/20))))
+    parse_cache = FlowDescription.parse_cache
+    actions_cache = FlowDescription.actions_cache
+    try:
+        FlowDescription.parse_cache = LRUCache(0)
+        FlowDescription.actions_cache = LRUCache(0)
+        results.append(('compiled grammar, no cache', _throughput(_parse,SAMPLE_FLOWS,repeat)))
+    finally:
+        FlowDescription.parse_cache = parse_cache
+        FlowDescription.actions_cache = actions_cache
+    FlowDescription.parse_cache.clear()
+    FlowDescription.actions_cache.clear()
+    results.append(('compiled grammar, cached', _throughput(_parse,SAMPLE_FLOWS,repeat*10)))
+
+    print 'FlowDescription parse throughput ({0} distinct flows):'.format(len(SAMPLE_FLOWS))
+    baseline = results[0][1]
+    for name,ops in results:
+        print '  {0:<30} {1:>12.0f} flows/s  ({2:.1f}x)'.format(name,ops,ops/baseline)
+    return results
+
+def calibrate(func,batch_time=0.01):
+    """Number of calls of func that take at least batch_time, so that timing a batch of them
+    keeps timer resolution and overhead out of fast operations
+    :rtype: int
+    """
+    number = 1
+    while True:
+        elapsed = _time_batch(func,number)
+        if elapsed >= batch_time:
+            return number
+        # aim a bit above batch_time, grow at most tenfold per step
+        number = max(number + 1, int(number * min(10.0, 1.2 * batch_time / max(elapsed,1e-9))))
+
+def time_batches(func,number,min_time=0.04,repeat=3):
+    """Time batches of number calls, at least repeat batches and until min_time seconds are spent.
+    Returns the seconds per call of each batch.
+    :rtype: list[float]
+    """
+    per_call = []
+    total = 0.0
+    while len(per_call) < repeat or total < min_time:
+        elapsed = _time_batch(func,number)
+        per_call.append(elapsed / number)
+        total += elapsed
+    return per_call
+
+def summarize(per_call,number):
+    """Result of a benchmark from the seconds per call of its batches: the number of calls and
+    batches, the time per call in microseconds of the best and the median batch, and the calls
+    per second of the best batch (what compare() uses: the fastest batch is the one least
+    disturbed by the rest of the machine).
+    :rtype: dict
+    """
+    per_call = sorted(per_call)
+    best = per_call[0]
+    return OrderedDict([('calls', number * len(per_call)),
+                        ('batches', len(per_call)),
+                        ('ops_per_sec', 1.0 / max(best,1e-12)),
+                        ('best_us', 1e6 * best),
+                        ('median_us', 1e6 * per_call[len(per_call) / 2])])
+
+def measure(func,min_time=0.2,repeat=5,batch_time=0.01):
+    """Time func in calibrated batches of calls (see calibrate() and summarize())
+    :rtype: dict
+    """
+    number = calibrate(func,batch_time)
+    return summarize(time_batches(func,number,min_time,repeat),number)
+
+def _time_batch(func,number):
+    timer = timeit.default_timer
+    start = timer()
+    for i in xrange(number):
+        func()
+    return timer() - start
+
+def _uncached(func):
+    """func with the FlowDescription parse caches disabled"""
+    def run():
+        parse_cache = FlowDescription.parse_cache
+        actions_cache = FlowDescription.actions_cache
+        FlowDescription.parse_cache = LRUCache(0)
+        FlowDescription.actions_cache = LRUCache(0)
+        try:
+            func()
+        finally:
+            FlowDescription.parse_cache = parse_cache
+            FlowDescription.actions_cache = actions_cache
+    return run
+
+def _fm(cmd_type,s,strict=False):
+    """A FlowDescription with the type and strict fields the checker expects, as the predictor injects them"""
+    f = FlowDescription(s)
+    f.type = cmd_type
+    f.strict = strict
+    return f
+
+def flowdesc_benchmarks():
+    """
+    :rtype: list[(str, callable)]
+    """
+    flows = itertools.cycle(SAMPLE_FLOWS)
+    parsed = [FlowDescription(s) for s in SAMPLE_FLOWS]
+    objects = itertools.cycle(parsed)
+    # hashing needs actions
+    with_actions = itertools.cycle([f for f in parsed if f.actions is not None])
+    return [
+        ('flowdesc.parse', lambda: FlowDescription(next(flows))),
+        ('flowdesc.parse_uncached', _uncached(lambda: FlowDescription(next(flows)))),
+        ('flowdesc.copy', lambda: next(objects).copy()),
+        ('flowdesc.hash', lambda: hash(next(with_actions))),
+        ('flowdesc.str', lambda: str(next(objects))),
+        ('flowdesc.str_uncached', lambda: str(next(objects).copy())),
+        ('flowdesc.get_priority', lambda: next(objects).get_priority()),
+        ('flowdesc.get_match', lambda: next(objects).get_match()),
+    ]
+
+def comparator_benchmarks(name,comparator):
+    """
+    :type comparator: FlowComparator
+    :rtype: list[(str, callable)]
+    """
+    pairs = itertools.cycle([(FlowDescription(a), FlowDescription(b)) for a,b in [
+        ('table=0, priority=5, tcp,nw_dst=10.0.0.1 actions=output:1', 'table=0, priority=5, tcp,nw_dst=10.0.0.0/24 actions=output:3'),
+        ('table=0, priority=5, tcp,nw_dst=10.0.0.0/8 actions=output:2', 'table=0, priority=5, tcp,nw_dst=10.0.0.0/24 actions=output:3'),
+        ('table=0, priority=5, tcp,nw_dst=10.0.1.0/24 actions=output:4', 'table=0, priority=5, tcp,nw_dst=10.0.2.0/24 actions=output:5'),
+    ]])
+    def is_subset():
+        s,t = next(pairs)
+        comparator.is_subset(s,t)
+    def is_intersection_nonempty():
+        s,t = next(pairs)
+        # it overwrites the actions and priorities of its arguments
+        comparator.is_intersection_nonempty(s.copy(),t.copy())
+    return [(name + '.is_subset', is_subset),
+            (name + '.is_intersection_nonempty', is_intersection_nonempty)]
+
+def ternary_benchmarks(size=500):
+    """Relation matrices of synthetic rules, if NumPy is installed
+    :rtype: list[(str, callable)]
+    """
+    if numpy is None:
+        return []
+    engine = TernaryMatchEngine()
+    rules = [FlowDescription(r) for r in synthetic_rules(size)]
+    return [('ternary.subset_matrix_{0}x{0}'.format(size), lambda: engine.subset_matrix(rules,rules)),
+            ('ternary.intersection_matrix_{0}x{0}'.format(size), lambda: engine.intersection_matrix(rules,rules))]
+
+def checker_benchmarks(comparator):
+    """
+    :type comparator: FlowComparator
+    :rtype: list[(str, callable)]
+    """
+    checker = SdnRacerCommutativityChecker(comparator)
+    pkt = _fm(Cmd.TRACE,'tcp,nw_dst=10.0.0.1')
+    eread = FlowDescription('table=0, priority=5, tcp,nw_dst=10.0.0.0/24 actions=output:3')
+    add = _fm(Cmd.OF_ADD,'table=0, priority=5, tcp,nw_dst=10.0.0.0/8 actions=output:2')
+    add2 = _fm(Cmd.OF_ADD,'table=0, priority=5, tcp,nw_dst=10.0.0.0/8 actions=output:6')
+    mod = _fm(Cmd.OF_MOD,'table=0, priority=5, tcp,nw_dst=10.0.0.0/24 actions=output:7')
+    mod_strict = _fm(Cmd.OF_MOD,'table=0, priority=5, tcp,nw_dst=10.0.0.0/24 actions=output:8',strict=True)
+    delete = _fm(Cmd.OF_DEL,'table=0, priority=5, tcp,nw_dst=10.0.0.0/16')
+    return [
+        ('checker.nocommute_read_add', lambda: checker.nocommute_read_add(pkt,eread,add,1,2)),
+        ('checker.nocommute_read_mod', lambda: checker.nocommute_read_mod(pkt,eread,mod,1,2)),
+        ('checker.nocommute_read_del', lambda: checker.nocommute_read_del(pkt,eread,delete,1,2)),
+        ('checker.nocommute_del_mod', lambda: checker.nocommute_del_mod(delete,mod)),
+        ('checker.nocommute_add_del', lambda: checker.nocommute_add_del(add,delete)),
+        ('checker.nocommute_mod_mod', lambda: checker.nocommute_mod_mod(mod,mod_strict)),
+        ('checker.nocommute_add_mod', lambda: checker.nocommute_add_mod(add,mod)),
+        ('checker.nocommute_add_add', lambda: checker.nocommute_add_add(add,add2)),
+    ]
+
+def switch_benchmarks(switch):
+    """One benchmark per command type. CREATE is covered by RESET, which recreates the bridge.
+    :type switch: OvsSwitch
+    :rtype: list[(str, callable)]
+    """
+    def setup():
+        switch.executeCommand(Command(Cmd.CLEAR))
+        switch.executeCommands([Command(Cmd.OF_ADD,FlowDescription(f)) for f in INITIAL_FLOWS])
+    def with_setup(cmd):
+        def run():
+            setup()
+            switch.executeCommand(cmd)
+        return run
+    add = Command(Cmd.OF_ADD,FlowDescription('table=0, priority=7, tcp,nw_dst=10.0.3.0/24 actions=output:5'))
+    benchmarks = [
+        ('switch.RESET', lambda: switch.executeCommand(Command(Cmd.RESET))),
+        ('switch.CLEAR', lambda: switch.executeCommand(Command(Cmd.CLEAR))),
+        ('switch.OF_BAR', lambda: switch.executeCommand(Command(Cmd.OF_BAR))),
+        ('switch.setup', setup),
+        ('switch.TRACE', lambda: switch.executeCommand(Command(Cmd.TRACE,FlowDescription('tcp,nw_dst=10.0.1.1')))),
+        ('switch.DUMP', lambda: switch.executeCommand(Command(Cmd.DUMP,dump_removeStatistics=True))),
+        # the flow mods change the table, so they are measured together with setup (see switch.setup)
+        ('switch.setup+OF_ADD', with_setup(add)),
+        ('switch.setup+OF_DEL', with_setup(Command(Cmd.OF_DEL,FlowDescription('table=0, tcp,nw_dst=10.0.0.0/16')))),
+        ('switch.setup+OF_MOD', with_setup(Command(Cmd.OF_MOD,FlowDescription('table=0, tcp,nw_dst=10.0.0.0/16 actions=output:9')))),
+        ('switch.setup+OF_ADD_affected', lambda: (setup(), switch.executeCommand(add,return_affected=True))),
+    ]
+    return benchmarks
+
+def _create_switches(backend):
+    """The benchmarked switch and the comparator's scratch switch, leased from the sandbox's bridge pool
+    :rtype: (OvsSwitch, OvsSwitch)
+    """
+    classes = {'sim' : SimulatedSwitch, 'ovs' : OvsSwitch, 'openflow' : OpenFlowSwitch}
+    create_switch = lambda name: classes[backend](SwitchDesc(name,10))
+    lock_dir = None if backend == 'sim' else os.path.join(ovs_rundir(),'bridge-pool')
+    pool = BridgePool(create_switch,2,lock_dir)
+    pool.provision()
+    return (pool.lease(), pool.lease())
+
+def run_benchmarks(backend,name_filter=None,min_time=0.2,rounds=5):
+    """Run all benchmarks whose name matches name_filter, print and return their results.
+    The benchmarks are timed in turn, for rounds rounds of min_time/rounds seconds each, so that
+    a slow stretch of the machine only slows down some of the batches of a benchmark.
+    :rtype: OrderedDict
+    """
+    switch,scratch = _create_switches(backend)
+    comparator = FlowComparator(scratch)
+    benchmarks = (flowdesc_benchmarks() +
+                  comparator_benchmarks('comparator',comparator) +
+                  comparator_benchmarks('analytical_comparator',AnalyticalFlowComparator()) +
+                  ternary_benchmarks() +
+                  checker_benchmarks(comparator) +
+                  switch_benchmarks(switch))
+    benchmarks = [(name,func) for name,func in benchmarks if name_filter is None or re.search(name_filter,name)]
+    numbers = [calibrate(func) for name,func in benchmarks]
+    per_call = [[] for b in benchmarks]
+    for r in xrange(rounds):
+        for (name,func),number,samples in zip(benchmarks,numbers,per_call):
+            samples.extend(time_batches(func,number,min_time / rounds))
+    results = OrderedDict()
+    for (name,func),number,samples in zip(benchmarks,numbers,per_call):
+        results[name] = summarize(samples,number)
+        print '  {0:<44} {1:>12.1f} ops/s  best {2:>10.3f} us  median {3:>10.3f} us'.format(
+            name,results[name]['ops_per_sec'],results[name]['best_us'],results[name]['median_us'])
+        sys.stdout.flush()
+    return results
+
+def _time(func,setup=None,repeat=3):
+    """Median time of func in seconds. setup is called before each call and not timed.
+    :rtype: float
+    """
+    times = []
+    for _ in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) / 2]
+
+class _Quiet(object):
+    """Discards what is printed within the with block"""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull,'w')
+    def __exit__(self,*exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def run_scaling(backend,sizes,max_seconds,name_filter=None,repeat=3):
+    """Measure the suite, the comparator set queries and the switch table operations against
+    synthetic flow tables of the given sizes, print and return the curves.
+    A point is skipped if its curve, extrapolated from the largest measured sizes, would take longer
+    than max_seconds.
+    :rtype: OrderedDict
+    """
+    switch,scratch = _create_switches(backend)
+    comparators = [('comparator', FlowComparator(scratch)), ('analytical_comparator', AnalyticalFlowComparator())]
+    commands = [Command(getattr(Cmd,t),FlowDescription(f)) for t,f in SCALING_COMMANDS]
+    state = {}
+
+    def load():
+        switch.executeCommand(Command(Cmd.CLEAR))
+        switch.executeCommands(state['initial'])
+    def comparator_set(comparator,query):
+        def setup():
+            # is_intersection_nonempty overwrites the actions and priorities of its arguments
+            state['probe'] = FlowDescription(SCALING_PROBE)
+            state['flows'] = [f.copy() for f in state['flows_original']]
+        def run():
+            getattr(comparator,query)(state['probe'],state['flows'])
+        return (setup,run)
+    def indexed_set(query):
+        # the queries of an interactive user, against an index built once
+        def setup():
+            if state.get('indexed') is not state['flows_original']:
+                state['index'] = FlowIndex(state['flows_original'])
+                state['indexed'] = state['flows_original']
+        def run():
+            getattr(comparators[1][1],query)(FlowDescription(SCALING_PROBE),state['index'])
+        return (setup,run)
+    def suite():
+        checker = SdnRacerCommutativityChecker(comparators[0][1])
+        with _Quiet():
+            CommutativityTestSuite(switch,comparators[0][1],checker,commands,[state['initial']]).evaluate_all()
+
+    # (name, the flow table must be loaded, setup, func)
+    curves = [('switch.DUMP', True, None, lambda: switch.executeCommand(Command(Cmd.DUMP,dump_removeStatistics=True))),
+              ('switch.TRACE', True, None, lambda: switch.executeCommand(Command(Cmd.TRACE,FlowDescription('tcp,nw_dst=10.1.2.3')))),
+              ('suite', False, None, suite)]
+    for name,comparator in comparators:
+        for query in ('subset_set', 'intersecting_set', 'superset_set'):
+            curves.append((name + '.' + query, False) + comparator_set(comparator,query))
+    curves.append(('index.build', False, None, lambda: FlowIndex(state['flows_original'])))
+    for query in ('subset_set', 'intersecting_set', 'superset_set'):
+        curves.append(('index.' + query, False) + indexed_set(query))
+    curves = [c for c in curves if name_filter is None or re.search(name_filter,c[0])]
+
+    load_points = []
+    results = OrderedDict()
+    if name_filter is None or re.search(name_filter,'switch.load'):
+        results['switch.load'] = load_points
+    for name,needs_table,setup,func in curves:
+        results[name] = []
+    for size in sizes:
+        rules = synthetic_rules(size)
+        state['flows_original'] = [FlowDescription(r) for r in rules]
+        state['initial'] = [Command(Cmd.OF_ADD,FlowDescription(r)) for r in rules]
+        loaded = False
+        if ('switch.load' in results or any([c[1] for c in curves])) and _extrapolate(load_points,size) <= max_seconds:
+            # the table is loaded once per size, for the curves that need it
+            load_points.append((size, _time(load,None,1)))
+            loaded = True
+            if 'switch.load' in results:
+                _print_point('switch.load',size,load_points[-1][1])
+        for name,needs_table,setup,func in curves:
+            points = results[name]
+            if (needs_table and not loaded) or _extrapolate(points,size) > max_seconds:
+                continue
+            points.append((size, _time(func,setup,repeat if size < 10000 else 1)))
+            _print_point(name,size,points[-1][1])
+
+    print 'Scaling exponents (time ~ size^k between the largest measured sizes):'
+    for name,points in results.iteritems():
+        if len(points) >= 2:
+            print '  {0:<44} k = {1:.2f}'.format(name,_exponent(points))
+    return results
+
+def _print_point(name,size,seconds):
+    print '  {0:<44} {1:>8} flows {2:>12.6f} s  {3:>10.2f} us/flow'.format(name,size,seconds,1e6*seconds/size)
+    sys.stdout.flush()
+
+def _exponent(points):
+    """k of time ~ size^k between the last two (size, seconds) points
+    :rtype: float
+    """
+    (n1,t1),(n2,t2) = points[-2],points[-1]
+    if t1 <= 0 or t2 <= 0:
+        return 1.0
+    return math.log(t2/t1)/math.log(float(n2)/n1)
+
+def _extrapolate(points,size):
+    """Expected seconds at size, from the curve measured so far (at least linear growth)
+    :rtype: float
+    """
+    if not points:
+        return 0.0
+    k = max(1.0, _exponent(points)) if len(points) >= 2 else 1.0
+    return points[-1][1] * (float(size) / points[-1][0]) ** k
+
+def compare(results,baseline,tolerance):
+    """Benchmarks whose throughput (of the best batch, see measure()) dropped by more than tolerance
+    (a fraction) against the baseline
+    :rtype: list[str]
+    """
+    regressions = []
+    for name,result in results.iteritems():
+        if name not in baseline:
+            continue
+        before = baseline[name]['ops_per_sec']
+        after = result['ops_per_sec']
+        if after < before * (1 - tolerance):
+            regressions.append('{0}: {1:.1f} ops/s, baseline {2:.1f} ops/s ({3:+.1f}%)'.format(
+                name,after,before,100.0 * (after - before) / before))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the commutativity toolkit.')
+    parser.add_argument('--backend', choices=['ovs', 'openflow', 'sim'], default=None,
+                        help='switch to benchmark (default: ovs in an OVS sandbox, sim otherwise)')
+    parser.add_argument('--filter', default=None, metavar='REGEX', help='only run the matching benchmarks')
+    parser.add_argument('--min-time', type=float, default=0.2, metavar='SECONDS',
+                        help='minimum time to spend on each benchmark')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='time the benchmarks in turn, in this many rounds (default: 5)')
+    parser.add_argument('--output', default='bench_results.json', help='file to write the results to')
+    parser.add_argument('--baseline', default=None, help='results file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown against the baseline that counts as a regression (default: 0.25)')
+    parser.add_argument('--parsers', action='store_true',
+                        help='only compare the parse throughput of the grammar variants')
+    parser.add_argument('--scaling', action='store_true',
+                        help='measure the cost against the flow table size instead, on synthetic rule sets')
+    parser.add_argument('--sizes', default=','.join([str(n) for n in SCALING_SIZES]),
+                        help='flow table sizes for --scaling (default: %(default)s)')
+    parser.add_argument('--max-seconds', type=float, default=60, metavar='SECONDS',
+                        help='skip --scaling points that are expected to take longer (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if args.parsers:
+        bench_parse()
+        return 0
+    backend = args.backend
+    if backend is None:
+        backend = 'ovs' if 'OVS_SYSCONFDIR' in os.environ else 'sim'
+
+    if args.scaling:
+        print 'Scaling ({0} backend):'.format(backend)
+        curves = run_scaling(backend,[int(n) for n in args.sizes.split(',')],args.max_seconds,args.filter)
+        with open(args.output,'w') as f:
+            json.dump(OrderedDict([('backend', backend),
+                                   ('date', datetime.datetime.now().isoformat()),
+                                   ('python', sys.version.split()[0]),
+                                   ('scaling', curves)]), f, indent=2)
+        print 'Results written to ' + args.output
+        return 0
+
+    print 'Benchmarks ({0} backend):'.format(backend)
+    results = run_benchmarks(backend,args.filter,args.min_time,args.rounds)
+    with open(args.output,'w') as f:
+        json.dump(OrderedDict([('backend', backend),
+                               ('date', datetime.datetime.now().isoformat()),
+                               ('python', sys.version.split()[0]),
+                               ('results', results)]), f, indent=2)
+    print 'Results written to ' + args.output
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('backend') != backend:
+            print 'Warning: the baseline was measured on the {0} backend'.format(baseline.get('backend'))
+        regressions = compare(results,baseline['results'],args.tolerance)
+        if regressions:
+            print 'PERFORMANCE REGRESSION against {0} (tolerance {1:.0f}%):'.format(args.baseline,100*args.tolerance)
+            for r in regressions:
+                print '  ' + r
+            return 1
+        print 'No regressions against ' + args.baseline
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,6 +10,21 @@ import itertools
 import datetime, time
 import functools
 import pprint
+import argparse
+import bisect
+import socket
+import struct
+import multiprocessing
+import threading
+import Queue
+import json
+import fcntl
+import hashlib
+import sqlite3
+try:
+    import numpy
+except ImportError: # optional, only needed by TernaryMatchEngine
+    numpy = None
 
 # sys.path.append(os.path.join(os.path.dirname(__file__), "pox"))
 # import pox.openflow.libopenflow_01 as of
@@ -44,21 +59,138 @@ Cmd = enum('CREATE',
 )
 
 class MainApp(object):
-    def __init__(self):
-        pass
+    def __init__(self,argv=None):
+        self.args = self._parse_args(argv)
+
+    def _parse_args(self,argv):
+        parser = argparse.ArgumentParser(description='Run the commutativity testcases against an OVS sandbox.')
+        parser.add_argument('--batch', action='store_true',
+                            help='send consecutive flow mods to the switch with a single ovs-ofctl invocation')
+        parser.add_argument('--backend', choices=['ovs', 'openflow', 'sim'], default='ovs',
+                            help='run against the OVS sandbox with ovs-ofctl (default), against the OVS sandbox '
+                                 'over a native OpenFlow connection, or against the in-process simulated switch')
+        parser.add_argument('--comparator', choices=['switch', 'analytical', 'crosscheck'], default='switch',
+                            help='decide subset/intersection queries on a scratch switch (default), analytically from '
+                                 'the match fields, or analytically with every answer verified on the switch')
+        parser.add_argument('--memoize', action='store_true',
+                            help='remember the answers of the comparator, shared between the --jobs workers')
+        parser.add_argument('--memoize-size', type=int, default=100000, metavar='N',
+                            help='number of comparator answers remembered per process (default: %(default)s)')
+        parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                            help='run the generated testcases in N worker processes, each with its own pair of bridges')
+        parser.add_argument('--plan', action='store_true',
+                            help='execute the command sequences of all testcases as a prefix tree, so that '
+                                 'shared prefixes are only executed once')
+        parser.add_argument('--snapshots', action='store_true',
+                            help='execute each initial command list once and restore a snapshot of the flow '
+                                 'tables for each testcase instead of replaying it')
+        parser.add_argument('--undo', action='store_true',
+                            help='undo the commands of a testcase or plan branch with inverse flow mods '
+                                 'instead of setting up the initial state again')
+        parser.add_argument('--monitor', action='store_true',
+                            help='determine the flows affected by a command from a flow monitor (ovs-ofctl monitor) '
+                                 'instead of dumping the flow tables before and after it; not with the sim backend')
+        parser.add_argument('--unixctl', action='store_true',
+                            help='trace packets over a persistent connection to the unixctl socket of ovs-vswitchd '
+                                 'instead of running ovs-appctl for every packet; not with the sim backend')
+        parser.add_argument('--ovsdb', action='store_true',
+                            help='create the bridges and their ports with one OVSDB transaction instead of '
+                                 'ovs-vsctl calls, and reset a bridge by clearing its flows if its ports are '
+                                 'already right; not with the sim backend')
+        parser.add_argument('--bridges', type=int, default=None, metavar='N',
+                            help='number of bridges in the pool the switches are leased from '
+                                 '(default: as many as the run needs)')
+        parser.add_argument('--runner', action='store_true',
+                            help='run the OVS command lines through a persistent helper process instead of '
+                                 'forking this process for each of them')
+        parser.add_argument('--results', default=None, metavar='FILE',
+                            help='write a record of every generated testcase to FILE as JSON Lines, as it is evaluated')
+        parser.add_argument('--keep-failed', action='store_true',
+                            help='include the commands, command results and flow tables in the records of '
+                                 'failed testcases')
+        parser.add_argument('--checkpoint', default=None, metavar='DIR',
+                            help='save the progress of the generated testcases in DIR, and resume an unfinished '
+                                 'run of the same testcases from it')
+        parser.add_argument('--checkpoint-every', type=int, default=100, metavar='N',
+                            help='save the progress every N testcases (default: %(default)s)')
+        parser.add_argument('--cache', default=None, metavar='FILE',
+                            help='keep the simulation results of the generated testcases in the SQLite database '
+                                 'FILE, per OVS version, and take them from it instead of simulating again')
+        parser.add_argument('--timings', action='store_true',
+                            help='time every switch command, testcase phase and external command, and print '
+                                 'a summary at the end')
+        parser.add_argument('--timings-json', default=None, metavar='FILE',
+                            help='time like --timings, and write the timings to FILE as JSON')
+        args = parser.parse_args(argv)
+        if args.ovsdb and args.backend == 'sim':
+            parser.error('--ovsdb requires an OVS backend')
+        if args.monitor and args.backend == 'sim':
+            parser.error('--monitor requires an OVS backend')
+        if args.unixctl and args.backend == 'sim':
+            parser.error('--unixctl requires an OVS backend')
+        return args
+
+    def _create_switch(self,name):
+        """Create a switch for the selected backend
+        :rtype: OvsSwitch
+        """
+        if self.args.backend == 'sim':
+            return SimulatedSwitch(SwitchDesc(name,10),batch=self.args.batch)
+        if self.args.backend == 'openflow':
+            return OpenFlowSwitch(SwitchDesc(name,10),batch=self.args.batch,monitor=self.args.monitor,
+                                  unixctl=self.args.unixctl,ovsdb=self.args.ovsdb)
+        return OvsSwitch(SwitchDesc(name,10),batch=self.args.batch,monitor=self.args.monitor,
+                         unixctl=self.args.unixctl,ovsdb=self.args.ovsdb)
+
+    def _create_comparator(self,switch):
+        """Create the comparator selected on the command line, switch is its scratch switch
+        :rtype: FlowComparator
+        """
+        if self.args.comparator == 'analytical':
+            comparator = AnalyticalFlowComparator()
+        elif self.args.comparator == 'crosscheck':
+            comparator = AnalyticalFlowComparator(cross_check=FlowComparator(switch))
+        else:
+            comparator = FlowComparator(switch)
+        if self.args.memoize:
+            comparator = MemoizingFlowComparator(comparator,self.args.memoize_size,self.shared_answers)
+        return comparator
+
+    def _create_worker(self):
+        """Switch, comparator and checker for a suite worker process, on two bridges
+        leased from the pool.
+        """
+        sw = self.bridge_pool.lease()
+        sw2 = self.bridge_pool.lease()
+        comparator = self._create_comparator(sw2)
+        return (sw, comparator, SdnRacerCommutativityChecker(comparator))
 
     def run(self):
         env = os.environ
         # print env
-        if 'OVS_SYSCONFDIR' not in env:
+        if self.args.backend != 'sim' and 'OVS_SYSCONFDIR' not in env:
             print "OVS sandbox not found. See the readme for instructions."
             exit()
-        sw = OvsSwitch(SwitchDesc('br0',10))
-        sw.executeCommand(Command(Cmd.RESET))
-        sw2 = OvsSwitch(SwitchDesc('br1',10))
-        sw2.executeCommand(Command(Cmd.RESET))
+        if self.args.runner:
+            CommandRunner.enable()
+        if self.args.timings or self.args.timings_json is not None:
+            Timings.enable()
+        # answers of the comparators of all workers, see MemoizingFlowComparator
+        self.shared_answers = None
+        if self.args.memoize and self.args.jobs > 1:
+            self.shared_answers = multiprocessing.Manager().dict()
+        # two bridges for this process, two for every suite worker
+        size = self.args.bridges
+        if size is None:
+            size = 2 + (2*self.args.jobs if self.args.jobs > 1 else 0)
+        # simulated bridges exist per process, there is nothing to share
+        lock_dir = None if self.args.backend == 'sim' else os.path.join(ovs_rundir(),'bridge-pool')
+        self.bridge_pool = BridgePool(self._create_switch,size,lock_dir)
+        self.bridge_pool.provision()
+        sw = self.bridge_pool.lease()
+        sw2 = self.bridge_pool.lease()
 
-        comparator = FlowComparator(sw2)
+        comparator = self._create_comparator(sw2)
         sdnracer_comm_checker = SdnRacerCommutativityChecker(comparator)
         
         testcases = []
@@ -205,15 +337,56 @@ class MainApp(object):
             [Command(Cmd.OF_ADD,FlowDescription('table=0, priority=0, tcp, actions=drop')),Command(Cmd.OF_ADD,FlowDescription('table=0, priority=5, tcp,nw_dst=10.0.0.0/24 actions=output:8'))],
             [Command(Cmd.OF_ADD,FlowDescription('table=0, priority=0, tcp, actions=drop')),Command(Cmd.OF_ADD,FlowDescription('table=0, priority=5, tcp,nw_dst=10.0.0.1 actions=output:9'))],
         ]
-        suite = CommutativityTestSuite(sw,comparator,sdnracer_comm_checker,command_list,initials_list)
-        suite.evaluate_all()
+        suite = CommutativityTestSuite(sw,comparator,sdnracer_comm_checker,command_list,initials_list,
+                                       jobs=self.args.jobs,worker_factory=self._create_worker,
+                                       use_snapshots=self.args.snapshots,use_planner=self.args.plan,
+                                       use_undo=self.args.undo,keep_failed=self.args.keep_failed,
+                                       checkpoint_dir=self.args.checkpoint,checkpoint_every=self.args.checkpoint_every,
+                                       cache_path=self.args.cache)
+        suite.evaluate_all(self.args.results)
+        if self.args.runner:
+            print CommandRunner.get().summary()
+        if self.args.memoize:
+            # with jobs > 1, it holds the counters merged from the workers
+            print comparator.summary()
+            if self.shared_answers is not None:
+                print 'Comparator cache: {0} answers shared between the workers.'.format(len(self.shared_answers))
+        if self.args.timings:
+            print Timings.get().summary()
+        if self.args.timings_json is not None:
+            with open(self.args.timings_json,'w') as f:
+                json.dump(Timings.get().export(),f,indent=2)
 
 
 class CommutativityTestSuite(object):
     """
     Given a list of commands and a list of initial commands, generate testcases for all possible combinations
     """
-    def __init__(self,switch,comparator,comm_checker,commands,initials=None):
+    def __init__(self,switch,comparator,comm_checker,commands,initials=None,jobs=1,worker_factory=None,
+                 use_snapshots=False,use_planner=False,use_undo=False,keep_failed=False,
+                 checkpoint_dir=None,checkpoint_every=100,cache_path=None):
+        """Create object
+        :type switch: OvsSwitch
+        :type comparator: FlowComparator
+        :type jobs: int
+        :param use_snapshots: execute each initial command list once and restore a snapshot of
+                              the resulting flow tables for every testcase, instead of replaying it
+        :param use_planner: execute all command sequences of an initial command list as a CommandTrie,
+                            so that every distinct prefix is only executed once
+        :param use_undo: return to an earlier state by undoing the commands executed since
+                         (OvsSwitch.rollback), instead of setting up the initial state again
+                         or restoring a snapshot
+        :param keep_failed: include the commands, results and flow tables in the records of
+                            failed cases (see result_record())
+        :param checkpoint_dir: save the progress of evaluate_all() in this directory every checkpoint_every
+                               cases, and resume from it (see suite_key())
+        :param cache_path: SQLite database of simulation results (see SimulationCache), cases found in it
+                           are not simulated again
+        :param worker_factory: for jobs > 1, called without arguments in each worker process (also
+                               in those the pool starts to replace others), returns a (switch,
+                               comparator, comm_checker) tuple that must not share bridges with
+                               any other worker, e.g. leased from a BridgePool
+        """
         self.switch = switch
         self.comparator = comparator
         self.comm_checker = comm_checker
@@ -223,71 +396,517 @@ class CommutativityTestSuite(object):
         self.initials = initials
         if initials == None:
             initials = [[]]
+        self.jobs = jobs
+        self.worker_factory = worker_factory
+        self.use_snapshots = use_snapshots
+        self._snapshot = None # (initial index, snapshot)
+        self.use_planner = use_planner
+        self._plan = None # (initial index, CommandTrie)
+        self.use_undo = use_undo
+        self.keep_failed = keep_failed
+        self.failed = [] # records of the failed cases of the last evaluate_all()
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.cache_path = cache_path
+        self.cache = None
+        ': :type cache: SimulationCache'
+        if cache_path is not None:
+            self.cache = SimulationCache(cache_path,self.simulation_version())
         self.predictor = CommutativityPredictor(self.switch,self.comparator, self.comm_checker)
 
-    def evaluate_all(self):
-        testcases = []
-        caseno = 0
-        passed = 0
-        failed_imprecise = 0
-        failed_unsound = 0
-        failed = 0
-        na = 0
-        skipped = 0
-        total = 0
-        
+    def generate_cases(self):
+        """List all testcases as (caseno, initial index, command index a, command index b)
+        :rtype: list[(int, int, int, int)]
+        """
         valid_types = [Cmd.TRACE, Cmd.OF_ADD, Cmd.OF_DEL, Cmd.OF_MOD]
         
         valid_perms = []
-        for i in itertools.permutations(self.commands,2): # both orderings: AB, BA!
-          if i[0].type in valid_types and i[1].type in valid_types:
-            total += 1
-            valid_perms.append(i)
-        
-        total = total * len(self.initials)
+        for ia,ib in itertools.permutations(range(len(self.commands)),2): # both orderings: AB, BA!
+          if self.commands[ia].type in valid_types and self.commands[ib].type in valid_types:
+            valid_perms.append((ia,ib))
+
+        cases = []
+        caseno = 0
+        for i in xrange(len(self.initials)):
+            for ia,ib in valid_perms:
+                caseno += 1
+                cases.append((caseno,i,ia,ib))
+        return cases
+
+    def evaluate_all(self,results_path=None):
+        """Evaluate all testcases, print their outcomes and the totals.
+        Only the totals and the records of the failed cases (see failed) are kept.
+        With a checkpoint directory, continues after the last case of an earlier run of the same
+        commands and initials that did not finish.
+        :param results_path: write the record of every case to this file as it is evaluated, as JSON Lines
+        """
+        counts = OrderedDict([(outcome, 0) for outcome in ('passed', 'imprecise', 'unsound', 'na')])
+        skipped = 0
+        self.failed = []
+
+        cases = self.generate_cases()
+        total = len(cases)
         
         print 'Running a total of {0} testcases.'.format(total)
         debug_cases = None #[1] #[257] #[116] # TODO(jm): Debug code, remove
-        for i in self.initials:
-            for a,b in valid_perms:
-                caseno += 1
-                if debug_cases is None or caseno in debug_cases: # TODO(jm): Debug code, remove
-                    print str(caseno) + '/' +str(total) + ':',
-                    tc = CommutativityTestCase(self.switch,a,b,i)
-                    testcases.append(tc)
-                    tc.expected = self.predictor.predict(tc)
-                    if tc.expected is None:
-                      print 'Skipped (N/A)'
-                      print tc
-                      na += 1
-                      continue
-                    result,info_str = tc.evaluate()
-                    tc.result = result
-                    tc.info_str = info_str
-                    if result is True:
-                        passed += 1
-                        print 'Pass. ' + info_str
-#                         print str(tc)
-                    elif result is False:
-                        failed += 1
-                        if tc.expected == False:
-                            # it commuted although we did not expect it to
-                            failed_imprecise += 1
-                            print 'Fail (impreciseness). ' + info_str
-#                             print str(tc)
-                        else:
-                            failed_unsound += 1
-                            print 'Fail (unsoundness! Invalid rules!). ' + info_str
-                            print str(tc)
-                    else:
-                        na += 1
-                        print 'N/A. ' + info_str
-                        print str(tc)
-        print 'Passed: {0}, Failed: {1} (imprecise: {2}, unsound: {3}), Skipped: {4}, N/A: {5}, Total testcases: {6}'.format(passed,failed,failed_imprecise,failed_unsound,skipped,na,total)
+        if debug_cases is not None: # TODO(jm): Debug code, remove
+            cases = [c for c in cases if c[0] in debug_cases]
+
+        done = 0 # number of the last evaluated case
+        results_offset = 0 # end of the record of case done in the results file
+        checkpoint = self._load_checkpoint()
+        if checkpoint is not None:
+            done = checkpoint['case']
+            counts.update(checkpoint['counts'])
+            self.failed = checkpoint['failed']
+            results_offset = checkpoint['results_offset']
+        results_file = None
+        if results_path is not None:
+            if checkpoint is not None and os.path.exists(results_path):
+                done,results_offset = self._reconcile_results(results_path,results_offset,done,counts)
+                results_file = open(results_path,'r+')
+                results_file.truncate(results_offset)
+                results_file.seek(results_offset)
+            else:
+                if checkpoint is not None and done > 0:
+                    print 'Warning: {0} not found, it will not have the records of testcases 1-{1}.'.format(results_path,done)
+                results_file = open(results_path,'w')
+                results_offset = 0
+        if done > 0:
+            print 'Resuming after testcase {0}.'.format(done)
+
+        finished = False
+        unsaved = 0
+        try:
+            for record,lines in self.iter_results([c for c in cases if c[0] > done],total):
+                print '\n'.join(lines)
+                if results_file is not None:
+                    results_file.write(json.dumps(record) + '\n')
+                    results_file.flush()
+                    results_offset = results_file.tell()
+                counts[record['outcome']] += 1
+                if record['outcome'] in ('imprecise', 'unsound'):
+                    self.failed.append(record)
+                done = record['case']
+                unsaved += 1
+                if self.checkpoint_dir is not None and unsaved >= self.checkpoint_every:
+                    self._save_checkpoint(done,counts,results_offset)
+                    unsaved = 0
+            finished = True
+        finally:
+            if results_file is not None:
+                results_file.close()
+            if self.checkpoint_dir is not None:
+                if finished:
+                    self._remove_checkpoint()
+                elif unsaved > 0:
+                    self._save_checkpoint(done,counts,results_offset)
+        failed = counts['imprecise'] + counts['unsound']
+        print 'Passed: {0}, Failed: {1} (imprecise: {2}, unsound: {3}), Skipped: {4}, N/A: {5}, Total testcases: {6}'.format(counts['passed'],failed,counts['imprecise'],counts['unsound'],skipped,counts['na'],total)
+        if self.use_planner:
+            planned = sum([self._build_plan(i,cases).count_operations(self.commands,self.initials,self.use_undo)
+                           for i in xrange(len(self.initials))])
+            naive = self._count_naive_operations(cases)
+            print 'Execution plan: {0} switch commands instead of {1} (saved {2}, {3:.1f}%).'.format(planned,naive,naive-planned,100.0*(naive-planned)/max(1,naive))
         print 'Note: Test failures due to impreciseness are expected and not a problem. This means that our commutativity checker predicted that a testcase would not commute, but it actually did when simulated. This is not a guarantee that the pair of rules would commute in every scenario, just that they did for the initial state given in the testcase.'
         print 'Note: Test failures due to unsoundness (predicted that the testcase commutes but it actually does not) are a major problem and the count should be 0.'
         print 'Done!'
 
+    def simulation_version(self):
+        """What the simulation results depend on besides the testcase (see SimulationCache): the switch
+        implementation and class, and the options that change what the results hold. With the flow
+        monitor, the results of flow mods have no before_set/after_set, and neither do traces that the
+        planner runs together.
+        :rtype: str
+        """
+        return '{0}\n{1} monitor={2} planner={3}'.format(self.switch.version(),type(self.switch).__name__,
+                                                        self.switch.use_monitor,self.use_planner)
+
+    def suite_key(self):
+        """Stable hash of the commands and initial command lists, identifies the checkpoint of the suite
+        :rtype: str
+        """
+        h = hashlib.sha1()
+        for cmd in self.commands:
+            h.update(str(cmd) + '\n')
+        for initial in self.initials:
+            h.update('--\n')
+            for cmd in initial:
+                h.update(str(cmd) + '\n')
+        return h.hexdigest()
+
+    def _checkpoint_path(self):
+        return os.path.join(self.checkpoint_dir,'suite-' + self.suite_key()[:16] + '.json')
+
+    def _load_checkpoint(self):
+        """The checkpoint of an unfinished earlier run, None if there is none
+        :rtype: dict
+        """
+        if self.checkpoint_dir is None or not os.path.exists(self._checkpoint_path()):
+            return None
+        with open(self._checkpoint_path()) as f:
+            checkpoint = json.load(f)
+        if checkpoint['key'] != self.suite_key():
+            raise Exception('Checkpoint ' + self._checkpoint_path() + ' belongs to another suite')
+        return checkpoint
+
+    def _save_checkpoint(self,done,counts,results_offset):
+        """Record that the cases up to done are evaluated, with the totals so far and the end of
+        the record of case done in the results file
+        """
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        path = self._checkpoint_path()
+        with open(path + '.tmp','w') as f:
+            json.dump(OrderedDict([('key', self.suite_key()), ('case', done), ('counts', counts),
+                                   ('failed', self.failed), ('results_offset', results_offset)]), f)
+        # replaces the previous checkpoint at once, a crash leaves either of them
+        os.rename(path + '.tmp',path)
+
+    def _remove_checkpoint(self):
+        if os.path.exists(self._checkpoint_path()):
+            os.remove(self._checkpoint_path())
+
+    def _reconcile_results(self,results_path,offset,done,counts):
+        """Take over the records the results file has after the checkpoint: the complete records
+        of the cases following case done are counted, anything after them is dropped.
+        Returns the number of the last case and the offset after its record.
+        :rtype: (int, int)
+        """
+        size = os.path.getsize(results_path)
+        if size < offset:
+            print 'Warning: {0} is shorter than at the checkpoint, it will not have all records.'.format(results_path)
+            return (done, size)
+        with open(results_path) as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith('\n'):
+                    break # cut off by the crash
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if record.get('case') != done + 1:
+                    break
+                counts[record['outcome']] += 1
+                if record['outcome'] in ('imprecise', 'unsound'):
+                    self.failed.append(record)
+                done = record['case']
+                offset += len(line)
+        return (done, offset)
+
+    def iter_results(self,cases,total):
+        """Evaluate cases (from generate_cases()), in the worker processes if jobs > 1.
+        Yields the record (see result_record()) and the lines to print of each case, in case order.
+        The testcases themselves are released once their record is made.
+        :rtype: generator[(dict, list[str])]
+        """
+        if self.jobs <= 1:
+            for caseno,i,ia,ib in cases:
+                outcome,lines,tc = self.evaluate_case(caseno,i,ia,ib,total)
+                yield (self.result_record(caseno,i,ia,ib,outcome,tc), lines)
+            return
+        pool = multiprocessing.Pool(self.jobs, _suite_worker_init,
+                                    (self.worker_factory, self.commands, self.initials, self._worker_options()))
+        try:
+            # imap returns the outcomes in case number order
+            chunksize = max(1, len(cases) / (self.jobs * 16))
+            if self.use_planner:
+                # one initial command list per chunk, so that each list is planned by one worker only
+                chunksize = max(1, total / len(self.initials))
+            for record,lines,worker_timings,worker_counters in pool.imap(_suite_worker_evaluate, [c + (total,) for c in cases], chunksize):
+                if worker_timings is not None:
+                    Timings.get().merge(worker_timings)
+                if worker_counters is not None:
+                    self.comparator.merge(worker_counters)
+                yield (record, lines)
+            pool.close()
+        finally:
+            pool.terminate()
+
+    def result_record(self,caseno,i,ia,ib,outcome,tc):
+        """Compact, JSON serializable result of an evaluated testcase. With keep_failed, the
+        record of a failed case also has the state of the switch (see _testcase_state()).
+        :type tc: CommutativityTestCase
+        :rtype: OrderedDict
+        """
+        record = OrderedDict([('case', caseno), ('initial', i), ('a', ia), ('b', ib),
+                              ('outcome', outcome),
+                              ('expected', tc.expected),
+                              ('result', getattr(tc,'result',None)),
+                              ('info', getattr(tc,'info_str',None)),
+                              ('timings', tc.timings)])
+        if self.keep_failed and outcome in ('imprecise', 'unsound'):
+            record['state'] = _testcase_state(tc)
+        return record
+
+    def evaluate_case(self,caseno,i,ia,ib,total):
+        """Simulate and predict a single testcase.
+        Returns the outcome ('passed', 'imprecise', 'unsound' or 'na'), the lines to print
+        and the testcase.
+        :rtype: (str, list[str], CommutativityTestCase)
+        """
+        prefix = str(caseno) + '/' +str(total) + ': '
+        phases = OrderedDict()
+        start = time.time()
+        tc = CommutativityTestCase(self.switch,self.commands[ia],self.commands[ib],self.initials[i],
+                                   use_undo=self.use_undo)
+        cached = self.cache is not None and self.cache.load(tc)
+        if cached:
+            pass # simulated in an earlier run
+        elif self.use_planner:
+            if self._plan is None or self._plan[0] != i:
+                self._plan = None # release the results of the previous list first
+                plan = self._build_plan(i,self.generate_cases())
+                plan.execute(self.switch,self.commands,self.initials,use_undo=self.use_undo)
+                self._plan = (i, plan)
+            ab = self._plan[1].node([i,ia,ib])
+            ba = self._plan[1].node([i,ib,ia])
+            tc.set_results(ab.parent.result,ab.result,ab.dump,ba.parent.result,ba.result,ba.dump)
+        else:
+            tc.initial_snapshot = self._initial_snapshot(i)
+            tc.simulate()
+        if self.cache is not None and not cached:
+            self.cache.save(tc)
+        phases['simulate'] = time.time() - start
+        start = time.time()
+        tc.expected = self.predictor.predict(tc)
+        phases['predict'] = time.time() - start
+        if tc.expected is None:
+          self._set_timings(caseno,tc,phases)
+          return ('na', [prefix + 'Skipped (N/A)', str(tc)], tc)
+        start = time.time()
+        result,info_str = tc.evaluate()
+        phases['evaluate'] = time.time() - start
+        self._set_timings(caseno,tc,phases)
+        tc.result = result
+        tc.info_str = info_str
+        if result is True:
+            return ('passed', [prefix + 'Pass. ' + info_str], tc)
+        elif result is False:
+            if tc.expected == False:
+                # it commuted although we did not expect it to
+                return ('imprecise', [prefix + 'Fail (impreciseness). ' + info_str], tc)
+            else:
+                return ('unsound', [prefix + 'Fail (unsoundness! Invalid rules!). ' + info_str, str(tc)], tc)
+        else:
+            return ('na', [prefix + 'N/A. ' + info_str, str(tc)], tc)
+
+    def _set_timings(self,caseno,tc,phases):
+        """Store the seconds per phase of a testcase in it, and record them if timing is enabled
+        :type tc: CommutativityTestCase
+        :type phases: OrderedDict
+        """
+        tc.timings = phases
+        timings = Timings.get()
+        if timings is not None:
+            timings.add_case(caseno,phases)
+
+    def _initial_snapshot(self,i):
+        """Snapshot of the switch after executing initial command list i, if snapshots are used.
+        Only the snapshot of the most recent initial list is kept, as cases are ordered by it.
+        """
+        if not self.use_snapshots:
+            return None
+        if self._snapshot is None or self._snapshot[0] != i:
+            self.switch.executeCommand(Command(Cmd.CLEAR))
+            self.switch.executeCommands(self.initials[i])
+            self._snapshot = (i, self.switch.snapshot())
+        return self._snapshot[1]
+
+    def _build_plan(self,i,cases):
+        """CommandTrie of the command sequences needed for the cases with initial command list i
+        :rtype: CommandTrie
+        """
+        plan = CommandTrie()
+        for caseno,j,ia,ib in cases:
+            if j == i:
+                plan.insert([i,ia,ib])
+                plan.insert([i,ib,ia])
+        return plan
+
+    def _count_naive_operations(self,cases):
+        """Number of switch commands executed by CommutativityTestCase.simulate() for the cases
+        """
+        count = 0
+        for caseno,i,ia,ib in cases:
+            if self.use_snapshots:
+                setup = 1 # restore
+            else:
+                setup = 1 + len(self.initials[i]) # CLEAR, initial commands
+            if self.use_undo:
+                # rollback of a and b instead of the second setup, if they changed anything
+                changes = [self.commands[ia].type in OvsSwitch.UNDOABLE,self.commands[ib].type in OvsSwitch.UNDOABLE]
+                count += setup + (1 if any(changes) else 0) + 4 + 2 + 1
+                continue
+            count += 2*setup + 4 + 2 + 1 # a, b, b, a, two DUMPs, CLEAR
+        if self.use_snapshots:
+            count += sum([1 + len(initial) + 1 for initial in self.initials]) # CLEAR, initial commands, snapshot
+        return count
+
+    def _worker_options(self):
+        """Keyword arguments for the suites in the worker processes
+        """
+        return {'use_snapshots' : self.use_snapshots,
+                'use_planner' : self.use_planner,
+                'use_undo' : self.use_undo,
+                'keep_failed' : self.keep_failed,
+                'cache_path' : self.cache_path}
+
+def _testcase_state(tc):
+    """The commands, results and flow tables of a simulated testcase, JSON serializable
+    :type tc: CommutativityTestCase
+    :rtype: OrderedDict
+    """
+    def flows(flow_set):
+        return None if flow_set is None else sorted([str(f) for f in flow_set])
+    def result(r):
+        ': :type r: CommandResult'
+        return OrderedDict([('added', flows(r.added_flows)),
+                            ('removed', flows(r.removed_flows)),
+                            ('traced_rule', None if r.traced_rule is None else str(r.traced_rule)),
+                            ('traced_actions', None if r.traced_actions is None else str(r.traced_actions))])
+    return OrderedDict([('a', str(tc.a)), ('b', str(tc.b)),
+                        ('initial', [str(c) for c in tc.initial]),
+                        ('a_executed', result(tc.state_a_executed)),
+                        ('ab_executed', result(tc.state_ab_executed)),
+                        ('dump_ab', flows(tc.dump_ab_done.dumped_flows)),
+                        ('b_executed', result(tc.state_b_executed)),
+                        ('ba_executed', result(tc.state_ba_executed)),
+                        ('dump_ba', flows(tc.dump_ba_done.dumped_flows))])
+
+# State of a CommutativityTestSuite worker process, see CommutativityTestSuite.evaluate_all
+
+_suite_worker = None
+
+def _suite_worker_init(worker_factory,commands,initials,options):
+    global _suite_worker
+    switch,comparator,comm_checker = worker_factory()
+    _suite_worker = CommutativityTestSuite(switch,comparator,comm_checker,commands,initials,**options)
+
+def _suite_worker_evaluate(case):
+    outcome,lines,tc = _suite_worker.evaluate_case(*case)
+    record = _suite_worker.result_record(*(case[:4] + (outcome,tc)))
+    timings = Timings.get()
+    comparator = _suite_worker.comparator
+    # the timings and comparator counters since the previous case are merged by the suite
+    return (record,lines,timings.take() if timings is not None else None,
+            comparator.take() if isinstance(comparator,MemoizingFlowComparator) else None)
+
+
+class CommandTrie(object):
+    """
+    Prefix tree of command sequences [initial index, command index, command index, ...].
+    Executing the trie depth-first produces every distinct prefix state only once:
+    a node's state is checkpointed with a switch snapshot and restored before each
+    further child, or, with use_undo, restored by rolling back the commands of the
+    previous child's branch. Each command node stores its CommandResult (with return_affected),
+    each end of a sequence a DUMP of the flow tables.
+    """
+    def __init__(self,key=None,parent=None):
+        self.key = key
+        self.parent = parent
+        self.children = OrderedDict()
+        self.is_end = False # a sequence ends here
+        self.result = None
+        ': :type result: CommandResult'
+        self.dump = None
+        ': :type dump: CommandResult'
+
+    def insert(self,keys):
+        node = self
+        for key in keys:
+            if key not in node.children:
+                node.children[key] = CommandTrie(key,node)
+            node = node.children[key]
+        node.is_end = True
+
+    def node(self,keys):
+        """
+        :rtype: CommandTrie
+        """
+        node = self
+        for key in keys:
+            node = node.children[key]
+        return node
+
+    def execute(self,switch,commands,initials,use_undo=False):
+        """Execute all sequences on the switch. The first key of a sequence selects the initial
+        command list, the others select commands.
+        Returns the number of switch commands executed.
+        :type switch: OvsSwitch
+        :rtype: int
+        """
+        return self._walk(switch,commands,initials,0,use_undo)
+
+    def count_operations(self,commands,initials,use_undo=False):
+        """Number of switch commands that execute() will issue. A rollback counts as one.
+        :rtype: int
+        """
+        return self._walk(None,commands,initials,0,use_undo)
+
+    def _changes_state(self,commands):
+        """Whether the commands left in the undo log after executing this node's branch change
+        the state: the node's own command and those along the path of last children.
+        """
+        node = self
+        while node is not None:
+            if commands[node.key].type in OvsSwitch.UNDOABLE:
+                return True
+            node = next(reversed(node.children.values()),None)
+        return False
+
+    def _walk(self,switch,commands,initials,depth,use_undo,traced=False):
+        # depth 0 is the root, depth 1 the initial command lists, deeper levels are commands.
+        # traced: the result of this node's TRACE command was already set by the parent
+        count = 0
+        if depth == 1:
+            count += 1 + len(initials[self.key]) # CLEAR, initial commands
+            if switch is not None:
+                switch.executeCommand(Command(Cmd.CLEAR))
+                switch.executeCommands(initials[self.key])
+                if use_undo:
+                    switch.start_undo_log()
+        elif depth > 1:
+            count += 1
+            if switch is not None and not traced:
+                self.result = switch.executeCommand(commands[self.key],return_affected=True)
+        if self.is_end:
+            count += 1
+            if switch is not None:
+                self.dump = switch.executeCommand(Command(Cmd.DUMP,dump_removeStatistics=True))
+        checkpoint = None
+        if depth > 0 and len(self.children) > 1 and not use_undo:
+            count += 1
+            if switch is not None:
+                checkpoint = switch.snapshot()
+        # every child starts from this node's state, so their TRACE commands are sent together
+        traces = [child for child in self.children.itervalues()
+                  if depth > 0 and commands[child.key].type == Cmd.TRACE]
+        if len(traces) > 1 and switch is not None:
+            for child,result in zip(traces,switch.trace_many([commands[child.key] for child in traces],True)):
+                child.result = result
+        else:
+            traces = []
+        previous = None
+        mark = None
+        for n,child in enumerate(self.children.itervalues()):
+            if n > 0 and depth > 0:
+                if not use_undo:
+                    count += 1
+                    if switch is not None:
+                        switch.restore(checkpoint)
+                elif previous._changes_state(commands):
+                    count += 1
+                    if switch is not None:
+                        switch.rollback(len(switch.undo_log) - mark)
+            if use_undo and depth > 0 and switch is not None:
+                mark = len(switch.undo_log)
+            count += child._walk(switch,commands,initials,depth+1,use_undo,child in traces)
+            previous = child
+        if depth == 1 and use_undo and switch is not None:
+            switch.stop_undo_log()
+        return count
 
 class CommutativityPredictor(object):
     def __init__(self,switch,comparator, comm_checker):
@@ -442,7 +1061,12 @@ class SubsetTestCase(object):
             return (None,info_str)
 
 class CommutativityTestCase(object):
-    def __init__(self,switch,a,b,initial=None,expected=None):
+    def __init__(self,switch,a,b,initial=None,expected=None,initial_snapshot=None,use_undo=False):
+        """Create object
+        :param initial_snapshot: switch snapshot taken after executing the initial commands,
+                                 restored instead of replaying them
+        :param use_undo: roll back a and b for the b->a run instead of setting up the initial state again
+        """
         self.switch = switch
         self.a = a.copy()
         self.b = b.copy()
@@ -450,37 +1074,71 @@ class CommutativityTestCase(object):
         if initial is None:
             self.initial = []
         self.expected = expected
+        self.initial_snapshot = initial_snapshot
+        self.use_undo = use_undo
         self._simulate_done = False
+        # seconds per phase (simulate, predict, evaluate), set by CommutativityTestSuite
+        self.timings = None
+
+    def _setup_initial(self):
+        """Bring the switch into the initial state
+        """
+        if self.initial_snapshot is not None:
+            self.switch.restore(self.initial_snapshot)
+        else:
+            self.switch.executeCommand(Command(Cmd.CLEAR))
+            self.switch.executeCommands(self.initial)
 
     def simulate(self):
         """
         Execute both possible traces, store results
         """
         
-        self.switch.executeCommand(Command(Cmd.CLEAR))
         if not self._simulate_done:
             # print "Running a->b"
-            for cmd in self.initial:
-                self.switch.executeCommand(cmd)
-            self.state_a_executed = self.switch.executeCommand(self.a,return_affected=True)
-            self.state_ab_executed = self.switch.executeCommand(self.b,return_affected=True)
+            self._setup_initial()
+            if self.use_undo:
+                self.switch.start_undo_log()
+            self.state_a_executed,self.state_ab_executed = self._execute_pair(self.a,self.b)
     
             self.dump_ab_done = self.switch.executeCommand(Command(Cmd.DUMP,dump_removeStatistics=True))
     
             # TODO: not strictly needed anymore, as testcases have order now. However, this might be very useful for debugging if we can see the reverse order.
     
             # print "Running b->a"
-            self.switch.executeCommand(Command(Cmd.CLEAR))
-            for cmd in self.initial:
-                self.switch.executeCommand(cmd)
+            if self.use_undo:
+                self.switch.rollback(len(self.switch.undo_log))
+                self.switch.stop_undo_log()
+            else:
+                self._setup_initial()
     
-            self.state_b_executed = self.switch.executeCommand(self.b,return_affected=True)
-            self.state_ba_executed = self.switch.executeCommand(self.a,return_affected=True)
+            self.state_b_executed,self.state_ba_executed = self._execute_pair(self.b,self.a)
     
             self.dump_ba_done = self.switch.executeCommand(Command(Cmd.DUMP,dump_removeStatistics=True))
     
             self._simulate_done = True
-        self.switch.executeCommand(Command(Cmd.CLEAR))
+            self.switch.executeCommand(Command(Cmd.CLEAR))
+
+    def _execute_pair(self,first,second):
+        """Execute two commands in order. Two TRACE commands read the same state and are sent together.
+        :rtype: (CommandResult, CommandResult)
+        """
+        if first.type == Cmd.TRACE and second.type == Cmd.TRACE:
+            return tuple(self.switch.trace_many([first,second],True))
+        return (self.switch.executeCommand(first,return_affected=True),
+                self.switch.executeCommand(second,return_affected=True))
+
+    def set_results(self,state_a_executed,state_ab_executed,dump_ab_done,state_b_executed,state_ba_executed,dump_ba_done):
+        """Use results of an execution elsewhere (see CommandTrie) instead of simulating.
+        :type state_a_executed: CommandResult
+        """
+        self.state_a_executed = state_a_executed
+        self.state_ab_executed = state_ab_executed
+        self.dump_ab_done = dump_ab_done
+        self.state_b_executed = state_b_executed
+        self.state_ba_executed = state_ba_executed
+        self.dump_ba_done = dump_ba_done
+        self._simulate_done = True
 
     def evaluate(self):
         """
@@ -542,6 +1200,72 @@ class CommutativityTestCase(object):
         initial_str = ', '.join([str(i) for i in self.initial])
         return '(\n\t' + str(self.a) + ',\n\t' + str(self.b) + ',\n\tinitial=' + initial_str + ',\n\texpected=' + str(self.expected) + '\n)'
 
+class SimulationCache(object):
+    """
+    Results of simulated testcases (CommutativityTestCase.simulate), kept in an SQLite database.
+    They only depend on the initial commands, the commands a and b, the switch implementation and
+    the options of the run that change the results (see CommutativityTestSuite.simulation_version()),
+    so a case is looked up by a hash of these (see key()). Several processes can share a database.
+    """
+    def __init__(self,path,version):
+        """Create object, the database is opened on first use
+        :param version: the switch implementation and options (CommutativityTestSuite.simulation_version())
+        """
+        self.path = path
+        self.version = version
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path,timeout=60)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS simulations (key TEXT PRIMARY KEY, results TEXT NOT NULL)')
+            self.db.commit()
+        return self.db
+
+    def key(self,tc):
+        """
+        :type tc: CommutativityTestCase
+        :rtype: str
+        """
+        h = hashlib.sha1()
+        h.update(self.version + '\n')
+        for cmd in tc.initial:
+            h.update(str(cmd) + '\n')
+        h.update('--\n' + str(tc.a) + '\n--\n' + str(tc.b) + '\n')
+        return h.hexdigest()
+
+    def load(self,tc):
+        """Set the results of tc from the cache (see CommutativityTestCase.set_results())
+        :type tc: CommutativityTestCase
+        :rtype: bool
+        :return: whether the case was cached
+        """
+        row = self._connect().execute('SELECT results FROM simulations WHERE key = ?',(self.key(tc),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        data = json.loads(row[0])
+        dump = Command(Cmd.DUMP,dump_removeStatistics=True)
+        tc.set_results(CommandResult.from_json(tc.a,data[0]),CommandResult.from_json(tc.b,data[1]),
+                       CommandResult.from_json(dump,data[2]),CommandResult.from_json(tc.b,data[3]),
+                       CommandResult.from_json(tc.a,data[4]),CommandResult.from_json(dump,data[5]))
+        return True
+
+    def save(self,tc):
+        """Add the results of a simulated testcase
+        :type tc: CommutativityTestCase
+        """
+        results = [tc.state_a_executed, tc.state_ab_executed, tc.dump_ab_done,
+                   tc.state_b_executed, tc.state_ba_executed, tc.dump_ba_done]
+        db = self._connect()
+        db.execute('INSERT OR REPLACE INTO simulations VALUES (?, ?)',
+                   (self.key(tc), json.dumps([r.to_json() for r in results])))
+        db.commit()
+
 class FlowComparator(object):
     def __init__(self,switch):
         self.switch = switch
@@ -610,31 +1334,134 @@ class FlowComparator(object):
               return False
         
     def subset_set(self,s,flow_set):
-        """Return all flows that are a subset of s (are more strict than s)
+        """Return all flows that are a subset of s (are more strict than s).
+        Given a FlowIndex, only the candidates it finds are compared; build one to
+        reuse it across queries on the same flows, a single query is cheaper without.
+        :type flow_set: collections.Iterable[FlowDescription] | FlowIndex
         """
-        subset_flows = set()
-        for t in flow_set:
-            if self.is_subset(t, s): #s is more general
-                subset_flows.add(t)
-        return subset_flows
+        flows = flow_set.subsets(s) if isinstance(flow_set,FlowIndex) else list(flow_set)
+        return set([t for t,subset in zip(flows,self.is_subset_many([(t,s) for t in flows])) if subset]) #s is more general
     
     def intersecting_set(self,s,flow_set):
         """Return all flows that overlap with the given mask
+        :type flow_set: collections.Iterable[FlowDescription] | FlowIndex
         """
-        intersecting_flows = set()
-        for t in flow_set:
-            if self.is_intersection_nonempty(t, s):
-                intersecting_flows.add(t)
-        return intersecting_flows
+        flows = flow_set.overlapping(s) if isinstance(flow_set,FlowIndex) else list(flow_set)
+        return set([t for t,nonempty in zip(flows,self.is_intersection_nonempty_many([(t,s) for t in flows])) if nonempty])
     
     def superset_set(self,s,flow_set):
         """Return all flows that are a superset of s (s is a subset of) (are more general than s)
+        :type flow_set: collections.Iterable[FlowDescription] | FlowIndex
+        """
+        flows = flow_set.supersets(s) if isinstance(flow_set,FlowIndex) else list(flow_set)
+        return set([t for t,subset in zip(flows,self.is_subset_many([(s,t) for t in flows])) if subset])
+
+    # pairs compared at once by the *_many queries, each in a flow table of its own
+    BATCH_TABLES = 250
+
+    def is_subset_many(self,pairs):
+        """is_subset(s,t) for every pair (s,t). On a switch with several flow tables, pairs
+        of flows in table 0 are compared in batches: pair k is installed in table k, so that a
+        batch takes a few switch commands per pair and a single reset instead of one per pair.
+        Pairs that share a flow still need a table each: the answers are read from non-strict
+        deletes, overwrites and overlap errors, which any other flow in the table would disturb.
+        The flows are not modified.
+        :type pairs: list[(FlowDescription, FlowDescription)]
+        :rtype: list[bool]
+        """
+        return self._many(pairs,self._is_subset_batch,lambda s,t: self.is_subset(s,t))
+
+    def is_intersection_nonempty_many(self,pairs):
+        """is_intersection_nonempty(s,t) for every pair (s,t), in batches like is_subset_many().
+        The flows are not modified.
+        :type pairs: list[(FlowDescription, FlowDescription)]
+        :rtype: list[bool]
+        """
+        return self._many(pairs,self._is_intersection_nonempty_batch,
+                          lambda s,t: self.is_intersection_nonempty(s.copy(),t.copy()))
+
+    def _many(self,pairs,batch,single):
+        results = [None] * len(pairs)
+        batched = []
+        for i,(s,t) in enumerate(pairs):
+            if self.switch.TABLES > 1 and s.fields.get('table','0') == '0' and t.fields.get('table','0') == '0':
+                batched.append(i)
+            else:
+                results[i] = single(s,t)
+        size = min(self.BATCH_TABLES,self.switch.TABLES)
+        for start in xrange(0,len(batched),size):
+            indexes = batched[start:start+size]
+            for i,result in zip(indexes,batch([pairs[i] for i in indexes])):
+                results[i] = result
+        return results
+
+    def _in_table(self,f,table,actions):
+        """Copy of f in another table, with other actions
+        :type f: FlowDescription
+        :rtype: FlowDescription
+        """
+        copy = f.copy()
+        copy.fields = [('table', str(table))] + [(k,v) for k,v in copy.fields.iteritems() if k != 'table']
+        copy.actions = OrderedDict([(actions,None)])
+        return copy
+
+    def _table_counts(self):
+        """Number of flows in each table
+        :rtype: dict
         """
-        superset_flows = set()
-        for t in flow_set:
-            if self.is_subset(s, t):
-                superset_flows.add(t)
-        return superset_flows
+        counts = {}
+        for f in self.switch.executeCommand(Command(Cmd.DUMP,dump_removeStatistics=True)).dumped_flows:
+            table = int(f.fields.get('table','0'),0)
+            counts[table] = counts.get(table,0) + 1
+        return counts
+
+    def _is_subset_batch(self,pairs):
+        """is_subset() of up to BATCH_TABLES pairs, pair k in table k
+        :rtype: list[bool]
+        """
+        self._reset()
+        s_copies = [self._in_table(s,k,'1') for k,(s,t) in enumerate(pairs)]
+        t_copies = [self._in_table(t,k,'2') for k,(s,t) in enumerate(pairs)]
+        # in every table: t, then s, which overwrites t if they are the same
+        self.switch.executeCommands([Command(Cmd.OF_ADD,f) for f in t_copies + s_copies])
+        before = self._table_counts()
+        self.switch.executeCommands([Command(Cmd.OF_DEL,f) for f in t_copies])
+        after = self._table_counts()
+        self._reset()
+        results = []
+        for k in xrange(len(pairs)):
+            if before.get(k,0) == 1:
+                # s overwrote t, s == t
+                results.append(True)
+            else:
+                assert before.get(k,0) == 2 and after.get(k,0) in (0,1)
+                # if s matches t, both t and s were removed
+                results.append(after.get(k,0) == 0)
+        return results
+
+    def _is_intersection_nonempty_batch(self,pairs):
+        """is_intersection_nonempty() of up to BATCH_TABLES pairs, pair k in table k
+        :rtype: list[bool]
+        """
+        self._reset()
+        s_copies = []
+        t_copies = []
+        for k,(s,t) in enumerate(pairs):
+            s_copy = self._in_table(s,k,'1')
+            t_copy = self._in_table(t,k,'2')
+            # set priorities to be the same
+            s_copy.set_priority(5)
+            t_copy.set_priority(5)
+            t_copy.fields['check_overlap'] = None #enables overlap checking (key has no value, thus None)
+            s_copies.append(s_copy)
+            t_copies.append(t_copy)
+        self.switch.executeCommands([Command(Cmd.OF_ADD,f) for f in s_copies])
+        # every check_overlap flow mod is executed on its own, its result tells about the overlap
+        results_t = self.switch.executeCommands([Command(Cmd.OF_ADD,f) for f in t_copies])
+        after = self._table_counts()
+        self._reset()
+        # only one flow in the table: s overwrote t, s == t
+        return [after.get(k,0) == 1 or results_t[k].overlap_error is True for k in xrange(len(pairs))]
 
     def is_subset(self,s,t):
         """Do all packets matching s also match t (t is more general)?
@@ -675,6 +1502,227 @@ class FlowComparator(object):
                 # s does not match t, so only t was removed
                 return False
 
+class AnalyticalFlowComparator(FlowComparator):
+    """FlowComparator that decides subset and intersection relations from the
+    parsed match fields instead of simulating them on a switch.
+    If cross_check is given (a switch-backed FlowComparator), every answer is
+    also computed on the switch and disagreements are recorded in mismatches.
+    """
+    def __init__(self,cross_check=None):
+        """Create object
+        :type cross_check: FlowComparator
+        """
+        FlowComparator.__init__(self,None)
+        self.cross_check = cross_check
+        self.mismatches = []
+        # batches are related with NumPy if it is installed
+        self.engine = TernaryMatchEngine() if numpy is not None else None
+
+    def _installed_match(self,f):
+        """Match of a flow as installed in a switch, flows without a table go to table 0.
+        :type f: FlowDescription
+        :rtype: FlowMatch
+        """
+        match = FlowMatch(f,with_table=True)
+        if 'table' not in match.fields:
+            match.add_field('table','0')
+        return match
+
+    def select(self,s,table):
+        """Match a flow s to the single closest flow entry in a flow table.
+        :type s: FlowDescription
+        :type table: list[FlowDescription]
+        :rtype: FlowDescription
+        """
+        packet = FlowMatch(s)
+        selected = None
+        selected_priority = None
+        for t in table:
+            match = FlowMatch(t)
+            priority = t.get_priority()
+            if priority is None:
+                priority = SimulatedSwitch.DEFAULT_PRIORITY
+            for u in table:
+                if u is not t and u.get_priority() == t.get_priority():
+                    assert not (match.intersects(FlowMatch(u)) and match != FlowMatch(u)) # overlapping entries
+            if match.matches_packet(packet) and (selected is None or priority > selected_priority):
+                selected = t
+                selected_priority = priority
+        if selected is None:
+            selected_flow = FlowDescription(SimulatedSwitch.MISS_RULE)
+            selected_flow.set_actions(SimulatedSwitch.MISS_ACTIONS)
+            return selected_flow
+        selected_flow = selected.copy()
+        selected_flow.remove_statistics()
+        selected_flow.remove_check_overlap()
+        return selected_flow
+
+    def is_intersection_nonempty(self,s,t,use_priorities=False):
+        """Do s and t intersect?
+        :type s: FlowDescription
+        :type t: FlowDescription
+        :type use_priorities: bool
+        :rtype: bool
+        """
+        result = self._installed_match(s).intersects(self._installed_match(t))
+        if use_priorities:
+            result = result and s.get_priority() == t.get_priority()
+        if self.cross_check is not None:
+            expected = self.cross_check.is_intersection_nonempty(s.copy(),t.copy(),use_priorities)
+            self._record('is_intersection_nonempty',s,t,result,expected)
+        return result
+
+    def is_subset(self,s,t):
+        """Do all packets matching s also match t (t is more general)?
+        Like OVS's non-strict delete, a missing table in t matches all tables.
+        :type s: FlowDescription
+        :type t: FlowDescription
+        :rtype: bool
+        """
+        result = self._installed_match(s).is_subset(FlowMatch(t,with_table=True))
+        if self.cross_check is not None:
+            expected = self.cross_check.is_subset(s.copy(),t.copy())
+            self._record('is_subset',s,t,result,expected)
+        return result
+
+    # smallest batch worth the NumPy overhead
+    ENGINE_MIN_PAIRS = 32
+
+    def is_subset_many(self,pairs):
+        if self.engine is not None and self.cross_check is None and len(pairs) >= self.ENGINE_MIN_PAIRS:
+            return self.engine.is_subset_many(pairs)
+        return [self.is_subset(s,t) for s,t in pairs]
+
+    def is_intersection_nonempty_many(self,pairs):
+        if self.engine is not None and self.cross_check is None and len(pairs) >= self.ENGINE_MIN_PAIRS:
+            return self.engine.is_intersection_nonempty_many(pairs)
+        return [self.is_intersection_nonempty(s,t) for s,t in pairs]
+
+    def _record(self,name,s,t,result,expected):
+        if result != expected:
+            print 'Warning: {0}({1}, {2}) is {3}, but {4} on the switch!'.format(name,s,t,result,expected)
+            self.mismatches.append((name,s.copy(),t.copy(),result,expected))
+
+class MemoizingFlowComparator(FlowComparator):
+    """FlowComparator that remembers the answers of another one.
+    The checker compares the same pairs of flows again and again (e.g. for every initial command
+    list), and every comparison on a switch costs several round-trips. Answers are looked up by
+    a canonical form of both flows (see key()). The flows passed in are never modified, the
+    wrapped comparator gets copies.
+    """
+    # fields no answer depends on
+    IRRELEVANT = ('actions', 'duration', 'n_packets', 'n_bytes', 'idle_age', 'hard_age')
+
+    def __init__(self,comparator,maxsize=100000,shared=None):
+        """Create object
+        :type comparator: FlowComparator
+        :param maxsize: number of answers kept, the least recently used ones are dropped
+        :param shared: dict shared with other processes (multiprocessing.Manager().dict()); answers
+                       not known here are looked up in it, and new answers are added to it
+        """
+        FlowComparator.__init__(self,comparator.switch)
+        self.comparator = comparator
+        self.cache = LRUCache(maxsize)
+        self.shared = shared
+        self.shared_hits = 0
+
+    def key(self,f,with_priority):
+        """Canonical form of a flow: its normalized match (FlowMatch), with the table only if
+        given, and the other fields an answer may depend on. The priority is left out if the
+        comparison does not use it.
+        :type f: FlowDescription
+        :rtype: tuple
+        """
+        other = [(k,v) for k,v in f.fields.iteritems()
+                 if k in FlowMatch.IGNORED and k not in self.IRRELEVANT and (with_priority or k != 'priority')]
+        return (FlowMatch(f,with_table=True).key(), tuple(sorted(other)))
+
+    def _lookup(self,key,compute):
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        if self.shared is not None:
+            result = self.shared.get(key)
+            if result is not None:
+                self.shared_hits += 1
+                self.cache.put(key,result)
+                return result
+        result = compute()
+        if result is not None:
+            self.cache.put(key,result)
+            if self.shared is not None:
+                self.shared[key] = result
+        return result
+
+    def select(self,s,table):
+        return self.comparator.select(s,table)
+
+    def _lookup_many(self,keys,pairs,compute_many):
+        """Answers for pairs with the given keys, the unknown ones computed with one compute_many call
+        :rtype: list[bool]
+        """
+        results = [self._lookup(key,lambda: None) for key in keys]
+        unknown = [i for i,result in enumerate(results) if result is None]
+        if unknown:
+            computed = compute_many([(pairs[i][0].copy(),pairs[i][1].copy()) for i in unknown])
+            for i,result in zip(unknown,computed):
+                results[i] = result
+                self.cache.put(keys[i],result)
+                if self.shared is not None:
+                    self.shared[keys[i]] = result
+        return results
+
+    def is_subset_many(self,pairs):
+        keys = [('is_subset', self.key(s,False), self.key(t,False)) for s,t in pairs]
+        return self._lookup_many(keys,pairs,self.comparator.is_subset_many)
+
+    def is_intersection_nonempty_many(self,pairs):
+        keys = [('is_intersection_nonempty', False, self.key(s,False), self.key(t,False)) for s,t in pairs]
+        return self._lookup_many(keys,pairs,self.comparator.is_intersection_nonempty_many)
+
+    def is_intersection_nonempty(self,s,t,use_priorities=False):
+        """Do s and t intersect?
+        :type s: FlowDescription
+        :type t: FlowDescription
+        :type use_priorities: bool
+        :rtype: bool
+        """
+        key = ('is_intersection_nonempty', use_priorities, self.key(s,use_priorities), self.key(t,use_priorities))
+        return self._lookup(key,lambda: self.comparator.is_intersection_nonempty(s.copy(),t.copy(),use_priorities))
+
+    def is_subset(self,s,t):
+        """Do all packets matching s also match t (t is more general)?
+        :type s: FlowDescription
+        :type t: FlowDescription
+        :rtype: bool
+        """
+        key = ('is_subset', self.key(s,False), self.key(t,False))
+        return self._lookup(key,lambda: self.comparator.is_subset(s.copy(),t.copy()))
+
+    def take(self):
+        """The counters of summary() so far, and start counting over (the answers are kept)
+        :rtype: dict
+        """
+        counters = {'hits' : self.cache.hits, 'misses' : self.cache.misses, 'shared_hits' : self.shared_hits}
+        self.cache.hits = 0
+        self.cache.misses = 0
+        self.shared_hits = 0
+        return counters
+
+    def merge(self,counters):
+        """Add the counters taken from the comparator of another process
+        :type counters: dict
+        """
+        self.cache.hits += counters['hits']
+        self.cache.misses += counters['misses']
+        self.shared_hits += counters['shared_hits']
+
+    def summary(self):
+        computed = self.cache.misses - self.shared_hits
+        return 'Comparator cache: {0} answers, {1} remembered ({2} from other processes), {3} computed ({4:.1f}% remembered).'.format(
+            self.cache.hits + self.cache.misses, self.cache.hits + self.shared_hits, self.shared_hits, computed,
+            100.0 * (self.cache.hits + self.shared_hits) / max(1, self.cache.hits + self.cache.misses))
+
 class SdnRacerCommutativityChecker(object):
   """
   Commutativity checking class from SDNRacer (hb_commute_check), adapted for 
@@ -975,10 +2023,45 @@ class CommandResult(object):
         self.affected_flows = None
         # was an OFPFMFC_OVERLAP error returned?
         self.overlap_error = None
+        # (type, code) of any other OFPT_ERROR returned for a flow mod, see OpenFlowSwitch.sync()
+        self.of_error = None
         self.retval = None
         # special maps for OF_MOD
         self.before_to_after = None
         self.after_to_before = None
+        # wall time of the command in seconds, set by OvsSwitch.executeCommand
+        self.seconds = None
+
+    # fields saved by to_json(), all but the flow sets
+    JSON_FIELDS = ('traced_rule', 'traced_actions', 'xid', 'overlap_error')
+    JSON_FLOW_SETS = ('before_set', 'after_set', 'added_flows', 'removed_flows', 'overwritten_flows', 'affected_flows')
+
+    def to_json(self):
+        """The result without the command and the return value, JSON serializable, see from_json()
+        :rtype: dict
+        """
+        data = dict([(field, getattr(self,field)) for field in self.JSON_FIELDS])
+        for field in self.JSON_FLOW_SETS:
+            flows = getattr(self,field)
+            data[field] = None if flows is None else [str(f) for f in flows]
+        data['dumped_flows'] = None if self.dumped_flows is None else [str(f) for f in self.dumped_flows]
+        return data
+
+    @staticmethod
+    def from_json(cmd,data):
+        """Result of cmd saved by to_json()
+        :type cmd: Command
+        :rtype: CommandResult
+        """
+        result = CommandResult(cmd)
+        for field in CommandResult.JSON_FIELDS:
+            setattr(result,field,data[field])
+        for field in CommandResult.JSON_FLOW_SETS:
+            if data[field] is not None:
+                setattr(result,field,set([FlowDescription(f) for f in data[field]]))
+        if data['dumped_flows'] is not None:
+            result.dumped_flows = [FlowDescription(f) for f in data['dumped_flows']]
+        return result
         
     def update_return_value(self,comparator):
         self.retval = self._calc_return_value(comparator)
@@ -1028,9 +2111,36 @@ class CommandResult(object):
         return None
 
 class OvsSwitch(object):
-    def __init__(self,switchdesc):
+    def __init__(self,switchdesc,batch=False,monitor=False,unixctl=False,ovsdb=False):
+        """Create object
+        :type switchdesc: SwitchDesc
+        :type batch: bool
+        :param monitor: once the bridge is created, follow its flow tables with a FlowMonitor
+                        and take the flows affected by a command from it instead of from dumps
+        :param unixctl: trace over a UnixctlClient connection to ovs-vswitchd instead of ovs-appctl
+        :param ovsdb: create the bridge with an OvsdbClient transaction instead of ovs-vsctl, and
+                      reset it by clearing its flows if its ports are already the right ones
+        """
         self.switchdesc = switchdesc
-        pass
+        # send consecutive flow mods in executeCommands() to the switch in one go
+        self.batch = batch
+        self.use_monitor = monitor
+        self.monitor = None
+        ': :type monitor: FlowMonitor'
+        self.use_unixctl = unixctl
+        self.unixctl = None # connected on the first trace
+        ': :type unixctl: UnixctlClient'
+        self.use_ovsdb = ovsdb
+        self.ovsdb = None # connected on first use
+        ': :type ovsdb: OvsdbClient'
+        # (added flows, removed flows) of each state-changing command, see start_undo_log()
+        self.undo_log = None
+
+    # commands recorded in the undo log
+    UNDOABLE = (Cmd.CLEAR, Cmd.OF_ADD, Cmd.OF_DEL, Cmd.OF_MOD)
+
+    # number of flow tables commands can use, 0..TABLES-1 (OVS reserves the last ones)
+    TABLES = 254
 
     def executeCommand(self,cmd,return_affected=False):
         """Execute a command.
@@ -1038,6 +2148,44 @@ class OvsSwitch(object):
         :type return_affected: bool
         :rtype: CommandResult
         """
+        start = time.time()
+        result = self._execute_command(cmd,return_affected)
+        self._set_seconds([result],time.time() - start)
+        return result
+
+    def _set_seconds(self,results,seconds):
+        """Store the time of executed commands in their results, and record it if timing is
+        enabled. Commands executed together share the time equally.
+        :type results: list[CommandResult]
+        """
+        timings = Timings.get()
+        for result in results:
+            result.seconds = seconds / len(results)
+            if timings is not None:
+                timings.add('command ' + Cmd.keys()[result.type],result.seconds)
+                timings.add('switch ' + self.switchdesc.name,result.seconds)
+
+    def _execute_command(self,cmd,return_affected):
+        if self.undo_log is not None and cmd.type in self.UNDOABLE:
+            # the affected flows are needed to undo the command
+            undo_log = self.undo_log
+            self.undo_log = None
+            try:
+                result = self._execute_command(cmd,True)
+            finally:
+                self.undo_log = undo_log
+            undo_log.append(self._undo_record(result))
+            return result
+        if return_affected and self.monitor is not None and cmd.type in self.UNDOABLE:
+            # the flow monitor reports the changes, no dumps needed. before_set/after_set stay unset.
+            if self.monitor.stale:
+                self.sync()
+                self.monitor.sync() # discard the changes of earlier commands
+            result = self._execute(cmd)
+            self.sync()
+            result.added_flows,result.removed_flows = self.monitor.sync()
+            result.affected_flows = result.added_flows.union(result.removed_flows)
+            return result
         if return_affected and (cmd not in (Cmd.TRACE, Cmd.DUMP, Cmd.OF_BAR)):
             # we will not get information about the affected rules in the result
             before = self._execute(Command(Cmd.DUMP,dump_removeStatistics=True))
@@ -1075,27 +2223,180 @@ class OvsSwitch(object):
         else:
             return self._execute(cmd)
 
-    def _execute(self,cmd):
-        funcs = {Cmd.CREATE : self._create,
-                 Cmd.RESET : self._reset,
-                 Cmd.CLEAR : self._clear,
-                 Cmd.TRACE : self._trace,
-                 Cmd.DUMP : self._dump,
-                 Cmd.OF_ADD : self._of_add,
-                 Cmd.OF_DEL : self._of_del,
-                 Cmd.OF_MOD : self._of_mod,
-                 Cmd.OF_BAR : self._of_bar
-        }
-        return funcs[cmd.type](cmd)
+    def executeCommands(self,cmds,return_affected=False):
+        """Execute a list of commands in order.
+        With batching enabled, runs of consecutive flow mods are executed with a
+        single ovs-ofctl invocation. A flow mod with the check_overlap flag ends its
+        run. Batching is not used if return_affected is set, as the affected rules
+        have to be determined for every command separately.
+        :type cmds: list[Command]
+        :type return_affected: bool
+        :rtype: list[CommandResult]
+        """
+        if not self.batch or return_affected or self.undo_log is not None:
+            return [self.executeCommand(cmd,return_affected) for cmd in cmds]
+        results = []
+        pending = []
+        for cmd in cmds:
+            if cmd.type in (Cmd.OF_ADD, Cmd.OF_DEL, Cmd.OF_MOD):
+                pending.append(cmd)
+                if 'check_overlap' not in cmd.flowdesc.fields:
+                    continue
+            if pending:
+                results.extend(self._timed_batch(pending))
+                pending = []
+            if cmd.type not in (Cmd.OF_ADD, Cmd.OF_DEL, Cmd.OF_MOD):
+                results.append(self.executeCommand(cmd))
+        if pending:
+            results.extend(self._timed_batch(pending))
+        return results
 
-    def _create(self,cmd):
-        run_cmdline_string('ovs-vsctl add-br '+self.switchdesc.name)
-        for i in xrange(1,self.switchdesc.ports,1):
-            run_cmdline_string('ovs-vsctl add-port '+self.switchdesc.name+' '+self.switchdesc.name+'p'+str(i))
-            run_cmdline_string('ovs-ofctl mod-port '+self.switchdesc.name+' '+self.switchdesc.name+'p'+str(i)+' up')
+    def _timed_batch(self,cmds):
+        start = time.time()
+        results = self._execute_batch(cmds)
+        self._set_seconds(results,time.time() - start)
+        return results
+
+    def sync(self):
+        """Wait until the switch has executed all commands sent so far. Nothing to do here,
+        ovs-ofctl only exits once its flow mods are executed.
+        """
+        pass
+
+    def trace_many(self,cmds,return_affected=False):
+        """Execute TRACE commands against the current state. With the unixctl client, all trace
+        requests are sent before the first reply is read, so that they take a single round-trip.
+        With return_affected, the results have empty added/removed/affected flow sets, as a trace
+        changes no flows (before_set/after_set stay unset, no dumps are taken).
+        :type cmds: list[Command]
+        :rtype: list[CommandResult]
+        """
+        if not self.use_unixctl:
+            results = [self.executeCommand(cmd) for cmd in cmds]
+        else:
+            start = time.time()
+            replies = self._unixctl_client().transact_many(
+                [('ofproto/trace', [self.switchdesc.name, self._trace_packet(cmd)]) for cmd in cmds])
+            results = [self._trace_result(cmd,reply.splitlines()) for cmd,reply in zip(cmds,replies)]
+            self._set_seconds(results,time.time() - start)
+        if return_affected:
+            for result in results:
+                result.added_flows,result.removed_flows,result.affected_flows = set(),set(),set()
+        return results
+
+    def start_undo_log(self):
+        """Record the flows added and removed by every following CLEAR, OF_ADD, OF_DEL and
+        OF_MOD command, so that they can be undone with rollback(). Starts with an empty log.
+        """
+        self.undo_log = []
+
+    def stop_undo_log(self):
+        self.undo_log = None
+
+    def _undo_record(self,result):
+        """Entry of the undo log for an executed command, as used by rollback()
+        :type result: CommandResult
+        """
+        return (result.added_flows, result.removed_flows)
+
+    def rollback(self,k):
+        """Undo the last k commands in the undo log, by strictly deleting the flows they added
+        and adding back the flows they removed. Costs time proportional to the changes.
+        :type k: int
+        """
+        assert self.undo_log is not None and 0 <= k <= len(self.undo_log)
+        inverse = []
+        for _ in xrange(k):
+            added_flows,removed_flows = self.undo_log.pop()
+            for f in added_flows:
+                inverse.append(Command(Cmd.OF_DEL,f.get_match_priority(),strict=True))
+            for f in removed_flows:
+                inverse.append(Command(Cmd.OF_ADD,f.copy()))
+        undo_log = self.undo_log
+        self.undo_log = None
+        try:
+            self.executeCommands(inverse)
+        finally:
+            self.undo_log = undo_log
+
+    def snapshot(self):
+        """Capture the flow tables, to be restored later with restore().
+        The snapshot is a tuple of flow strings without statistics.
+        """
+        dump = self.executeCommand(Command(Cmd.DUMP,dump_removeStatistics=True))
+        return tuple([str(f) for f in dump.dumped_flows])
+
+    def restore(self,snapshot):
+        """Restore the flow tables captured by snapshot().
+        ovs-ofctl replace-flows only sends the flow mods for the differences.
+        """
+        flows = ''.join([f + '\n' for f in snapshot])
+        run_cmdline_string('ovs-ofctl replace-flows '+self.switchdesc.name+' -',piped_input=flows)
+        if self.monitor is not None:
+            self.monitor.stale = True
+
+    def start_monitor(self):
+        """Start following the flow tables of the (existing) bridge with a FlowMonitor.
+        """
+        self.stop_monitor()
+        self.monitor = FlowMonitor(self.switchdesc)
+
+    def stop_monitor(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+            self.monitor = None
+
+    def _execute_batch(self,cmds):
+        if len(cmds) == 1:
+            return [self._execute(cmds[0])]
+        if self.monitor is not None:
+            self.monitor.stale = True
+        return self._of_batch(cmds)
+
+    def _execute(self,cmd):
+        if self.monitor is not None and cmd.type in self.UNDOABLE:
+            self.monitor.stale = True
+        funcs = {Cmd.CREATE : self._create,
+                 Cmd.RESET : self._reset,
+                 Cmd.CLEAR : self._clear,
+                 Cmd.TRACE : self._trace,
+                 Cmd.DUMP : self._dump,
+                 Cmd.OF_ADD : self._of_add,
+                 Cmd.OF_DEL : self._of_del,
+                 Cmd.OF_MOD : self._of_mod,
+                 Cmd.OF_BAR : self._of_bar
+        }
+        return funcs[cmd.type](cmd)
+
+    def _create(self,cmd):
+        if self.use_ovsdb:
+            if self._ovsdb_client().bridge(self.switchdesc.name) is not None:
+                raise Exception('Bridge '+self.switchdesc.name+' already exists')
+            self._ovsdb_client().create_bridge(self.switchdesc.name,self._port_names()[1:])
+        else:
+            run_cmdline_string('ovs-vsctl add-br '+self.switchdesc.name)
+            for i in xrange(1,self.switchdesc.ports,1):
+                run_cmdline_string('ovs-vsctl add-port '+self.switchdesc.name+' '+self.switchdesc.name+'p'+str(i))
+        self._ports_up()
+        if self.use_monitor:
+            self.start_monitor()
         return CommandResult(cmd)
 
     def _reset(self,cmd):
+        if self.use_ovsdb:
+            bridge = self._ovsdb_client().bridge(self.switchdesc.name)
+            if bridge is not None and bridge[1] == set(self._port_names()):
+                # same topology, only the flows need to go
+                return self._clear(cmd)
+            self.stop_monitor()
+            # replace it, in the same transaction
+            self._ovsdb_client().create_bridge(self.switchdesc.name,self._port_names()[1:],
+                                               replace=None if bridge is None else bridge[0])
+            self._ports_up()
+            if self.use_monitor:
+                self.start_monitor()
+            return CommandResult(cmd)
+        self.stop_monitor() # its connection goes away with the bridge
         try:
             run_cmdline_string('ovs-vsctl del-br '+self.switchdesc.name, noerr=False)
         except subprocess.CalledProcessError:
@@ -1103,6 +2404,38 @@ class OvsSwitch(object):
         self._create(cmd)
         return CommandResult(cmd)
 
+    def _ports_up(self):
+        for i in xrange(1,self.switchdesc.ports,1):
+            run_cmdline_string('ovs-ofctl mod-port '+self.switchdesc.name+' '+self.switchdesc.name+'p'+str(i)+' up')
+
+    def version(self):
+        """Version of the switch implementation, the simulation results are cached per version
+        :rtype: str
+        """
+        return run_cmdline_string('ovs-vswitchd --version')[0]
+
+    def has_topology(self):
+        """Does the bridge exist, with the expected ports?
+        :rtype: bool
+        """
+        if self.use_ovsdb:
+            bridge = self._ovsdb_client().bridge(self.switchdesc.name)
+            return bridge is not None and bridge[1] == set(self._port_names())
+        # fails with a message instead of the ports if there is no such bridge
+        lines = run_cmdline_string('ovs-vsctl list-ports '+self.switchdesc.name,noerr=True)
+        return set(lines) == set(self._port_names()[1:])
+
+    def _port_names(self):
+        """The bridge's own port first, then the others
+        :rtype: list[str]
+        """
+        return [self.switchdesc.name] + [self.switchdesc.name+'p'+str(i) for i in xrange(1,self.switchdesc.ports,1)]
+
+    def _ovsdb_client(self):
+        if self.ovsdb is None:
+            self.ovsdb = OvsdbClient(OvsdbClient.default_path())
+        return self.ovsdb
+
     def _clear(self,cmd):
         run_cmdline_string('ovs-ofctl del-flows '+self.switchdesc.name)
         lines = run_cmdline_string('ovs-ofctl dump-flows '+self.switchdesc.name)
@@ -1110,12 +2443,28 @@ class OvsSwitch(object):
         return CommandResult(cmd)
 
     def _trace(self,cmd):
+        if self.use_unixctl:
+            reply = self._unixctl_client().transact('ofproto/trace',[self.switchdesc.name,self._trace_packet(cmd)])
+            return self._trace_result(cmd,reply.splitlines())
+        lines = run_cmdline_string('ovs-appctl ofproto/trace '+self.switchdesc.name+' "'+self._trace_packet(cmd)+'"')
+        return self._trace_result(cmd,lines)
+
+    def _trace_packet(self,cmd):
+        """The packet of a TRACE command, as ofproto/trace expects it
+        :rtype: str
+        """
         f = FlowDescription(str(cmd.flowdesc))
         f.remove_table()
         f.remove_actions()
         f.remove_priority()
         f.remove_statistics()
-        lines = run_cmdline_string('ovs-appctl ofproto/trace '+self.switchdesc.name+' "'+str(f)+'"')
+        return str(f)
+
+    def _trace_result(self,cmd,lines):
+        """Parse the output of ofproto/trace
+        :type lines: list[str]
+        :rtype: CommandResult
+        """
         result = CommandResult(cmd)
         rule = None
         actions = None
@@ -1128,6 +2477,11 @@ class OvsSwitch(object):
         result.traced_actions = actions
         return result
 
+    def _unixctl_client(self):
+        if self.unixctl is None:
+            self.unixctl = UnixctlClient(UnixctlClient.target_path('ovs-vswitchd'))
+        return self.unixctl
+
     def _dump(self,cmd):
         lines = run_cmdline_string('ovs-ofctl dump-flows '+self.switchdesc.name)
         result = CommandResult(cmd)
@@ -1136,10 +2490,7 @@ class OvsSwitch(object):
 
         iterlines = iter(lines)
         headerline = next(iterlines)
-        LBRACE,RBRACE,EQUAL = map(pp.Suppress,'()=')
-        hexint = pp.Combine( "0x" + pp.Word(pp.hexnums))
-        header = ('NXST_FLOW reply ' + LBRACE + 'xid' + EQUAL + hexint("xid"))
-        parsed_header = header.parseString(headerline)
+        parsed_header = DUMP_HEADER_PARSER.parseString(headerline)
 
         result.xid = parsed_header.xid
         # We skipped the first element already
@@ -1152,7 +2503,7 @@ class OvsSwitch(object):
 
     def _of_add(self,cmd):
         # TODO: Handle OFPFMFC_ALL_TABLES_FULL case
-        lines = run_cmdline_string('ovs-ofctl add-flow '+self.switchdesc.name+' "'+str(cmd.flowdesc)+'"',noerr=True)
+        lines = run_cmdline_string('ovs-ofctl add-flow '+self.switchdesc.name+' "'+self._flowmod_string(cmd)+'"',noerr=True)
         result = CommandResult(cmd)
         if len(lines) > 0:
             l = lines[0].strip()
@@ -1163,30 +2514,17 @@ class OvsSwitch(object):
         return result
 
     def _of_del(self,cmd):
-        f = FlowDescription(str(cmd.flowdesc))
-        f.actions = None
-        had_check_overlap_field = False
-        if 'check_overlap' in f.fields:
-          had_check_overlap_field = True
-          # remove for ovs-ofctl
-          f.remove_check_overlap()
         if cmd.strict:
-            run_cmdline_string('ovs-ofctl --strict del-flows '+self.switchdesc.name+' "'+str(cmd.flowdesc)+'"')
+            run_cmdline_string('ovs-ofctl --strict del-flows '+self.switchdesc.name+' "'+self._flowmod_string(cmd)+'"')
         else:
-            f.remove_priority()
-            run_cmdline_string('ovs-ofctl del-flows '+self.switchdesc.name+' "'+str(f)+'"')
-        if had_check_overlap_field == True:
-          # restore
-          f.fields['check_overlap'] = None # no value, but it exists
+            run_cmdline_string('ovs-ofctl del-flows '+self.switchdesc.name+' "'+self._flowmod_string(cmd)+'"')
         return CommandResult(cmd)
 
     def _of_mod(self,cmd):
         if cmd.strict:
-            lines = run_cmdline_string('ovs-ofctl --strict mod-flows '+self.switchdesc.name+' "'+str(cmd.flowdesc)+'"',noerr=True)
+            lines = run_cmdline_string('ovs-ofctl --strict mod-flows '+self.switchdesc.name+' "'+self._flowmod_string(cmd)+'"',noerr=True)
         else:
-            f = FlowDescription(str(cmd.flowdesc))
-            f.remove_priority()
-            lines = run_cmdline_string('ovs-ofctl mod-flows '+self.switchdesc.name+' "'+str(f)+'"',noerr=True)
+            lines = run_cmdline_string('ovs-ofctl mod-flows '+self.switchdesc.name+' "'+self._flowmod_string(cmd)+'"',noerr=True)
         result = CommandResult(cmd)
         if len(lines) > 0:
             l = lines[0].strip()
@@ -1194,10 +2532,1122 @@ class OvsSwitch(object):
                 result.overlaps = True
         return result
 
+    def _flowmod_string(self,cmd):
+        """Render the flow of an OF_ADD/OF_DEL/OF_MOD command the way ovs-ofctl expects it.
+        :type cmd: Command
+        :rtype: str
+        """
+        if cmd.type == Cmd.OF_DEL and not cmd.strict:
+            f = FlowDescription(str(cmd.flowdesc))
+            f.actions = None
+            f.remove_check_overlap() # not accepted by ovs-ofctl del-flows
+            f.remove_priority()
+            return str(f)
+        if cmd.type == Cmd.OF_MOD and not cmd.strict:
+            f = FlowDescription(str(cmd.flowdesc))
+            f.remove_priority()
+            return str(f)
+        return str(cmd.flowdesc)
+
+    def _of_batch(self,cmds):
+        """Execute consecutive flow mods with a single ovs-ofctl invocation.
+        The flows are piped to 'ovs-ofctl add-flows', each line prefixed with its
+        flow_mod command (add, delete, delete_strict, modify, modify_strict).
+        Only the last command in a batch may carry the check_overlap flag, so that
+        an OFPFMFC_OVERLAP error in the output can be attributed to it.
+        :type cmds: list[Command]
+        :rtype: list[CommandResult]
+        """
+        keywords = {(Cmd.OF_ADD, False) : 'add',
+                    (Cmd.OF_ADD, True) : 'add',
+                    (Cmd.OF_DEL, False) : 'delete',
+                    (Cmd.OF_DEL, True) : 'delete_strict',
+                    (Cmd.OF_MOD, False) : 'modify',
+                    (Cmd.OF_MOD, True) : 'modify_strict'
+        }
+        flows = '\n'.join([keywords[(c.type, bool(c.strict))] + ' ' + self._flowmod_string(c) for c in cmds]) + '\n'
+        cmdline = 'ovs-ofctl add-flows '+self.switchdesc.name+' -'
+        retval,lines = run_cmdline_string(cmdline,piped_input=flows,noerr=True,status=True)
+        results = [CommandResult(c) for c in cmds]
+        for l in lines:
+            l = l.strip()
+            if l.startswith('OFPT_ERROR') and l.endswith('OFPFMFC_OVERLAP') and cmds[-1].type == Cmd.OF_ADD:
+                results[-1].overlap_error = True
+            if l.find('must specify an action') != -1:
+                raise Exception(lines)
+        # ovs-ofctl also fails on the overlap of the last command, any other failure is an error
+        if retval != 0 and not results[-1].overlap_error:
+            print cmdline
+            print '\n'.join(lines)
+            raise subprocess.CalledProcessError(retval, shlex.split(cmdline), '\n'.join(lines))
+        return results
+
     def _of_bar(self,cmd):
         # already done automatically
         return CommandResult(cmd)
 
+class BridgePool(object):
+    """
+    Bridges br0..br<size-1> of a sandbox, provisioned once and leased to the users of a switch.
+    provision() only (re)creates bridges whose ports are not the expected ones, so that repeated
+    runs skip provisioning. A lease is an exclusive flock on <lock_dir>/<bridge>.lock, which
+    keeps concurrent processes from sharing a bridge; the kernel releases it when the process
+    exits. Leased bridges are free of flows.
+    """
+    def __init__(self,create_switch,size,lock_dir=None):
+        """Create object
+        :param create_switch: returns an OvsSwitch for a bridge name
+        :type size: int
+        :param lock_dir: directory for the lock files, None to only lease within this process
+        """
+        self.create_switch = create_switch
+        self.size = size
+        self.lock_dir = lock_dir
+        if lock_dir is not None and not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir)
+        # bridge name -> lock file (None without lock_dir) of the bridges leased here
+        self.leases = {}
+
+    def names(self):
+        return ['br' + str(n) for n in xrange(self.size)]
+
+    def provision(self):
+        """Make sure that every bridge exists with the expected ports and without flows.
+        Bridges leased by another process are skipped. Returns the number of bridges created.
+        :rtype: int
+        """
+        created = 0
+        for name in self.names():
+            if name in self.leases:
+                continue
+            locked,lock = self._try_lock(name)
+            if not locked:
+                continue
+            try:
+                switch = self.create_switch(name)
+                if switch.has_topology():
+                    self._clear(switch)
+                else:
+                    switch.executeCommand(Command(Cmd.RESET))
+                    created += 1
+            finally:
+                if lock is not None:
+                    lock.close()
+        return created
+
+    def lease(self):
+        """Lease a free bridge, without flows, until release() or the end of the process
+        :rtype: OvsSwitch
+        """
+        for name in self.names():
+            if name in self.leases:
+                continue
+            locked,lock = self._try_lock(name)
+            if locked:
+                self.leases[name] = lock
+                switch = self.create_switch(name)
+                self._clear(switch)
+                return switch
+        raise Exception('All {0} bridges of the pool are leased'.format(self.size))
+
+    def release(self,switch):
+        """
+        :type switch: OvsSwitch
+        """
+        lock = self.leases.pop(switch.switchdesc.name)
+        if lock is not None:
+            lock.close()
+
+    def _clear(self,switch):
+        if switch.executeCommand(Command(Cmd.DUMP)).dumped_flows:
+            switch.executeCommand(Command(Cmd.CLEAR))
+
+    def _try_lock(self,name):
+        """Returns whether the bridge could be locked, and the lock file
+        :rtype: (bool, file)
+        """
+        if self.lock_dir is None:
+            return (True, None)
+        lock = open(os.path.join(self.lock_dir,name+'.lock'),'a')
+        try:
+            fcntl.flock(lock.fileno(),fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            return (False, None)
+        return (True, lock)
+
+class FlowMonitor(object):
+    """
+    Change feed of the flow tables of a bridge. Runs 'ovs-ofctl monitor <bridge> watch:'
+    (an NXST_FLOW_MONITOR request) for as long as the monitor lives; a reader thread
+    queues its output and sync() applies the reported flow updates to a mirror of the
+    flow tables.
+    Updates arrive asynchronously. To know that it has seen the updates of all flow mods
+    executed so far, sync() adds and deletes a sentinel flow in SENTINEL_TABLE and waits
+    for the sentinel's deletion, since the switch reports updates in execution order.
+    """
+    SENTINEL_TABLE = 253
+    # seconds to wait for the next update
+    TIMEOUT = 10.0
+    UPDATE_RE = re.compile(r'^\s*event=(\w+)(?: reason=\S+)? (.*)$')
+
+    def __init__(self,switchdesc):
+        """Start monitoring, returns once the initial flows are known
+        :type switchdesc: SwitchDesc
+        """
+        self.switchdesc = switchdesc
+        # str(flow.get_match_priority()) -> flow without statistics
+        self.flows = {}
+        # flows may have changed since the last sync()
+        self.stale = False
+        self._sentinel = 0
+        self._lines = Queue.Queue()
+        self._process = subprocess.Popen(['ovs-ofctl','monitor',switchdesc.name,'watch:'], close_fds=True,
+                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+        self.sync() # the initial flows are reported first
+
+    def stop(self):
+        if self._process.poll() is None:
+            self._process.terminate()
+        self._process.wait()
+
+    def sync(self):
+        """Wait for the updates of all flow mods executed so far and apply them.
+        Returns the flows added and removed since the previous sync(), like the
+        differences of a dump before and a dump after them.
+        :rtype: (set[FlowDescription], set[FlowDescription])
+        """
+        self._sentinel += 1
+        sentinel = 'table={0}, priority=0, metadata={1:#x}'.format(self.SENTINEL_TABLE,self._sentinel)
+        run_cmdline_string('ovs-ofctl add-flows '+self.switchdesc.name+' -',
+                           piped_input='add '+sentinel+' actions=drop\ndelete_strict '+sentinel+'\n')
+        original = {} # state before this sync of every changed flow, None if it did not exist
+        while True:
+            try:
+                line = self._lines.get(timeout=self.TIMEOUT)
+            except Queue.Empty:
+                raise Exception('No flow monitor update for '+self.switchdesc.name+' within '+str(self.TIMEOUT)+'s')
+            if line is None:
+                raise Exception('ovs-ofctl monitor '+self.switchdesc.name+' exited')
+            m = self.UPDATE_RE.match(line)
+            if m is None:
+                continue # reply headers, NXT_FLOW_MONITOR_PAUSED/RESUMED
+            event = m.group(1)
+            flow = FlowDescription(m.group(2))
+            flow.remove_statistics()
+            if flow.fields.get('table') == str(self.SENTINEL_TABLE):
+                if event == 'DELETED' and flow.fields.get('metadata') == '{0:#x}'.format(self._sentinel):
+                    break
+                continue
+            key = str(flow.get_match_priority())
+            if key not in original:
+                original[key] = self.flows.get(key)
+            if event == 'DELETED':
+                self.flows.pop(key,None)
+            else: # INITIAL, ADDED, MODIFIED
+                self.flows[key] = flow
+        self.stale = False
+        added = set()
+        removed = set()
+        for key,before in original.iteritems():
+            after = self.flows.get(key)
+            if before != after:
+                if before is not None:
+                    removed.add(before)
+                if after is not None:
+                    added.add(after)
+        return (added,removed)
+
+    def _read(self):
+        for line in iter(self._process.stdout.readline,''):
+            self._lines.put(line)
+        self._lines.put(None)
+
+class JsonRpcStream(object):
+    """
+    JSON-RPC messages over a stream socket, framed the way OVS frames them: one JSON
+    object after the other, without delimiters.
+    """
+    def __init__(self,sock):
+        """
+        :type sock: socket.socket
+        """
+        self.sock = sock
+        self._buffer = ''
+        self._decoder = json.JSONDecoder()
+
+    def send(self,msg):
+        """
+        :type msg: dict
+        """
+        self.sock.sendall(json.dumps(msg))
+
+    def recv(self):
+        """Next message, None once the peer has closed the connection
+        :rtype: dict
+        """
+        while True:
+            data = self._buffer.lstrip()
+            if data:
+                try:
+                    msg,end = self._decoder.raw_decode(data)
+                    self._buffer = data[end:]
+                    return msg
+                except ValueError:
+                    pass # incomplete
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                if data:
+                    raise Exception('Incomplete JSON-RPC message: '+data)
+                return None
+            self._buffer = data + chunk
+
+    def close(self):
+        self.sock.close()
+
+class UnixctlClient(object):
+    """
+    Client for the unixctl socket of an OVS daemon (what ovs-appctl talks to), keeping
+    one connection open for all requests.
+    """
+    # maximum number of requests in flight
+    WINDOW = 32
+
+    def __init__(self,path):
+        """Connect to the socket at path
+        :type path: str
+        """
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        sock.connect(path)
+        self.stream = JsonRpcStream(sock)
+        self._next_id = 0
+
+    @staticmethod
+    def target_path(target):
+        """Socket of a running daemon, e.g. 'ovs-vswitchd', found like ovs-appctl finds it:
+        <rundir>/<target>.<pid>.ctl, with the pid from <rundir>/<target>.pid
+        :rtype: str
+        """
+        with open(os.path.join(ovs_rundir(),target+'.pid')) as f:
+            pid = int(f.read().strip())
+        return os.path.join(ovs_rundir(),'{0}.{1}.ctl'.format(target,pid))
+
+    def transact(self,method,params):
+        """Run a command, returns its output
+        :type params: list[str]
+        :rtype: str
+        """
+        return self.transact_many([(method,params)])[0]
+
+    def transact_many(self,requests):
+        """Run several commands, pipelined: up to WINDOW requests are sent before waiting
+        for a reply. (Unbounded, both sides could block on full socket buffers.)
+        :type requests: list[(str, list[str])]
+        :rtype: list[str]
+        """
+        ids = []
+        replies = {}
+        for method,params in requests:
+            if len(ids) - len(replies) >= self.WINDOW:
+                self._receive(replies)
+            self._next_id += 1
+            ids.append(self._next_id)
+            self.stream.send({'method' : method, 'params' : params, 'id' : self._next_id})
+        while len(replies) < len(ids):
+            self._receive(replies)
+        results = []
+        for i,(method,params) in zip(ids,requests):
+            if replies[i].get('error') is not None:
+                raise Exception(' '.join([method]+params)+': '+str(replies[i]['error']).strip())
+            result = replies[i]['result']
+            if isinstance(result,unicode):
+                result = result.encode('utf-8')
+            results.append(result)
+        return results
+
+    def _receive(self,replies):
+        msg = self.stream.recv()
+        if msg is None:
+            raise Exception('unixctl connection closed')
+        replies[msg.get('id')] = msg
+
+    def close(self):
+        self.stream.close()
+
+class OvsdbClient(object):
+    """
+    Client for the Open_vSwitch database of ovsdb-server (what ovs-vsctl talks to), over
+    one JSON-RPC connection. Knows just enough of the schema to create and delete bridges.
+    """
+    DATABASE = 'Open_vSwitch'
+    # seconds to wait for ovs-vswitchd to apply a configuration change
+    TIMEOUT = 10.0
+
+    def __init__(self,path):
+        """Connect to the socket at path
+        :type path: str
+        """
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        sock.connect(path)
+        self.stream = JsonRpcStream(sock)
+        self._next_id = 0
+
+    @staticmethod
+    def default_path():
+        return os.path.join(ovs_rundir(),'db.sock')
+
+    def transact(self,operations):
+        """Execute the operations in one transaction, returns their results
+        :type operations: list[dict]
+        :rtype: list[dict]
+        """
+        self._next_id += 1
+        self.stream.send({'method' : 'transact', 'params' : [self.DATABASE] + operations, 'id' : self._next_id})
+        while True:
+            msg = self.stream.recv()
+            if msg is None:
+                raise Exception('OVSDB connection closed')
+            if msg.get('method') == 'echo':
+                self.stream.send({'result' : msg['params'], 'error' : None, 'id' : msg['id']})
+            elif msg.get('id') == self._next_id:
+                break
+        if msg.get('error') is not None:
+            raise Exception('OVSDB transaction failed: '+json.dumps(msg['error']))
+        # a failed operation has an error result, a failed commit an extra one at the end
+        for result in msg['result']:
+            if result is not None and 'error' in result:
+                raise Exception('OVSDB transaction failed: '+json.dumps(result))
+        return msg['result']
+
+    def bridge(self,name):
+        """UUID and port names of a bridge, None if there is no such bridge
+        :rtype: (str, set[str])
+        """
+        bridges,ports = self.transact([
+            {'op' : 'select', 'table' : 'Bridge', 'where' : [['name', '==', name]], 'columns' : ['_uuid', 'ports']},
+            {'op' : 'select', 'table' : 'Port', 'where' : [], 'columns' : ['_uuid', 'name']}])
+        if not bridges['rows']:
+            return None
+        row = bridges['rows'][0]
+        port_uuids = set([uuid for unused_type,uuid in _ovsdb_set(row['ports'])])
+        return (row['_uuid'][1], set([p['name'] for p in ports['rows'] if p['_uuid'][1] in port_uuids]))
+
+    def create_bridge(self,name,ports,replace=None):
+        """Create a bridge with its own internal port and the given ports, in one transaction.
+        Returns once ovs-vswitchd has applied it.
+        :type ports: list[str]
+        :param replace: UUID of a bridge to delete in the same transaction
+        """
+        operations = []
+        bridge_ports = []
+        mutations = [['bridges', 'insert', ['set', [['named-uuid', 'bridge']]]], ['next_cfg', '+=', 1]]
+        if replace is not None:
+            # its ports and interfaces are garbage collected
+            mutations.insert(0,['bridges', 'delete', ['set', [['uuid', replace]]]])
+            operations.append({'op' : 'delete', 'table' : 'Bridge', 'where' : [['_uuid', '==', ['uuid', replace]]]})
+        for n,port in enumerate([name] + ports):
+            interface = {'name' : port}
+            if n == 0:
+                interface['type'] = 'internal'
+            operations.append({'op' : 'insert', 'table' : 'Interface', 'row' : interface,
+                               'uuid-name' : 'interface{0}'.format(n)})
+            operations.append({'op' : 'insert', 'table' : 'Port', 'uuid-name' : 'port{0}'.format(n),
+                               'row' : {'name' : port, 'interfaces' : ['named-uuid', 'interface{0}'.format(n)]}})
+            bridge_ports.append(['named-uuid', 'port{0}'.format(n)])
+        operations.append({'op' : 'insert', 'table' : 'Bridge', 'uuid-name' : 'bridge',
+                           'row' : {'name' : name, 'ports' : ['set', bridge_ports]}})
+        operations.append({'op' : 'mutate', 'table' : 'Open_vSwitch', 'where' : [], 'mutations' : mutations})
+        operations.append({'op' : 'select', 'table' : 'Open_vSwitch', 'where' : [], 'columns' : ['next_cfg']})
+        results = self.transact(operations)
+        self.wait_applied(results[len(operations)-1]['rows'][0]['next_cfg'])
+
+    def wait_applied(self,next_cfg):
+        """Wait until ovs-vswitchd has applied configuration number next_cfg (like ovs-vsctl
+        does, it reports the number of the last applied one in cur_cfg).
+        :type next_cfg: int
+        """
+        deadline = time.time() + self.TIMEOUT
+        while True:
+            result = self.transact([{'op' : 'select', 'table' : 'Open_vSwitch', 'where' : [], 'columns' : ['cur_cfg']}])
+            if result[0]['rows'][0]['cur_cfg'] >= next_cfg:
+                return
+            if time.time() > deadline:
+                raise Exception('ovs-vswitchd did not apply the configuration within '+str(self.TIMEOUT)+'s')
+            time.sleep(0.01)
+
+    def close(self):
+        self.stream.close()
+
+def _ovsdb_set(value):
+    """Atoms of an OVSDB set, which is sent as a single atom if it has one element
+    :rtype: list
+    """
+    if isinstance(value,list) and len(value) == 2 and value[0] == 'set':
+        return value[1]
+    return [value]
+
+# OpenFlow 1.0 wire format (openflow.h)
+OFP_VERSION = 0x01
+OFPT_HELLO = 0
+OFPT_ERROR = 1
+OFPT_ECHO_REQUEST = 2
+OFPT_ECHO_REPLY = 3
+OFPT_FLOW_MOD = 14
+OFPT_STATS_REQUEST = 16
+OFPT_STATS_REPLY = 17
+OFPT_BARRIER_REQUEST = 18
+OFPT_BARRIER_REPLY = 19
+OFPFC_ADD = 0
+OFPFC_MODIFY = 1
+OFPFC_MODIFY_STRICT = 2
+OFPFC_DELETE = 3
+OFPFC_DELETE_STRICT = 4
+OFPFF_CHECK_OVERLAP = 1 << 1
+OFPST_FLOW = 1
+OFPSF_REPLY_MORE = 1
+OFPET_BAD_REQUEST = 1
+OFPBRC_BAD_TYPE = 1
+OFPET_FLOW_MOD_FAILED = 3
+OFPFMFC_OVERLAP = 1
+OFPFMFC_BAD_COMMAND = 4
+OFPAT_OUTPUT = 0
+OFPP_NONE = 0xffff
+OFP_NO_BUFFER = 0xffffffff
+OFP_DEFAULT_PRIORITY = 0x8000
+OFP_HEADER = struct.Struct('!BBHI')
+OFP_MATCH = struct.Struct('!IH6s6sHBxHBBxxIIHH')
+OFP_FLOW_MOD = struct.Struct('!QHHHHIHH') # after the match
+OFP_FLOW_STATS_REQUEST = struct.Struct('!HH40sBxH')
+OFP_STATS_REPLY = struct.Struct('!HH')
+OFP_FLOW_STATS = struct.Struct('!HBx40sIIHHH6xQQQ')
+OFP_ERROR = struct.Struct('!HH')
+OFP_ACTION_OUTPUT = struct.Struct('!HHHH')
+# FlowMatch field -> OFPFW_* wildcard bit
+OFPFW_FIELDS = OrderedDict([
+    ('in_port', 1 << 0),
+    ('dl_vlan', 1 << 1),
+    ('dl_src', 1 << 2),
+    ('dl_dst', 1 << 3),
+    ('dl_type', 1 << 4),
+    ('nw_proto', 1 << 5),
+    ('tp_src', 1 << 6),
+    ('tp_dst', 1 << 7),
+    ('dl_vlan_pcp', 1 << 20),
+    ('nw_tos', 1 << 21),
+])
+# FlowMatch field -> shift of its OFPFW_* wildcarded bit count
+OFPFW_PREFIX_FIELDS = OrderedDict([('nw_src', 8), ('nw_dst', 14)])
+OFPFW_ALL = (1 << 22) - 1
+# port name in actions -> OFPP_*
+OFPP_NAMES = OrderedDict([
+    ('IN_PORT', 0xfff8),
+    ('TABLE', 0xfff9),
+    ('NORMAL', 0xfffa),
+    ('FLOOD', 0xfffb),
+    ('ALL', 0xfffc),
+    ('CONTROLLER', 0xfffd),
+    ('LOCAL', 0xfffe),
+])
+
+class OpenFlowSwitch(OvsSwitch):
+    """
+    OvsSwitch that speaks OpenFlow 1.0 itself, over one persistent connection to the
+    management socket of the bridge (<rundir>/<bridge>.mgmt), instead of running ovs-ofctl
+    for every command. Flow mods are pipelined: they are sent without waiting, and only
+    synchronized with a barrier where needed: at OF_BAR, before anything that reads the
+    flow tables (DUMP, TRACE), and after a check_overlap flow mod, whose result is the
+    absence or presence of an error reply. Error replies are mapped back to their flow mod
+    by xid. Only table 0 is available. Traces and bridges still go through ovs-appctl (or
+    the unixctl client) and ovs-vsctl.
+    """
+    TABLES = 1
+
+    def __init__(self,switchdesc,batch=False,monitor=False,unixctl=False,ovsdb=False):
+        OvsSwitch.__init__(self,switchdesc,batch,monitor,unixctl,ovsdb)
+        self.connection = None # connected on first use
+        ': :type connection: OpenFlowConnection'
+        # xid -> CommandResult of the flow mods sent since the last barrier
+        self._unconfirmed = OrderedDict()
+
+    def sync(self):
+        """Wait until the switch has executed all flow mods sent so far (a barrier request).
+        Raises if any of them failed with an error other than OFPFMFC_OVERLAP.
+        """
+        if self.connection is None:
+            return
+        xid = self.connection.send(OFPT_BARRIER_REQUEST)
+        self._receive(xid,OFPT_BARRIER_REPLY)
+        errors = [r for r in self._unconfirmed.itervalues() if r.of_error is not None]
+        self._unconfirmed.clear()
+        if errors:
+            raise Exception(['OFPT_ERROR (type {0}, code {1}) for {2}'.format(r.of_error[0],r.of_error[1],r.cmd)
+                             for r in errors])
+
+    def trace_many(self,cmds,return_affected=False):
+        self.sync()
+        return OvsSwitch.trace_many(self,cmds,return_affected)
+
+    def restore(self,snapshot):
+        """Restore the flow tables captured by snapshot(), with one pipelined run of flow mods.
+        """
+        self._clear(Command(Cmd.CLEAR))
+        for f in snapshot:
+            self._execute(Command(Cmd.OF_ADD,FlowDescription(f)))
+        self.sync()
+        if self.monitor is not None:
+            self.monitor.stale = True
+
+    def _execute_batch(self,cmds):
+        # flow mods are pipelined anyway
+        return [self._execute(cmd) for cmd in cmds]
+
+    def _connect(self):
+        if self.connection is None:
+            sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            sock.connect(os.path.join(ovs_rundir(),self.switchdesc.name+'.mgmt'))
+            self.connection = OpenFlowConnection(sock)
+        return self.connection
+
+    def _disconnect(self):
+        if self.connection is not None:
+            self.sync()
+            self.connection.close()
+            self.connection = None
+
+    def _receive(self,xid,reply_type):
+        """Read messages up to the (last part of the) reply with the given xid, handling the
+        error replies for unconfirmed flow mods on the way.
+        Returns the bodies of the reply parts.
+        :rtype: list[str]
+        """
+        bodies = []
+        while True:
+            msg_type,msg_xid,body = self.connection.recv()
+            if msg_type == OFPT_ERROR and msg_xid in self._unconfirmed:
+                result = self._unconfirmed[msg_xid]
+                error_type,error_code = OFP_ERROR.unpack_from(body)
+                if error_type == OFPET_FLOW_MOD_FAILED and error_code == OFPFMFC_OVERLAP and result.type == Cmd.OF_ADD:
+                    result.overlap_error = True
+                else:
+                    result.of_error = (error_type,error_code)
+            elif msg_type == OFPT_ERROR and msg_xid == xid:
+                error_type,error_code = OFP_ERROR.unpack_from(body)
+                raise Exception('OFPT_ERROR (type {0}, code {1}) for request {2:#x}'.format(error_type,error_code,xid))
+            elif msg_xid == xid and msg_type == reply_type:
+                bodies.append(body)
+                if msg_type != OFPT_STATS_REPLY or not OFP_STATS_REPLY.unpack_from(body)[1] & OFPSF_REPLY_MORE:
+                    return bodies
+
+    def _create(self,cmd):
+        self._disconnect()
+        return OvsSwitch._create(self,cmd)
+
+    def _reset(self,cmd):
+        self._disconnect() # the bridge goes away
+        return OvsSwitch._reset(self,cmd)
+
+    def _clear(self,cmd):
+        self._send_flow_mod(cmd,OFPFC_DELETE,FlowMatch(),OFP_DEFAULT_PRIORITY,'',0)
+        self.sync()
+        return CommandResult(cmd)
+
+    def _trace(self,cmd):
+        self.sync()
+        return OvsSwitch._trace(self,cmd)
+
+    def _dump(self,cmd):
+        self.sync()
+        connection = self._connect()
+        xid = connection.send(OFPT_STATS_REQUEST,OFP_FLOW_STATS_REQUEST.pack(OFPST_FLOW,0,
+                              _of_encode_match(FlowMatch()),0xff,OFPP_NONE))
+        result = CommandResult(cmd)
+        result.xid = hex(xid)
+        result.dumped_flows = []
+        for body in self._receive(xid,OFPT_STATS_REPLY):
+            offset = OFP_STATS_REPLY.size
+            while offset < len(body):
+                (length,table_id,match,duration_sec,duration_nsec,priority,idle_timeout,hard_timeout,
+                 cookie,packet_count,byte_count) = OFP_FLOW_STATS.unpack_from(body,offset)
+                actions = _of_decode_actions(body[offset+OFP_FLOW_STATS.size:offset+length])
+                offset += length
+                timeouts = ''
+                if idle_timeout:
+                    timeouts += 'idle_timeout={0}, '.format(idle_timeout)
+                if hard_timeout:
+                    timeouts += 'hard_timeout={0}, '.format(hard_timeout)
+                flow = FlowDescription('cookie={0:#x}, duration={1:.3f}s, table={2}, n_packets={3}, n_bytes={4}, {5}{6} actions={7}'.format(
+                    cookie,duration_sec+duration_nsec/1e9,table_id,packet_count,byte_count,timeouts,
+                    _match_string(priority,_of_decode_match(match)),actions))
+                if cmd.dump_removeStatistics:
+                    flow.remove_statistics()
+                result.dumped_flows.append(flow)
+        return result
+
+    def _of_add(self,cmd):
+        if cmd.flowdesc.actions is None:
+            raise Exception(['ovs-ofctl: must specify an action'])
+        return self._of_flow_mod(cmd,OFPFC_ADD)
+
+    def _of_del(self,cmd):
+        return self._of_flow_mod(cmd,OFPFC_DELETE_STRICT if cmd.strict else OFPFC_DELETE)
+
+    def _of_mod(self,cmd):
+        return self._of_flow_mod(cmd,OFPFC_MODIFY_STRICT if cmd.strict else OFPFC_MODIFY)
+
+    def _of_bar(self,cmd):
+        self.sync()
+        return CommandResult(cmd)
+
+    def _of_flow_mod(self,cmd,command):
+        # the same flow ovs-ofctl would send
+        f = FlowDescription(self._flowmod_string(cmd))
+        if int(f.fields.get('table','0'),0) != 0:
+            raise Exception('OpenFlow 1.0 has a single table: '+str(cmd))
+        priority = f.get_priority()
+        if priority is None:
+            priority = OFP_DEFAULT_PRIORITY
+        out_port = _of_port(f.fields['out_port']) if f.fields.get('out_port') else OFPP_NONE
+        flags = OFPFF_CHECK_OVERLAP if 'check_overlap' in f.fields else 0
+        result = self._send_flow_mod(cmd,command,FlowMatch(f),priority,f.get_actions(),flags,out_port)
+        if flags & OFPFF_CHECK_OVERLAP:
+            # the result is the error reply, or its absence
+            self.sync()
+        return result
+
+    def _send_flow_mod(self,cmd,command,match,priority,actions,flags,out_port=OFPP_NONE):
+        """
+        :type match: FlowMatch
+        :rtype: CommandResult
+        """
+        connection = self._connect()
+        body = (_of_encode_match(match) +
+                OFP_FLOW_MOD.pack(0,command,0,0,priority,OFP_NO_BUFFER,out_port,flags) +
+                _of_encode_actions(actions))
+        result = CommandResult(cmd)
+        self._unconfirmed[connection.send(OFPT_FLOW_MOD,body)] = result
+        return result
+
+class OpenFlowConnection(object):
+    """
+    OpenFlow 1.0 message framing over a stream socket: sends HELLO on connect and
+    answers echo requests, numbers outgoing messages with consecutive xids.
+    """
+    def __init__(self,sock):
+        """
+        :type sock: socket.socket
+        """
+        self.sock = sock
+        self._buffer = ''
+        self._next_xid = 0
+        self.send(OFPT_HELLO)
+
+    def send(self,msg_type,body='',xid=None):
+        """Send a message, returns its xid
+        :rtype: int
+        """
+        if xid is None:
+            self._next_xid += 1
+            xid = self._next_xid
+        self.sock.sendall(OFP_HEADER.pack(OFP_VERSION,msg_type,OFP_HEADER.size+len(body),xid) + body)
+        return xid
+
+    def recv(self):
+        """Next message other than HELLO and echo requests, as (type, xid, body)
+        :rtype: (int, int, str)
+        """
+        while True:
+            msg = self.recv_any()
+            if msg is None:
+                raise Exception('OpenFlow connection closed')
+            msg_type,xid,body = msg
+            if msg_type == OFPT_ECHO_REQUEST:
+                self.send(OFPT_ECHO_REPLY,body,xid)
+            elif msg_type != OFPT_HELLO:
+                return msg
+
+    def recv_any(self):
+        """Next message as (type, xid, body), None once the peer has closed the connection
+        :rtype: (int, int, str)
+        """
+        while True:
+            if len(self._buffer) >= OFP_HEADER.size:
+                version,msg_type,length,xid = OFP_HEADER.unpack_from(self._buffer)
+                if len(self._buffer) >= length:
+                    body = self._buffer[OFP_HEADER.size:length]
+                    self._buffer = self._buffer[length:]
+                    return (msg_type,xid,body)
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return None
+            self._buffer += chunk
+
+    def close(self):
+        self.sock.close()
+
+def ovs_rundir():
+    """Directory with the sockets of the OVS daemons and bridges
+    :rtype: str
+    """
+    return os.environ.get('OVS_RUNDIR','/var/run/openvswitch')
+
+def _of_encode_match(match):
+    """ofp_match for a FlowMatch
+    :type match: FlowMatch
+    :rtype: str
+    """
+    if match.opaque:
+        raise Exception('Not expressible in OpenFlow 1.0: '+str(match))
+    wildcards = OFPFW_ALL
+    values = {}
+    for name,(v,m) in match.fields.iteritems():
+        width,fmt = FlowMatch.FIELDS[name]
+        full = (1 << width) - 1
+        if name in OFPFW_PREFIX_FIELDS:
+            prefix = bin(m).count('1')
+            if m != (full << (width - prefix)) & full:
+                raise Exception('Not expressible in OpenFlow 1.0: '+str(match))
+            shift = OFPFW_PREFIX_FIELDS[name]
+            wildcards = (wildcards & ~(0x3f << shift)) | ((width - prefix) << shift)
+        elif name in OFPFW_FIELDS and m == full:
+            wildcards &= ~OFPFW_FIELDS[name]
+        else:
+            raise Exception('Not expressible in OpenFlow 1.0: '+str(match))
+        values[name] = v
+    get = lambda name: values.get(name,0)
+    return OFP_MATCH.pack(wildcards,get('in_port'),struct.pack('!Q',get('dl_src'))[2:],
+                          struct.pack('!Q',get('dl_dst'))[2:],get('dl_vlan'),get('dl_vlan_pcp'),get('dl_type'),
+                          get('nw_tos'),get('nw_proto'),get('nw_src'),get('nw_dst'),get('tp_src'),get('tp_dst'))
+
+def _of_decode_match(data):
+    """FlowMatch for an ofp_match
+    :type data: str
+    :rtype: FlowMatch
+    """
+    (wildcards,in_port,dl_src,dl_dst,dl_vlan,dl_vlan_pcp,dl_type,nw_tos,nw_proto,nw_src,nw_dst,
+     tp_src,tp_dst) = OFP_MATCH.unpack(data)
+    values = {'in_port' : in_port, 'dl_src' : int(dl_src.encode('hex'),16), 'dl_dst' : int(dl_dst.encode('hex'),16),
+              'dl_vlan' : dl_vlan, 'dl_vlan_pcp' : dl_vlan_pcp, 'dl_type' : dl_type, 'nw_tos' : nw_tos,
+              'nw_proto' : nw_proto, 'nw_src' : nw_src, 'nw_dst' : nw_dst, 'tp_src' : tp_src, 'tp_dst' : tp_dst}
+    match = FlowMatch()
+    for name in FlowMatch.FIELDS:
+        if name in OFPFW_FIELDS and not wildcards & OFPFW_FIELDS[name]:
+            match.fields[name] = (values[name], (1 << FlowMatch.FIELDS[name][0]) - 1)
+        elif name in OFPFW_PREFIX_FIELDS:
+            wildcarded = (wildcards >> OFPFW_PREFIX_FIELDS[name]) & 0x3f
+            if wildcarded < 32:
+                m = (0xffffffff << wildcarded) & 0xffffffff
+                match.fields[name] = (values[name] & m, m)
+    return match
+
+def _of_port(port):
+    """Port number of a port in an action or out_port field, like '1' or 'NORMAL'
+    :rtype: int
+    """
+    if port.upper() in OFPP_NAMES:
+        return OFPP_NAMES[port.upper()]
+    return int(port,0)
+
+def _of_encode_actions(actions):
+    """ofp_action_output list for actions like 'output:1,NORMAL'. Only output actions are supported.
+    :type actions: str
+    :rtype: str
+    """
+    data = ''
+    for action in _split_actions(normalize_actions(actions)):
+        if action == 'drop':
+            continue
+        port = action[len('output:'):] if action.startswith('output:') else action
+        try:
+            data += OFP_ACTION_OUTPUT.pack(OFPAT_OUTPUT,OFP_ACTION_OUTPUT.size,_of_port(port),0xffff)
+        except ValueError:
+            raise Exception('Action not supported in OpenFlowSwitch: '+action)
+    return data
+
+def _of_decode_actions(data):
+    """Actions of an action list, formatted like normalize_actions() does
+    :type data: str
+    :rtype: str
+    """
+    names = dict([(v,k) for k,v in OFPP_NAMES.iteritems()])
+    actions = []
+    offset = 0
+    while offset < len(data):
+        action_type,length,port,max_len = OFP_ACTION_OUTPUT.unpack_from(data,offset)
+        if action_type != OFPAT_OUTPUT:
+            raise Exception('Unsupported OpenFlow action type '+str(action_type))
+        actions.append(names[port] if port in names else 'output:'+str(port))
+        offset += length
+    return ','.join(actions) if actions else 'drop'
+
+class SimulatedSwitch(OvsSwitch):
+    """In-process replacement for an OVS bridge.
+    Keeps the flow tables in memory and implements the commands with the same
+    semantics as OVS, so that no ovs-sandbox is needed. The CommandResult objects
+    look like the ones returned by OvsSwitch (traced rules and dumped flows are
+    formatted like the ovs-appctl/ovs-ofctl output).
+    """
+    # Hidden rule OVS reports when a traced packet does not match any flow
+    MISS_RULE = 'table=254 cookie=0 priority=0,reg0=0x2'
+    MISS_ACTIONS = 'drop'
+    # OFP_DEFAULT_PRIORITY, used if a flow has no priority field
+    DEFAULT_PRIORITY = 32768
+    # increase when the results of commands change, invalidates cached simulations (see SimulationCache)
+    VERSION = 2
+
+    def __init__(self,switchdesc,batch=False):
+        OvsSwitch.__init__(self,switchdesc,batch)
+        # table id -> list of SimulatedFlowEntry, highest priority first
+        self.tables = {}
+        # table id -> sort_key() of each entry in tables, kept in step so that inserts can bisect it
+        self.sort_keys = {}
+        # (table id, match, priority) -> SimulatedFlowEntry
+        self.index = {}
+        self.xid = 0
+        self.seq = 0
+        # while an undoable command is logged: (keys of the entries it inserted,
+        # key -> (seq, actions) of the entries it removed or modified), see rollback()
+        self.undo_changes = None
+
+    def _execute_batch(self,cmds):
+        # no process to save, execute one by one
+        return [self._execute(cmd) for cmd in cmds]
+
+    def _execute_command(self,cmd,return_affected):
+        if self.undo_log is None or cmd.type not in self.UNDOABLE:
+            return OvsSwitch._execute_command(self,cmd,return_affected)
+        self.undo_changes = (set(), {})
+        try:
+            return OvsSwitch._execute_command(self,cmd,return_affected)
+        finally:
+            self.undo_changes = None
+
+    def _undo_record(self,result):
+        return self.undo_changes
+
+    def rollback(self,k):
+        """Undo the last k commands in the undo log. Unlike OvsSwitch.rollback(), the entries come
+        back as they were, with their seq, so that they keep their order among equal priorities.
+        :type k: int
+        """
+        assert self.undo_log is not None and 0 <= k <= len(self.undo_log)
+        for _ in xrange(k):
+            inserted,removed = self.undo_log.pop()
+            for key in inserted:
+                if key in self.index:
+                    self._remove_entry(self.index[key])
+            for (table,match,priority),(seq,actions) in removed.iteritems():
+                self._insert_entry(SimulatedFlowEntry(table,priority,match,actions),seq)
+
+    def snapshot(self):
+        return tuple([(e.table, e.priority, e.match, e.actions, e.seq)
+                      for table_id in sorted(self.tables.keys()) for e in self.tables[table_id]])
+
+    def restore(self,snapshot):
+        self.tables = {}
+        self.sort_keys = {}
+        self.index = {}
+        for table,priority,match,actions,seq in snapshot:
+            entry = SimulatedFlowEntry(table,priority,match,actions)
+            entry.seq = seq # keeps the order among equal priorities
+            self.tables.setdefault(table,[]).append(entry)
+            self.sort_keys.setdefault(table,[]).append(entry.sort_key())
+            self.index[entry.key()] = entry
+
+    def version(self):
+        return 'SimulatedSwitch ' + str(self.VERSION)
+
+    def has_topology(self):
+        return True
+
+    def _create(self,cmd):
+        self.tables = {}
+        self.sort_keys = {}
+        self.index = {}
+        return CommandResult(cmd)
+
+    def _reset(self,cmd):
+        return self._create(cmd)
+
+    def _clear(self,cmd):
+        if self.undo_changes is not None:
+            for entries in self.tables.itervalues():
+                for entry in entries:
+                    self._record_removal(entry)
+        return self._create(cmd)
+
+    def _trace(self,cmd):
+        f = FlowDescription(str(cmd.flowdesc))
+        f.remove_table()
+        f.remove_actions()
+        f.remove_priority()
+        f.remove_statistics()
+        packet = FlowMatch(f)
+        result = CommandResult(cmd)
+        result.traced_rule = self.MISS_RULE
+        result.traced_actions = self.MISS_ACTIONS
+        for entry in self.tables.get(0,[]):
+            if entry.match.matches_packet(packet):
+                result.traced_rule = 'table={0} cookie=0 {1}'.format(entry.table, entry.match_string())
+                result.traced_actions = entry.actions
+                break
+        return result
+
+    def _dump(self,cmd):
+        result = CommandResult(cmd)
+        result.dumped_flows = []
+        self.xid += 1
+        result.xid = hex(self.xid)
+        for table_id in sorted(self.tables.keys()):
+            for entry in self.tables[table_id]:
+                flow = FlowDescription('cookie=0x0, duration=0s, table={0}, n_packets=0, n_bytes=0, idle_age=0, {1} actions={2}'.format(entry.table, entry.match_string(), entry.actions))
+                if cmd.dump_removeStatistics:
+                    flow.remove_statistics()
+                result.dumped_flows.append(flow)
+        return result
+
+    def _of_add(self,cmd):
+        f = cmd.flowdesc
+        if f.actions is None:
+            raise Exception(['ovs-ofctl: must specify an action'])
+        result = CommandResult(cmd)
+        entry = SimulatedFlowEntry(self._table_id(f), self._priority(f), FlowMatch(f), f.get_actions())
+        if 'check_overlap' in f.fields:
+            for other in self.tables.get(entry.table,[]):
+                if (other.priority == entry.priority and other.match != entry.match
+                    and other.match.intersects(entry.match)):
+                    result.overlap_error = True
+                    return result
+        existing = self.index.get(entry.key())
+        if existing is not None:
+            # an identical flow is replaced
+            self._remove_entry(existing)
+        self._insert_entry(entry)
+        return result
+
+    def _of_del(self,cmd):
+        f = cmd.flowdesc
+        for entry in self._selected_entries(cmd):
+            if 'out_port' in f.fields and not entry.outputs_to(f.fields['out_port']):
+                continue
+            self._remove_entry(entry)
+        return CommandResult(cmd)
+
+    def _of_mod(self,cmd):
+        f = cmd.flowdesc
+        entries = self._selected_entries(cmd)
+        if len(entries) == 0:
+            # OpenFlow 1.0 semantics: a modify that matches no flow adds it.
+            # ovs-ofctl drops the priority of non-strict modifies (see _flowmod_string)
+            priority = self._priority(f) if cmd.strict else self.DEFAULT_PRIORITY
+            self._insert_entry(SimulatedFlowEntry(self._table_id(f), priority, FlowMatch(f), f.get_actions()))
+        for entry in entries:
+            if self.undo_changes is not None:
+                # rolled back as a removal and a reinsertion
+                self._record_removal(entry)
+                self.undo_changes[0].add(entry.key())
+            entry.actions = normalize_actions(f.get_actions())
+        return CommandResult(cmd)
+
+    def _selected_entries(self,cmd):
+        """Flow entries affected by a DEL/MOD command, in strict or non-strict mode.
+        :rtype: list[SimulatedFlowEntry]
+        """
+        f = cmd.flowdesc
+        match = FlowMatch(f)
+        if 'table' in f.fields:
+            table_ids = [self._table_id(f)]
+        else:
+            table_ids = self.tables.keys()
+        if cmd.strict:
+            priority = self._priority(f)
+            entries = [self.index.get((t,match,priority)) for t in table_ids]
+            return [e for e in entries if e is not None]
+        entries = []
+        for t in table_ids:
+            entries.extend([e for e in self.tables.get(t,[]) if e.match.is_subset(match)])
+        return entries
+
+    def _insert_entry(self,entry,seq=None):
+        """Add an entry to its table, as the newest one unless seq is given
+        :type entry: SimulatedFlowEntry
+        """
+        if seq is None:
+            self.seq += 1
+            seq = self.seq
+        entry.seq = seq
+        if self.undo_changes is not None:
+            self.undo_changes[0].add(entry.key())
+        keys = self.sort_keys.setdefault(entry.table,[])
+        i = bisect.bisect(keys,entry.sort_key())
+        keys.insert(i,entry.sort_key())
+        self.tables.setdefault(entry.table,[]).insert(i,entry)
+        self.index[entry.key()] = entry
+
+    def _remove_entry(self,entry):
+        if self.undo_changes is not None:
+            self._record_removal(entry)
+        # sort keys are unique (seq)
+        i = bisect.bisect_left(self.sort_keys[entry.table],entry.sort_key())
+        del self.sort_keys[entry.table][i]
+        del self.tables[entry.table][i]
+        del self.index[entry.key()]
+
+    def _record_removal(self,entry):
+        # the first state of an entry within a command is the one to restore
+        if entry.key() not in self.undo_changes[1]:
+            self.undo_changes[1][entry.key()] = (entry.seq, entry.actions)
+
+    def _table_id(self,f):
+        return int(f.fields.get('table','0'),0)
+
+    def _priority(self,f):
+        priority = f.get_priority()
+        return self.DEFAULT_PRIORITY if priority is None else priority
+
+class SimulatedFlowEntry(object):
+    def __init__(self,table,priority,match,actions):
+        """Create object
+        :type table: int
+        :type priority: int
+        :type match: FlowMatch
+        :type actions: str
+        """
+        self.table = table
+        self.priority = priority
+        self.match = match
+        self.actions = normalize_actions(actions)
+        self.seq = 0
+
+    def key(self):
+        return (self.table, self.match, self.priority)
+
+    def sort_key(self):
+        # highest priority first, older flows first among equal priorities
+        return (-self.priority, self.seq)
+
+    def match_string(self):
+        return _match_string(self.priority,self.match)
+
+    def outputs_to(self,port):
+        port = str(port)
+        for action in self.actions.split(','):
+            if action in (port, 'output:'+port, port.upper()):
+                return True
+        return False
+
+def _match_string(priority,match):
+    """Priority and match the way OVS prints them, which omits the default priority
+    :type match: FlowMatch
+    :rtype: str
+    """
+    match = str(match)
+    if priority == SimulatedSwitch.DEFAULT_PRIORITY:
+        return match
+    return 'priority={0}'.format(priority) + (',' + match if match else '')
+
 class KvSwitchProxy(object):
     def __init__(self):
         pass
@@ -1206,35 +3656,162 @@ class PoxSwitchProxy(object):
     def __init__(self):
         pass
 
+class LRUCache(object):
+    """Mapping with a bounded number of entries, evicting the least recently used one.
+    A maxsize of 0 disables caching.
+    """
+    def __init__(self,maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,key,default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value # move to the end (most recently used)
+        self.hits += 1
+        return value
+
+    def put(self,key,value):
+        self.entries.pop(key,None)
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Grammars, compiled once. The _build_* functions are also used by bench.py.
+
+def _build_flowdesc_parser():
+    # General definitions
+    LBRACE,RBRACE,COMMA,EQUAL,COLON = map(pp.Suppress,'(),=:')
+    SEPARATOR = pp.Suppress(pp.oneOf(['',' ',',',' ,',', ',' , ']))
+    identifier = pp.Word(pp.alphas + "_", pp.alphanums + "_")
+    value = pp.Word(pp.printables.translate(None, ',='))
+
+    # Generic parsing of fields, excluding "actions" field
+    field_key = identifier
+    field_value = value
+    field_entry = pp.Group(field_key + pp.Optional(EQUAL + field_value))
+    fields = pp.Dict(field_entry + pp.ZeroOrMore(SEPARATOR + field_entry))
+    return fields("fields")
+
+def _build_actions_parser():
+    identifier = pp.Word(pp.alphas + "_", pp.alphanums + "_")
+    integer = pp.Word(pp.nums)
+
+    action_args_generic = pp.Word(pp.printables.translate(None, ',()'))
+    action_args_func = pp.Word(pp.printables.translate(None, '()'))
+    action_entry_generic = (identifier|integer) + pp.Optional(action_args_generic)
+    action_entry_func = identifier + pp.Combine('(' + pp.Optional(action_args_func) + ')')
+    action_entry = pp.Group(action_entry_func | action_entry_generic)
+
+    actions = pp.Dict(action_entry + pp.ZeroOrMore(pp.Suppress(',') + action_entry))
+    return actions("actions")
+
+def _build_priority_parser():
+    integer = pp.Word(pp.nums)
+    priority = integer
+
+    def _parse_priority(s,loc,tok):
+        # Note: effectively the same as using return int(self.fields['priority']), but ignores whitespace
+        assert len(tok) == 1
+        return int(tok[0]) # unpack
+
+    priority.setParseAction(_parse_priority)
+    return priority("priority")
+
+def _build_duration_parser():
+    integer = pp.Word(pp.nums)
+    seconds = integer
+    milliseconds = integer
+    duration = seconds("seconds") + pp.Optional(pp.Suppress('.') + milliseconds("milliseconds")) + pp.Suppress('s')
+
+    def _parse_duration(s,loc,tok):
+        assert len(tok) == 1 or len(tok) == 2
+        if len(tok) == 2:
+            return datetime.timedelta(seconds=int(tok[0]), microseconds=1000*int(tok[1]))
+        elif len(tok) == 1:
+            return datetime.timedelta(seconds=int(tok[0]))
+
+    duration.setParseAction(_parse_duration)
+    return duration("duration")
+
+def _build_dump_header_parser():
+    LBRACE,RBRACE,EQUAL = map(pp.Suppress,'()=')
+    hexint = pp.Combine( "0x" + pp.Word(pp.hexnums))
+    return ('NXST_FLOW reply ' + LBRACE + 'xid' + EQUAL + hexint("xid"))
+
+FLOWDESC_PARSER = _build_flowdesc_parser()
+ACTIONS_PARSER = _build_actions_parser()
+PRIORITY_PARSER = _build_priority_parser()
+DURATION_PARSER = _build_duration_parser()
+DUMP_HEADER_PARSER = _build_dump_header_parser()
+
+class _FlowFieldsDict(OrderedDict):
+    """OrderedDict used for FlowDescription.fields/actions. Tells its owner when
+    it is changed, so that the owner can drop its cached string rendering.
+    """
+    def __init__(self,owner,items=()):
+        self._owner = None
+        OrderedDict.__init__(self)
+        if hasattr(items,'iteritems'):
+            items = items.iteritems()
+        # fill directly, MutableMapping.update is slow
+        setitem = OrderedDict.__setitem__
+        for k,v in items:
+            setitem(self,k,v)
+        self._owner = owner
+
+    def __setitem__(self,key,value,*args,**kwargs):
+        OrderedDict.__setitem__(self,key,value,*args,**kwargs)
+        if self._owner is not None:
+            self._owner._changed()
+
+    def __delitem__(self,key,*args,**kwargs):
+        OrderedDict.__delitem__(self,key,*args,**kwargs)
+        if self._owner is not None:
+            self._owner._changed()
+
+    def clear(self):
+        OrderedDict.clear(self)
+        if self._owner is not None:
+            self._owner._changed()
+
+    def __reduce__(self):
+        # pickle as a plain OrderedDict, the owner wraps it again
+        return (OrderedDict, (self.items(),))
+
 class FlowDescription(object):
+    # Parse results by normalized flow/action string, shared by all instances.
+    # Entries are immutable tuples, every instance gets its own OrderedDicts.
+    parse_cache = LRUCache(20000)
+    actions_cache = LRUCache(5000)
+
     def __init__(self,s):
         s = ' '.join(s.split())
-#         print ' --------------------------'
-#         print s
         # Parse string to flow description object
-        # General definitions
-        LBRACE,RBRACE,COMMA,EQUAL,COLON = map(pp.Suppress,'(),=:')
-        WSPACE = pp.Suppress(pp.ZeroOrMore(pp.White()))
-        SEPARATOR = pp.Suppress(pp.oneOf(['',' ',',',' ,',', ',' , ']))
-        identifier = pp.Word(pp.alphas + "_", pp.alphanums + "_")
-        value = pp.Word(pp.printables.translate(None, ',='))
-        integer = pp.Word(pp.nums)
-        hexint = pp.Combine( "0x" + pp.Word(pp.hexnums))
-        # hexint.setParseAction(lambda s,loc,tok: [ int(tok[0],base=16) ])
-
-        # Generic parsing of fields, excluding "actions" field
-        field_key = identifier
-        field_value = value
-        field_entry = pp.Group(field_key + pp.Optional(EQUAL + field_value))
-        fields = pp.Dict(field_entry + pp.ZeroOrMore(SEPARATOR + field_entry))
-
-        flowdesc_parser = fields("fields")
-
-        parsed = flowdesc_parser.parseString(s)
-#         print parsed.dump()
+        parsed_fields = self.parse_cache.get(s)
+        if parsed_fields is None:
+            parsed = FLOWDESC_PARSER.parseString(s)
+            parsed_fields = tuple([(i[0],(None if len(i) < 2 else i[1])) for i in parsed.fields.asList()])
+            self.parse_cache.put(s,parsed_fields)
 
         # Store
-        self.fields = OrderedDict([(i[0],(None if len(i) < 2 else i[1])) for i in parsed.fields.asList()])
+        self.fields = parsed_fields
         if 'actions' in self.fields.keys():
             self.set_actions(self.fields['actions'])
             del self.fields['actions']
@@ -1245,12 +3822,38 @@ class FlowDescription(object):
         #assert s == repr(self)
 #         print str(self)
     
+    @property
+    def fields(self):
+        """Fields as an ordered dict (key -> value or None), excluding the actions.
+        Assigning any mapping or list of pairs stores a copy.
+        """
+        return self._fields
+
+    @fields.setter
+    def fields(self,fields):
+        self._fields = _FlowFieldsDict(self,fields)
+        self._changed()
+
+    @property
+    def actions(self):
+        """Actions as an ordered dict (action -> argument or None), or None.
+        Assigning any mapping or list of pairs stores a copy.
+        """
+        return self._actions
+
+    @actions.setter
+    def actions(self,actions):
+        self._actions = None if actions is None else _FlowFieldsDict(self,actions)
+        self._changed()
+
+    def _changed(self):
+        self._str = None
+
+    STATISTICS = ('cookie', 'duration', 'n_packets', 'n_bytes', 'idle_age')
+
     def remove_statistics(self):
-        self.fields.pop('cookie',None)
-        self.fields.pop('duration',None)
-        self.fields.pop('n_packets',None)
-        self.fields.pop('n_bytes',None)
-        self.fields.pop('idle_age',None)
+        for k in self.STATISTICS:
+            self.fields.pop(k,None)
     
     def remove_priority(self):
         self.fields.pop('priority',None)
@@ -1270,17 +3873,7 @@ class FlowDescription(object):
         :rtype: int
         """
         if 'priority' in self.fields:
-            integer = pp.Word(pp.nums)
-            priority = integer
-             
-            def _parse_priority(s,loc,tok):
-                # Note: effectively the same as using return int(self.fields['priority']), but ignores whitespace
-                assert len(tok) == 1
-                return int(tok[0]) # unpack
- 
-            priority.setParseAction(_parse_priority)
-            flowdesc_parser = priority("priority")
-            parsed = flowdesc_parser.parseString(self.fields['priority'])
+            parsed = PRIORITY_PARSER.parseString(self.fields['priority'])
             return parsed.priority
         else:
             return None
@@ -1290,21 +3883,7 @@ class FlowDescription(object):
         :rtype: datetime.timedelta
         """
         if 'duration' in self.fields:
-            integer = pp.Word(pp.nums)
-            seconds = integer
-            milliseconds = integer
-            duration = seconds("seconds") + pp.Optional(pp.Suppress('.') + milliseconds("milliseconds")) + pp.Suppress('s')
-
-            def _parse_duration(s,loc,tok):
-                assert len(tok) == 1 or len(tok) == 2
-                if len(tok) == 2:
-                    return datetime.timedelta(seconds=int(tok[0]), microseconds=1000*int(tok[1]))
-                elif len(tok) == 1:
-                    return datetime.timedelta(seconds=int(tok[0]))
-
-            duration.setParseAction(_parse_duration)
-            flowdesc_parser = duration("duration")
-            parsed = flowdesc_parser.parseString(self.fields['duration'])
+            parsed = DURATION_PARSER.parseString(self.fields['duration'])
             print parsed.dump()
             dd = parsed.duration
             print dd
@@ -1322,19 +3901,23 @@ class FlowDescription(object):
         """Get a copy of this FlowDescription with stats, priority, actions removed.
         :rtype: FlowDescription
         """
-        result = self.copy()
-        result.remove_statistics()
-        result.remove_priority()
-        result.remove_actions()
-        return result
+        return self._projection(self.STATISTICS + ('priority',))
       
     def get_match_priority(self):
         """Get a copy of this FlowDescription with stats, actions removed.
         :rtype: FlowDescription
         """
-        result = self.copy()
-        result.remove_statistics()
-        result.remove_actions()
+        return self._projection(self.STATISTICS)
+
+    def _projection(self,removed):
+        """Copy of this FlowDescription without the actions and the given fields.
+        :type removed: tuple[str]
+        :rtype: FlowDescription
+        """
+        result = self.__class__.__new__(self.__class__)
+        result._fields = _FlowFieldsDict(result,[(k,v) for k,v in self._fields.iteritems() if k not in removed])
+        result._actions = None
+        result._str = None
         return result
       
     def set_priority(self,p):
@@ -1353,28 +3936,25 @@ class FlowDescription(object):
         """Set actions.
         :type a: str
         """
-        identifier = pp.Word(pp.alphas + "_", pp.alphanums + "_")
-        integer = pp.Word(pp.nums)
-        
-        action_args_generic = pp.Word(pp.printables.translate(None, ',()'))
-        action_args_func = pp.Word(pp.printables.translate(None, '()'))
-        action_entry_generic = (identifier|integer) + pp.Optional(action_args_generic)
-        action_entry_func = identifier + pp.Combine('(' + pp.Optional(action_args_func) + ')')
-        action_entry = pp.Group(action_entry_func | action_entry_generic)
-
-        actions = pp.Dict(action_entry + pp.ZeroOrMore(pp.Suppress(',') + action_entry))
-
-        action_parser = actions("actions")
+        parsed_actions = self.actions_cache.get(a)
+        if parsed_actions is None:
+            parsed = ACTIONS_PARSER.parseString(a)
+            if 'actions' in parsed:
+                parsed_actions = tuple([(i[0],(None if len(i) < 2 else i[1])) for i in parsed.actions.asList()])
+            else:
+                parsed_actions = ()
+            self.actions_cache.put(a,parsed_actions)
 
-        parsed = action_parser.parseString(a)
-        
-        if 'actions' in parsed:
-            self.actions = OrderedDict([(i[0],(None if len(i) < 2 else i[1])) for i in parsed.actions.asList()])
+        if parsed_actions:
+            self.actions = parsed_actions
         else:
             self.actions = None
 
     def __str__(self):
-        return ', '.join([(k if v is None else k+'='+v) for k,v in self.fields.iteritems()]) + ('' if self.actions is None else ' actions='+','.join([(k if v is None else k+''+v) for k,v in self.actions.iteritems()]))
+        # cached until the fields or actions change
+        if self._str is None:
+            self._str = ', '.join([(k if v is None else k+'='+v) for k,v in self.fields.iteritems()]) + ('' if self.actions is None else ' actions='+','.join([(k if v is None else k+''+v) for k,v in self.actions.iteritems()]))
+        return self._str
 
     def __repr__(self):
         return str(self.__class__.__name__) + '(\'' + str(self) + '\')'
@@ -1393,20 +3973,672 @@ class FlowDescription(object):
         return hash(frozenset(mydict.items()))
     
     def copy(self):
-        return FlowDescription(self.__str__())
+        """Copy fields and actions without going through the parser.
+        :rtype: FlowDescription
+        """
+        result = self.__class__.__new__(self.__class__)
+        result._fields = _FlowFieldsDict(result,self._fields)
+        result._actions = None if self._actions is None else _FlowFieldsDict(result,self._actions)
+        result._str = self._str
+        return result
+
+    def __getstate__(self):
+        return {'fields' : OrderedDict(self.fields),
+                'actions' : None if self.actions is None else OrderedDict(self.actions)}
+
+    def __setstate__(self,state):
+        self.fields = state['fields']
+        self.actions = state['actions']
+
+class FlowMatch(object):
+    """Normalized match part of a FlowDescription.
+    Every matched header field is stored as an integer (value, mask) pair, with the
+    value masked. Protocol shorthands like 'tcp' are expanded to their dl_type and
+    nw_proto prerequisites, IP prefixes like '10.0.1.0/8' are canonicalized.
+    Fields not known here are kept as exact-match strings.
+    """
+    # field name -> (width in bits, format)
+    FIELDS = OrderedDict([
+        ('table', (8, 'dec')),
+        ('in_port', (16, 'dec')),
+        ('dl_vlan', (12, 'dec')),
+        ('dl_vlan_pcp', (3, 'dec')),
+        ('dl_src', (48, 'mac')),
+        ('dl_dst', (48, 'mac')),
+        ('dl_type', (16, 'hex')),
+        ('nw_src', (32, 'ip')),
+        ('nw_dst', (32, 'ip')),
+        ('nw_proto', (8, 'dec')),
+        ('nw_tos', (8, 'dec')),
+        ('nw_ttl', (8, 'dec')),
+        ('tp_src', (16, 'dec')),
+        ('tp_dst', (16, 'dec')),
+    ])
+    ALIASES = {'eth_type' : 'dl_type',
+               'eth_src' : 'dl_src',
+               'eth_dst' : 'dl_dst',
+               'ip_src' : 'nw_src',
+               'ip_dst' : 'nw_dst',
+               'ip_proto' : 'nw_proto',
+               'tcp_src' : 'tp_src',
+               'tcp_dst' : 'tp_dst',
+               'udp_src' : 'tp_src',
+               'udp_dst' : 'tp_dst',
+    }
+    # protocol shorthand -> (dl_type, nw_proto)
+    PROTOCOLS = OrderedDict([
+        ('tcp', (0x0800, 6)),
+        ('udp', (0x0800, 17)),
+        ('icmp', (0x0800, 1)),
+        ('sctp', (0x0800, 132)),
+        ('ip', (0x0800, None)),
+        ('arp', (0x0806, None)),
+        ('rarp', (0x8035, None)),
+        ('tcp6', (0x86dd, 6)),
+        ('udp6', (0x86dd, 17)),
+        ('icmp6', (0x86dd, 58)),
+        ('ipv6', (0x86dd, None)),
+    ])
+    # FlowDescription fields that are not part of the match
+    IGNORED = ('priority', 'cookie', 'duration', 'n_packets', 'n_bytes', 'idle_age', 'hard_age',
+               'idle_timeout', 'hard_timeout', 'check_overlap', 'out_port', 'send_flow_rem', 'actions')
+
+    def __init__(self,flowdesc=None,with_table=False):
+        """Create object
+        :type flowdesc: FlowDescription
+        :type with_table: bool
+        """
+        # field name -> (value, mask)
+        self.fields = {}
+        # field name -> string, for fields matched exactly as given
+        self.opaque = {}
+        if flowdesc is not None:
+            for k,v in flowdesc.fields.iteritems():
+                if k in self.IGNORED or (k == 'table' and not with_table):
+                    continue
+                self.add_field(k,v)
+
+    def add_field(self,name,value):
+        """Add a field as found in a FlowDescription
+        :type name: str
+        :type value: str
+        """
+        name = self.ALIASES.get(name,name)
+        if value is None and name in self.PROTOCOLS:
+            dl_type,nw_proto = self.PROTOCOLS[name]
+            self.fields['dl_type'] = (dl_type, 0xffff)
+            if nw_proto is not None:
+                self.fields['nw_proto'] = (nw_proto, 0xff)
+        elif name in self.FIELDS and value is not None:
+            width,fmt = self.FIELDS[name]
+            v,m = _parse_masked_value(value,width,fmt)
+            if m != 0:
+                self.fields[name] = (v & m, m)
+        else:
+            self.opaque[name] = value
+
+    def is_subset(self,other):
+        """Does every packet matching self also match other?
+        :type other: FlowMatch
+        :rtype: bool
+        """
+        for name,(ov,om) in other.fields.iteritems():
+            if name not in self.fields:
+                return False
+            sv,sm = self.fields[name]
+            if (sm & om) != om or (sv & om) != ov:
+                return False
+        for name,ov in other.opaque.iteritems():
+            if name not in self.opaque or self.opaque[name] != ov:
+                return False
+        return True
+
+    def intersects(self,other):
+        """Is there a packet matching both self and other?
+        :type other: FlowMatch
+        :rtype: bool
+        """
+        for name,(ov,om) in other.fields.iteritems():
+            if name in self.fields:
+                sv,sm = self.fields[name]
+                if (sv ^ ov) & sm & om:
+                    return False
+        for name,ov in other.opaque.iteritems():
+            if name in self.opaque and self.opaque[name] != ov:
+                return False
+        return True
+
+    def matches_packet(self,packet):
+        """Does a packet match? Header fields not given in the packet are 0.
+        :type packet: FlowMatch
+        :rtype: bool
+        """
+        for name,(v,m) in self.fields.iteritems():
+            if (packet.fields.get(name,(0,0))[0] & m) != v:
+                return False
+        for name,v in self.opaque.iteritems():
+            if packet.opaque.get(name) != v:
+                return False
+        return True
+
+    def key(self):
+        return (tuple(sorted(self.fields.iteritems())), tuple(sorted(self.opaque.iteritems())))
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __str__(self):
+        """Format like OVS does: protocol shorthand first, then the remaining fields.
+        """
+        entries = []
+        consumed = set()
+        dl_type = self.fields.get('dl_type')
+        nw_proto = self.fields.get('nw_proto')
+        for name,(p_dl_type,p_nw_proto) in self.PROTOCOLS.iteritems():
+            if dl_type != (p_dl_type, 0xffff):
+                continue
+            if p_nw_proto is None:
+                entries.append(name)
+                consumed.add('dl_type')
+                break
+            if nw_proto == (p_nw_proto, 0xff):
+                entries.append(name)
+                consumed.update(['dl_type', 'nw_proto'])
+                break
+        for name,(width,fmt) in self.FIELDS.iteritems():
+            if name in self.fields and name not in consumed:
+                v,m = self.fields[name]
+                entries.append(name + '=' + _format_masked_value(v,m,width,fmt))
+        for name in sorted(self.opaque.keys()):
+            entries.append(name if self.opaque[name] is None else name + '=' + self.opaque[name])
+        return ','.join(entries)
+
+    def __repr__(self):
+        return str(self.__class__.__name__) + '(\'' + str(self) + '\')'
+
+class PrefixTrie(object):
+    """Binary trie over bit prefixes of a fixed width, storing ids. A node is addressed by
+    (length, prefix), prefix being the top length bits; its children are (length+1, 2*prefix)
+    and (length+1, 2*prefix+1). Only nodes with something stored at or below them exist.
+    """
+    def __init__(self,width):
+        self.width = width
+        # (length, prefix) -> set of ids stored at that node
+        self.ids = {}
+        # (length, prefix) -> number of ids stored at or below that node
+        self.counts = {}
+
+    def insert(self,length,prefix,i):
+        for l in xrange(length + 1):
+            node = (l, prefix >> (length - l))
+            self.counts[node] = self.counts.get(node,0) + 1
+        self.ids.setdefault((length,prefix),set()).add(i)
+
+    def remove(self,length,prefix,i):
+        ids = self.ids[(length,prefix)]
+        ids.remove(i)
+        if not ids:
+            del self.ids[(length,prefix)]
+        for l in xrange(length + 1):
+            node = (l, prefix >> (length - l))
+            self.counts[node] -= 1
+            if not self.counts[node]:
+                del self.counts[node]
+
+    def ancestors(self,length,prefix,inclusive=True):
+        """Ids stored on the path from the root to (length, prefix)
+        :rtype: list[int]
+        """
+        result = []
+        for l in xrange(length + 1 if inclusive else length):
+            result.extend(self.ids.get((l, prefix >> (length - l)),()))
+        return result
+
+    def count_ancestors(self,length,prefix,inclusive=True):
+        return sum(len(self.ids.get((l, prefix >> (length - l)),())) for l in xrange(length + 1 if inclusive else length))
+
+    def descendants(self,length,prefix):
+        """Ids stored at (length, prefix) or below
+        :rtype: list[int]
+        """
+        result = []
+        stack = [(length,prefix)]
+        while stack:
+            l,p = stack.pop()
+            if (l,p) not in self.counts:
+                continue
+            result.extend(self.ids.get((l,p),()))
+            if l < self.width:
+                stack.append((l + 1, 2 * p + 1))
+                stack.append((l + 1, 2 * p))
+        return result
+
+    def count_descendants(self,length,prefix):
+        return self.counts.get((length,prefix),0)
+
+class FlowIndex(object):
+    """Index over a collection of FlowDescriptions that narrows down the flows that may be
+    supersets, subsets of, or overlap with a given flow, so that a FlowComparator only has to
+    compare those candidates instead of the whole collection.
+    nw_src and nw_dst are kept in a PrefixTrie each (a flow is stored at the leading ones of
+    its mask), the other header fields in hash buckets of their exact values. A query takes
+    the smallest of these candidate lists and filters it, lookups are proportional to the prefix
+    length. The candidates are a superset of the answer: table and opaque fields are not indexed,
+    and flows using a field without its prerequisite (e.g. nw_src without dl_type, which OVS may
+    ignore) are always candidates.
+    Flows must not be modified while they are in the index.
+    """
+    PREFIX_FIELDS = ('nw_src', 'nw_dst')
+    EXACT_FIELDS = ('in_port', 'dl_vlan', 'dl_vlan_pcp', 'dl_src', 'dl_dst', 'dl_type', 'nw_proto', 'nw_tos', 'nw_ttl',
+                    'tp_src', 'tp_dst')
+    # field -> field that must be matched exactly for it to be used
+    PREREQUISITES = {'nw_src' : 'dl_type', 'nw_dst' : 'dl_type', 'nw_proto' : 'dl_type', 'nw_tos' : 'dl_type',
+                     'nw_ttl' : 'dl_type', 'tp_src' : 'nw_proto', 'tp_dst' : 'nw_proto'}
+
+    def __init__(self,flows=()):
+        """Create object
+        :type flows: collections.Iterable[FlowDescription]
+        """
+        self.flows = OrderedDict() # id -> FlowDescription
+        self.entries = {} # id -> (prefixes, exact) as returned by _entry, None if not indexable
+        # id() of a FlowDescription -> its ids; flows are not hashed, match-only ones (no actions) cannot be
+        self.numbers = {}
+        self.next_id = 0
+        self.tries = dict((name, PrefixTrie(FlowMatch.FIELDS[name][0])) for name in self.PREFIX_FIELDS)
+        self.buckets = dict((name, {}) for name in self.EXACT_FIELDS) # field -> value -> set of ids
+        self.wildcards = dict((name, set()) for name in self.EXACT_FIELDS) # field -> ids not matching it exactly
+        self.unindexed = set()
+        for f in flows:
+            self.add(f)
+
+    def __len__(self):
+        return len(self.flows)
+
+    def __iter__(self):
+        return iter(self.flows.values())
+
+    def add(self,f):
+        """
+        :type f: FlowDescription
+        """
+        i = self.next_id
+        self.next_id += 1
+        entry = self._entry(f)
+        self.flows[i] = f
+        self.entries[i] = entry
+        self.numbers.setdefault(id(f),[]).append(i)
+        if entry is None:
+            self.unindexed.add(i)
+            return
+        prefixes,exact = entry
+        for name in self.PREFIX_FIELDS:
+            length,prefix = prefixes.get(name,(0,0)) # not matched: the root
+            self.tries[name].insert(length,prefix,i)
+        for name in self.EXACT_FIELDS:
+            if name in exact:
+                self.buckets[name].setdefault(exact[name],set()).add(i)
+            else:
+                self.wildcards[name].add(i)
+
+    def remove(self,f):
+        """Remove f, the same object that was added
+        :type f: FlowDescription
+        """
+        i = self.numbers[id(f)].pop()
+        if not self.numbers[id(f)]:
+            del self.numbers[id(f)]
+        del self.flows[i]
+        entry = self.entries.pop(i)
+        if entry is None:
+            self.unindexed.remove(i)
+            return
+        prefixes,exact = entry
+        for name in self.PREFIX_FIELDS:
+            length,prefix = prefixes.get(name,(0,0))
+            self.tries[name].remove(length,prefix,i)
+        for name in self.EXACT_FIELDS:
+            if name in exact:
+                bucket = self.buckets[name][exact[name]]
+                bucket.remove(i)
+                if not bucket:
+                    del self.buckets[name][exact[name]]
+            else:
+                self.wildcards[name].remove(i)
+
+    def supersets(self,s):
+        """Flows that may be a superset of s (s is a subset of them)
+        :type s: FlowDescription
+        :rtype: list[FlowDescription]
+        """
+        return self._query(s,'supersets')
+
+    def subsets(self,s):
+        """Flows that may be a subset of s
+        :type s: FlowDescription
+        :rtype: list[FlowDescription]
+        """
+        return self._query(s,'subsets')
+
+    def overlapping(self,s):
+        """Flows that may overlap with s
+        :type s: FlowDescription
+        :rtype: list[FlowDescription]
+        """
+        return self._query(s,'overlapping')
+
+    def _entry(self,f):
+        """Indexed form of a flow: {field: (prefix length, prefix)} and {field: exact value},
+        None if a field is used without its prerequisite.
+        :type f: FlowDescription
+        """
+        match = FlowMatch(f)
+        full = {}
+        for name,(v,m) in match.fields.iteritems():
+            full[name] = m == (1 << FlowMatch.FIELDS[name][0]) - 1
+        for name in match.fields:
+            prerequisite = self.PREREQUISITES.get(name)
+            if prerequisite is not None and not full.get(prerequisite):
+                return None
+        prefixes = {}
+        for name in self.PREFIX_FIELDS:
+            if name in match.fields:
+                v,m = match.fields[name]
+                width = FlowMatch.FIELDS[name][0]
+                length = width - len(bin(m ^ ((1 << width) - 1))) + 2 if m != (1 << width) - 1 else width
+                prefixes[name] = (length, v >> (width - length))
+        exact = dict((name, match.fields[name][0]) for name in self.EXACT_FIELDS if full.get(name))
+        return (prefixes, exact)
+
+    def _query(self,s,kind):
+        entry = self._entry(s)
+        if entry is None:
+            return self.flows.values()
+        prefixes,exact = entry
+        # candidate sources as (size, function returning the ids)
+        sources = [(len(self.flows), lambda: self.flows.keys())]
+        for name in self.PREFIX_FIELDS:
+            trie = self.tries[name]
+            length,prefix = prefixes.get(name,(0,0))
+            if kind == 'supersets':
+                sources.append((trie.count_ancestors(length,prefix),
+                                lambda trie=trie,length=length,prefix=prefix: trie.ancestors(length,prefix)))
+            elif kind == 'subsets':
+                sources.append((trie.count_descendants(length,prefix),
+                                lambda trie=trie,length=length,prefix=prefix: trie.descendants(length,prefix)))
+            else:
+                sources.append((trie.count_ancestors(length,prefix,False) + trie.count_descendants(length,prefix),
+                                lambda trie=trie,length=length,prefix=prefix:
+                                    trie.ancestors(length,prefix,False) + trie.descendants(length,prefix)))
+        for name,value in exact.iteritems():
+            bucket = self.buckets[name].get(value,())
+            if kind == 'subsets':
+                sources.append((len(bucket), lambda bucket=bucket: bucket))
+            else:
+                wildcards = self.wildcards[name]
+                sources.append((len(bucket) + len(wildcards), lambda bucket=bucket,wildcards=wildcards: list(bucket) + list(wildcards)))
+        if kind == 'supersets':
+            for name in self.EXACT_FIELDS:
+                if name not in exact:
+                    wildcards = self.wildcards[name]
+                    sources.append((len(wildcards), lambda wildcards=wildcards: wildcards))
+        ids = min(sources,key=lambda source: source[0])[1]
+        candidates = set(i for i in ids() if self._compatible(self.entries[i],prefixes,exact,kind))
+        candidates.update(self.unindexed)
+        return [self.flows[i] for i in sorted(candidates)]
+
+    def _compatible(self,entry,prefixes,exact,kind):
+        if entry is None:
+            return True
+        t_prefixes,t_exact = entry
+        for name in self.PREFIX_FIELDS:
+            s_length,s_prefix = prefixes.get(name,(0,0))
+            t_length,t_prefix = t_prefixes.get(name,(0,0))
+            if kind == 'supersets' and t_length > s_length:
+                return False
+            if kind == 'subsets' and t_length < s_length:
+                return False
+            common = min(s_length,t_length)
+            if s_prefix >> (s_length - common) != t_prefix >> (t_length - common):
+                return False
+        for name in self.EXACT_FIELDS:
+            if name in exact and name in t_exact and exact[name] != t_exact[name]:
+                return False
+            if kind == 'supersets' and name in t_exact and name not in exact:
+                return False
+            if kind == 'subsets' and name in exact and name not in t_exact:
+                return False
+        return True
+
+class TernaryMatchEngine(object):
+    """Header space relations of whole batches of flows, computed with NumPy.
+    Every match is encoded as a row of (value, mask) words, one column per FlowMatch header
+    field and one per opaque field (whose strings are numbered); a field that is not matched
+    has mask 0. subset_matrix and intersection_matrix relate every flow of one batch to every
+    flow of another with bitwise array operations, CHUNK_CELLS pairs at a time so that memory
+    stays bounded. Relations are the ones of AnalyticalFlowComparator: a flow without a table
+    is in table 0, except for the more general flow of a subset test, which matches all tables.
+    """
+    # pairs related at once, memory is a few bytes per pair
+    CHUNK_CELLS = 1 << 22
+    # mask of an opaque field's number
+    OPAQUE_MASK = 0xffffffff
+
+    def __init__(self):
+        if numpy is None:
+            raise Exception('TernaryMatchEngine needs numpy')
+        self.columns = list(FlowMatch.FIELDS)
+        self.opaque = {} # opaque field name -> {string: number}
+
+    def encode(self,flows,installed=True):
+        """(values, masks), uint64 arrays with a row per flow and a column per field
+        :type flows: list[FlowDescription]
+        :param installed: encode flows without a table as in table 0
+        """
+        encoded = []
+        for f in flows:
+            match = FlowMatch(f,with_table=True)
+            if installed and 'table' not in match.fields:
+                match.add_field('table','0')
+            fields = dict(match.fields)
+            for name,value in match.opaque.iteritems():
+                if name not in self.opaque:
+                    self.opaque[name] = {}
+                    self.columns.append(name)
+                numbers = self.opaque[name]
+                fields[name] = (numbers.setdefault(value,len(numbers)), self.OPAQUE_MASK)
+            encoded.append(fields)
+        empty = (0, 0)
+        values = numpy.array([[fields.get(name,empty)[0] for name in self.columns] for fields in encoded],dtype=numpy.uint64)
+        masks = numpy.array([[fields.get(name,empty)[1] for name in self.columns] for fields in encoded],dtype=numpy.uint64)
+        return (values.reshape(len(encoded),len(self.columns)), masks.reshape(len(encoded),len(self.columns)))
+
+    def subset_matrix(self,rows,cols):
+        """Boolean array, [i,j] is whether every packet matching rows[i] also matches cols[j]
+        :type rows: list[FlowDescription]
+        :type cols: list[FlowDescription]
+        :rtype: numpy.ndarray
+        """
+        return self._matrix(self.encode(rows),self.encode(cols,installed=False),self._subset)
+
+    def intersection_matrix(self,rows,cols):
+        """Boolean array, [i,j] is whether a packet matches both rows[i] and cols[j]
+        :type rows: list[FlowDescription]
+        :type cols: list[FlowDescription]
+        :rtype: numpy.ndarray
+        """
+        return self._matrix(self.encode(rows),self.encode(cols),self._intersects)
+
+    def is_subset_many(self,pairs):
+        """is_subset(s,t) for every pair (s,t)
+        :rtype: list[bool]
+        """
+        (sv,sm),(tv,tm) = self._encode_pairs(pairs,False)
+        return (((sm & tm) == tm) & ((sv & tm) == tv)).all(axis=1).tolist()
+
+    def is_intersection_nonempty_many(self,pairs):
+        """is_intersection_nonempty(s,t) for every pair (s,t)
+        :rtype: list[bool]
+        """
+        (sv,sm),(tv,tm) = self._encode_pairs(pairs,True)
+        return (((sv ^ tv) & sm & tm) == 0).all(axis=1).tolist()
+
+    def _encode_pairs(self,pairs,installed):
+        # the same flow is often in many pairs (e.g. the query of a set operation), encode it once
+        flows = OrderedDict()
+        for s,t in pairs:
+            flows.setdefault(id(s),s)
+        s_rows = dict((k, i) for i,k in enumerate(flows))
+        t_flows = OrderedDict()
+        for s,t in pairs:
+            t_flows.setdefault(id(t),t)
+        t_rows = dict((k, i) for i,k in enumerate(t_flows))
+        # both sides are padded only once both are encoded, t may bring in new opaque columns
+        s_encoded = self.encode(flows.values())
+        t_encoded = self.encode(t_flows.values(),installed)
+        sv,sm = self._pad(s_encoded)
+        tv,tm = self._pad(t_encoded)
+        s_index = numpy.array([s_rows[id(s)] for s,t in pairs],dtype=numpy.intp)
+        t_index = numpy.array([t_rows[id(t)] for s,t in pairs],dtype=numpy.intp)
+        return (sv[s_index],sm[s_index]),(tv[t_index],tm[t_index])
+
+    def _pad(self,encoded):
+        """encoded with zero columns for the opaque fields added since it was encoded"""
+        values,masks = encoded
+        missing = len(self.columns) - values.shape[1]
+        if missing:
+            padding = numpy.zeros((values.shape[0],missing),dtype=numpy.uint64)
+            values,masks = numpy.hstack((values,padding)),numpy.hstack((masks,padding))
+        return (values,masks)
+
+    def _matrix(self,a,b,relation):
+        (av,am),(bv,bm) = self._pad(a),self._pad(b)
+        result = numpy.ones((av.shape[0],bv.shape[0]),dtype=bool)
+        # columns no flow of either batch matches do not change any relation
+        used = am.any(axis=0) | bm.any(axis=0)
+        av,am,bv,bm = av[:,used],am[:,used],bv[:,used],bm[:,used]
+        step = max(1,self.CHUNK_CELLS // max(1,bv.shape[0]))
+        for start in xrange(0,av.shape[0],step):
+            relation(av[start:start+step],am[start:start+step],bv,bm,result[start:start+step])
+        return result
+
+    def _subset(self,av,am,bv,bm,out):
+        for c in xrange(av.shape[1]):
+            m = bm[None,:,c]
+            out &= ((am[:,c,None] & m) == m) & ((av[:,c,None] & m) == bv[None,:,c])
+
+    def _intersects(self,av,am,bv,bm,out):
+        for c in xrange(av.shape[1]):
+            out &= ((av[:,c,None] ^ bv[None,:,c]) & am[:,c,None] & bm[None,:,c]) == 0
+
+def _parse_masked_value(s,width,fmt):
+    """Parse a field value like '10.0.0.0/8', '0x800' or '00:11:22:33:44:55/ff:ff:ff:00:00:00'.
+    :rtype: (int, int)
+    """
+    full = (1 << width) - 1
+    parse = {'ip' : _parse_ip, 'mac' : _parse_mac, 'dec' : _parse_int, 'hex' : _parse_int}[fmt]
+    if '/' not in s:
+        return (parse(s), full)
+    value,mask = s.split('/',1)
+    if fmt == 'ip' and '.' not in mask:
+        prefix = int(mask)
+        return (parse(value), (full << (width - prefix)) & full)
+    return (parse(value), parse(mask))
+
+def _format_masked_value(v,m,width,fmt):
+    full = (1 << width) - 1
+    if fmt == 'ip':
+        prefix = bin(m).count('1')
+        if m == full:
+            return _format_ip(v)
+        if m == (full << (width - prefix)) & full:
+            return _format_ip(v) + '/' + str(prefix)
+        return _format_ip(v) + '/' + _format_ip(m)
+    if fmt == 'mac':
+        return _format_mac(v) + ('' if m == full else '/' + _format_mac(m))
+    if fmt == 'hex':
+        return '0x%04x' % v + ('' if m == full else '/0x%04x' % m)
+    return str(v) if m == full else '0x%x/0x%x' % (v,m)
+
+def _parse_int(s):
+    return int(s,0)
+
+def _parse_ip(s):
+    return struct.unpack('!I',socket.inet_aton(s))[0]
+
+def _format_ip(v):
+    return socket.inet_ntoa(struct.pack('!I',v))
+
+def _parse_mac(s):
+    return int(s.replace(':',''),16)
+
+def _format_mac(v):
+    h = '%012x' % v
+    return ':'.join([h[i:i+2] for i in xrange(0,12,2)])
+
+def normalize_actions(actions):
+    """Format an action list the way OVS prints it, e.g. '1,normal' -> 'output:1,NORMAL'.
+    :type actions: str
+    :rtype: str
+    """
+    special = ('normal', 'flood', 'all', 'local', 'in_port', 'controller')
+    result = []
+    for action in _split_actions(actions):
+        if action.isdigit():
+            result.append('output:' + action)
+        elif action.lower() in special:
+            result.append(action.upper())
+        elif action != 'drop' and action != '':
+            result.append(action)
+    return ','.join(result) if result else 'drop'
+
+def _split_actions(actions):
+    # split at commas, but not inside parentheses like in enqueue(1,2)
+    parts = []
+    depth = 0
+    current = ''
+    for c in actions:
+        if c == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        current += c
+    parts.append(current.strip())
+    return parts
 
 # Helper functionality
 
-def run_cmdline(args, piped_input=None, chdir='.', nowait=False, noerr=False):
+def run_cmdline(args, piped_input=None, chdir='.', nowait=False, noerr=False, status=False):
     """Run a command externally.
+    With status, return (exit status, lines) instead of the lines.
     """
     # my_env = os.environ.copy()
 #     print "$ " + " ".join(map(str,args))
-    p = subprocess.Popen(args, close_fds=True, cwd=chdir, shell=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
+    timings = Timings.get()
+    start = time.time()
+    runner = CommandRunner.get()
+    if runner is not None and not nowait:
+        retval, output = runner.run(args, piped_input, chdir)
+        p = None
+    else:
+        p = subprocess.Popen(args, close_fds=True, cwd=chdir, shell=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
     if nowait == True:
+        if timings is not None:
+            timings.add('subprocess ' + os.path.basename(args[0]),time.time() - start)
         return []
     else:
-        if piped_input is not None:
+        if p is None:
+            pass # already done by the runner
+        elif piped_input is not None:
             output, unused_err = p.communicate(piped_input);
         else:
             output, unused_err = p.communicate();
@@ -1414,19 +4646,226 @@ def run_cmdline(args, piped_input=None, chdir='.', nowait=False, noerr=False):
             lines = output.splitlines()
         else:
             lines = []
-        retval = p.wait()
+        if p is not None:
+            retval = p.wait()
+        if timings is not None:
+            timings.add('subprocess ' + os.path.basename(args[0]),time.time() - start)
         if retval != 0 and not noerr:
             error = subprocess.CalledProcessError(retval, args, output)
             print " ".join(map(str,args))
             print output
             raise error
 #         print "\n".join(map(str,lines))
+        if status:
+            return retval, lines
         return lines
 
 def run_cmdline_string(cmdline, *args, **kwargs):
     cmd = shlex.split(cmdline);
     return run_cmdline(cmd, *args, **kwargs);
 
+class CommandRunner(object):
+    """
+    Long-lived helper process that runs the command lines of run_cmdline(), once enabled, so
+    that this (large) process does not fork for every command. Requests and replies are
+    frames of length-prefixed byte strings (see _write_frame), so any input and output
+    passes through. A process that inherits the runner through fork() starts its own.
+    """
+    # the helper: reads [chdir, input, args...], replies [exit code, output] or ['error', errno, message]
+    SOURCE = '''
+import os, struct, subprocess, sys
+def read(n):
+    data = ''
+    while len(data) < n:
+        chunk = os.read(0, n - len(data))
+        if not chunk:
+            sys.exit(0)
+        data += chunk
+    return data
+def read_frame():
+    fields = []
+    for _ in xrange(struct.unpack('!I', read(4))[0]):
+        fields.append(read(struct.unpack('!I', read(4))[0]))
+    return fields
+def write_frame(fields):
+    os.write(1, struct.pack('!I', len(fields)) + ''.join([struct.pack('!I', len(f)) + f for f in fields]))
+while True:
+    fields = read_frame()
+    chdir, piped_input, args = fields[0], fields[1], fields[2:]
+    try:
+        p = subprocess.Popen(args, cwd=chdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
+        output = p.communicate(piped_input[1:] if piped_input else None)[0]
+        write_frame([str(p.wait()), output])
+    except OSError as e:
+        write_frame(['error', str(e.errno), e.strerror])
+'''
+    _instance = None
+    _enabled = False
+
+    @classmethod
+    def enable(cls):
+        """Run all following commands of this process (and its children) through a runner"""
+        cls._enabled = True
+
+    @classmethod
+    def get(cls):
+        """The runner of this process, None if not enabled
+        :rtype: CommandRunner
+        """
+        if not cls._enabled:
+            return None
+        if cls._instance is None or cls._instance.pid != os.getpid():
+            # the pipes of an inherited runner belong to the parent
+            cls._instance = CommandRunner()
+        return cls._instance
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.process = subprocess.Popen([sys.executable, '-c', self.SOURCE], close_fds=True,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # seconds per command, including the round-trip to the helper
+        self.latencies = []
+
+    def run(self,args,piped_input,chdir):
+        """Run a command, returns its exit code and combined stdout/stderr
+        :type args: list[str]
+        :rtype: (int, str)
+        """
+        start = time.time()
+        # input is sent with a '+' in front, to tell no input and empty input apart
+        _write_frame(self.process.stdin,[chdir, '' if piped_input is None else '+' + piped_input] + list(args))
+        reply = _read_frame(self.process.stdout)
+        self.latencies.append(time.time() - start)
+        if reply[0] == 'error':
+            # like Popen would have
+            raise OSError(int(reply[1]),reply[2])
+        return (int(reply[0]), reply[1])
+
+    def summary(self):
+        if not self.latencies:
+            return 'Command runner: no commands.'
+        return 'Command runner: {0} commands, {1:.2f} ms mean latency, {2:.2f} ms max.'.format(
+            len(self.latencies), 1000 * sum(self.latencies) / len(self.latencies), 1000 * max(self.latencies))
+
+def _write_frame(f,fields):
+    """Write a frame: the number of fields, then each field prefixed with its length
+    :type fields: list[str]
+    """
+    f.write(struct.pack('!I',len(fields)) + ''.join([struct.pack('!I',len(field)) + field for field in fields]))
+    f.flush()
+
+def _read_frame(f):
+    """
+    :rtype: list[str]
+    """
+    def read(n):
+        data = f.read(n)
+        if len(data) < n:
+            raise Exception('Command runner exited')
+        return data
+    return [read(struct.unpack('!I',read(4))[0]) for _ in xrange(struct.unpack('!I',read(4))[0])]
+
+class Timings(object):
+    """
+    Wall-time instrumentation of a run, once enabled: the commands executed by every switch
+    (OvsSwitch.executeCommand), the phases of every testcase (CommutativityTestSuite.evaluate_case)
+    and the external commands of run_cmdline(). Each series has a count, a total, a maximum and a
+    histogram. Every process records its own timings; a suite merges those of its workers.
+    """
+    # upper bounds of the histogram buckets in seconds, the last bucket has no bound
+    BUCKETS = [0.0001, 0.001, 0.01, 0.1, 1.0, 10.0]
+    _instance = None
+    _enabled = False
+
+    @classmethod
+    def enable(cls):
+        """Record timings in this process (and its children)"""
+        cls._enabled = True
+
+    @classmethod
+    def get(cls):
+        """The timings of this process, None if not enabled
+        :rtype: Timings
+        """
+        if not cls._enabled:
+            return None
+        if cls._instance is None or cls._instance.pid != os.getpid():
+            # what was recorded before a fork belongs to the parent
+            cls._instance = Timings()
+        return cls._instance
+
+    def __init__(self):
+        self.pid = os.getpid()
+        # name -> [count, total seconds, max seconds, count per bucket]
+        self.series = OrderedDict()
+        # seconds per phase of every testcase, with its number
+        self.cases = []
+
+    def add(self,name,seconds):
+        series = self.series.get(name)
+        if series is None:
+            series = self.series[name] = [0, 0.0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+        series[0] += 1
+        series[1] += seconds
+        series[2] = max(series[2],seconds)
+        series[3][bisect.bisect_left(self.BUCKETS,seconds)] += 1
+
+    def add_case(self,caseno,phases):
+        """
+        :type phases: OrderedDict
+        """
+        self.cases.append(OrderedDict([('case', caseno)] + phases.items()))
+        for phase,seconds in phases.iteritems():
+            self.add('phase ' + phase,seconds)
+
+    def export(self):
+        """Machine-readable timings, see merge()
+        :rtype: dict
+        """
+        series = OrderedDict()
+        for name,(count,total,longest,histogram) in self.series.iteritems():
+            series[name] = OrderedDict([('count', count), ('total', total), ('max', longest), ('histogram', histogram)])
+        return OrderedDict([('buckets', self.BUCKETS), ('series', series), ('cases', self.cases)])
+
+    def take(self):
+        """export() the timings recorded so far and start over
+        :rtype: dict
+        """
+        exported = self.export()
+        self.series = OrderedDict()
+        self.cases = []
+        return exported
+
+    def merge(self,exported):
+        """Add timings exported by another process
+        :type exported: dict
+        """
+        for name,other in exported['series'].iteritems():
+            series = self.series.get(name)
+            if series is None:
+                series = self.series[name] = [0, 0.0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+            series[0] += other['count']
+            series[1] += other['total']
+            series[2] = max(series[2],other['max'])
+            series[3] = [a + b for a,b in zip(series[3],other['histogram'])]
+        self.cases.extend(exported['cases'])
+
+    def summary(self):
+        bounds = ['<=' + _format_seconds(b) for b in self.BUCKETS] + ['>' + _format_seconds(self.BUCKETS[-1])]
+        lines = ['Timings:',
+                 '  {0:<32} {1:>8} {2:>10} {3:>10} {4:>10}  '.format('', 'count', 'total s', 'mean ms', 'max ms') +
+                 ' '.join(['{0:>8}'.format(b) for b in bounds])]
+        for name in sorted(self.series.keys()):
+            count,total,longest,histogram = self.series[name]
+            lines.append('  {0:<32} {1:>8} {2:>10.3f} {3:>10.3f} {4:>10.3f}  '.format(
+                name, count, total, 1000 * total / count, 1000 * longest) + ' '.join(['{0:>8}'.format(n) for n in histogram]))
+        return '\n'.join(lines)
+
+def _format_seconds(seconds):
+    if seconds < 1:
+        return '{0:g}ms'.format(1000 * seconds)
+    return '{0:g}s'.format(seconds)
+
 if __name__ == "__main__":
     app = MainApp()
     app.run();
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Tests of the analytical comparator and its NumPy engine. Run from this directory:
+
+  python -m unittest discover -p 'test_*.py'
+"""
+import unittest
+import random
+
+from test import FlowDescription, AnalyticalFlowComparator, TernaryMatchEngine, FlowIndex, numpy
+
+def _random_flows(rnd,count):
+    flows = []
+    for i in xrange(count):
+        parts = ['priority=%d' % rnd.randint(1,5)]
+        if rnd.random() < 0.8:
+            parts.append(rnd.choice(['ip', 'tcp', 'udp']))
+        if rnd.random() < 0.6:
+            parts.append('nw_dst=10.0.%d.0/%d' % (rnd.randint(0,2), rnd.choice([8,16,24,32])))
+        if rnd.random() < 0.3:
+            parts.append('in_port=%d' % rnd.randint(1,3))
+        if rnd.random() < 0.2:
+            parts.append('table=%d' % rnd.randint(0,1))
+        # opaque fields, each value gets a column number in the engine
+        if rnd.random() < 0.3:
+            parts.append('reg0=%d' % rnd.randint(0,2))
+        if rnd.random() < 0.2:
+            parts.append('metadata=%d' % rnd.randint(0,1))
+        flows.append(FlowDescription(','.join(parts) + ' actions=output:1'))
+    return flows
+
+@unittest.skipIf(numpy is None, 'needs numpy')
+class TernaryMatchEngineTest(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(1)
+        self.flows = _random_flows(rnd,60)
+        self.others = _random_flows(rnd,60)
+        self.pairwise = AnalyticalFlowComparator()
+        self.pairwise.engine = None
+
+    def _check_many(self,pairs):
+        engine = TernaryMatchEngine()
+        self.assertEqual(engine.is_subset_many(pairs), [self.pairwise.is_subset(s,t) for s,t in pairs])
+        engine = TernaryMatchEngine()
+        self.assertEqual(engine.is_intersection_nonempty_many(pairs),
+                         [self.pairwise.is_intersection_nonempty(s,t) for s,t in pairs])
+
+    def test_many_matches_pairwise(self):
+        self._check_many([(s,t) for s in self.flows[:20] for t in self.others])
+
+    def test_many_with_opaque_fields_only_on_one_side(self):
+        plain = FlowDescription('table=0, priority=5, tcp,nw_dst=10.0.0.1 actions=output:1')
+        with_reg = [FlowDescription('table=0, priority=%d, tcp,reg0=%d actions=output:1' % (i,i)) for i in range(40)]
+        self._check_many([(plain,t) for t in with_reg])
+        self._check_many([(t,plain) for t in with_reg])
+
+    def test_set_queries_with_engine(self):
+        comparator = AnalyticalFlowComparator()
+        probe = FlowDescription('table=0, priority=5, tcp,nw_dst=10.0.0.1 actions=output:1')
+        flows = [FlowDescription('table=0, priority=%d, tcp,reg0=%d actions=output:1' % (i,i)) for i in range(40)]
+        self.assertEqual(comparator.superset_set(probe,flows), set())
+        self.assertEqual(comparator.intersecting_set(probe,flows), set(flows))
+
+    def test_matrices_match_pairwise(self):
+        engine = TernaryMatchEngine()
+        subset = engine.subset_matrix(self.flows,self.others)
+        intersection = engine.intersection_matrix(self.flows,self.others)
+        for i,s in enumerate(self.flows):
+            for j,t in enumerate(self.others):
+                self.assertEqual(bool(subset[i,j]), self.pairwise.is_subset(s,t))
+                self.assertEqual(bool(intersection[i,j]), self.pairwise.is_intersection_nonempty(s,t))
+
+    def test_matrices_in_small_chunks(self):
+        engine = TernaryMatchEngine()
+        expected = engine.intersection_matrix(self.flows,self.others)
+        engine.CHUNK_CELLS = 7
+        self.assertTrue((engine.intersection_matrix(self.flows,self.others) == expected).all())
+
+class FlowIndexTest(unittest.TestCase):
+    def test_set_queries_with_index(self):
+        rnd = random.Random(2)
+        flows = _random_flows(rnd,80)
+        index = FlowIndex(flows)
+        comparator = AnalyticalFlowComparator()
+        for probe in _random_flows(rnd,15):
+            for query in ('subset_set', 'intersecting_set', 'superset_set'):
+                self.assertEqual(getattr(comparator,query)(probe,index), getattr(comparator,query)(probe,flows))
+
+    def test_match_only_flows(self):
+        rnd = random.Random(4)
+        # no actions, like the flows of DEL commands
+        flows = [f.get_match_priority() for f in _random_flows(rnd,40)]
+        index = FlowIndex(flows)
+        comparator = AnalyticalFlowComparator()
+        for probe in _random_flows(rnd,10):
+            candidates = [id(f) for f in index.overlapping(probe)]
+            for f in flows:
+                if comparator.is_intersection_nonempty(f.copy(),probe.copy()):
+                    self.assertIn(id(f), candidates)
+        for f in flows:
+            index.remove(f)
+        self.assertEqual(len(index), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Tests of OpenFlowSwitch against FakeOpenFlowServer, a local OpenFlow 1.0 management socket
+backed by a SimulatedSwitch. Run from this directory:
+
+  python -m unittest discover -p 'test_*.py'
+"""
+import unittest
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from test import (FlowDescription, FlowMatch, Command, Cmd, SwitchDesc, SimulatedSwitch, OpenFlowSwitch,
+                  OpenFlowConnection, OFP_VERSION, OFPT_HELLO, OFPT_ERROR, OFPT_ECHO_REQUEST, OFPT_ECHO_REPLY,
+                  OFPT_FLOW_MOD, OFPT_STATS_REQUEST, OFPT_STATS_REPLY, OFPT_BARRIER_REQUEST,
+                  OFPT_BARRIER_REPLY, OFPFC_ADD, OFPFC_MODIFY, OFPFC_MODIFY_STRICT, OFPFC_DELETE,
+                  OFPFC_DELETE_STRICT, OFPFF_CHECK_OVERLAP, OFPST_FLOW, OFPSF_REPLY_MORE,
+                  OFPET_BAD_REQUEST, OFPBRC_BAD_TYPE, OFPET_FLOW_MOD_FAILED, OFPFMFC_OVERLAP,
+                  OFPFMFC_BAD_COMMAND, OFPP_NONE, OFP_DEFAULT_PRIORITY, OFP_HEADER, OFP_MATCH,
+                  OFP_FLOW_MOD, OFP_STATS_REPLY, OFP_FLOW_STATS, OFP_ERROR, _of_encode_match,
+                  _of_decode_match, _of_encode_actions, _of_decode_actions)
+
+class FakeOpenFlowServer(object):
+    """
+    Local stand-in for the management socket of a bridge, speaking enough OpenFlow 1.0 for
+    OpenFlowSwitch: flow mods (with OFPFMFC_OVERLAP errors), flow stats and barriers are
+    executed on a SimulatedSwitch. Flow stats replies are split into parts of STATS_PER_REPLY
+    flows. Unknown flow mod commands get OFPFMFC_BAD_COMMAND. Serves each connection in its
+    own thread, until close().
+    """
+    STATS_PER_REPLY = 10
+    # close the connection instead of answering the next barrier request
+    close_at_barrier = False
+    FLOW_MOD_COMMANDS = {OFPFC_ADD : (Cmd.OF_ADD, False),
+                         OFPFC_MODIFY : (Cmd.OF_MOD, False),
+                         OFPFC_MODIFY_STRICT : (Cmd.OF_MOD, True),
+                         OFPFC_DELETE : (Cmd.OF_DEL, False),
+                         OFPFC_DELETE_STRICT : (Cmd.OF_DEL, True)}
+
+    def __init__(self,path,switch):
+        """Listen at path
+        :type switch: SimulatedSwitch
+        """
+        self.path = path
+        self.switch = switch
+        self._lock = threading.Lock() # the switch is shared by the connections
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept(self):
+        while True:
+            try:
+                conn,unused_addr = self.sock.accept()
+            except socket.error:
+                return # closed
+            thread = threading.Thread(target=self._serve,args=(OpenFlowConnection(conn),))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self,connection):
+        """
+        :type connection: OpenFlowConnection
+        """
+        while True:
+            msg = connection.recv_any()
+            if msg is None:
+                connection.close()
+                return
+            msg_type,xid,body = msg
+            with self._lock:
+                if msg_type == OFPT_HELLO:
+                    continue
+                elif msg_type == OFPT_ECHO_REQUEST:
+                    connection.send(OFPT_ECHO_REPLY,body,xid)
+                elif msg_type == OFPT_BARRIER_REQUEST and self.close_at_barrier:
+                    connection.close()
+                    return
+                elif msg_type == OFPT_BARRIER_REQUEST:
+                    connection.send(OFPT_BARRIER_REPLY,'',xid)
+                elif msg_type == OFPT_FLOW_MOD:
+                    error_code = self._flow_mod(body)
+                    if error_code is not None:
+                        request = OFP_HEADER.pack(OFP_VERSION,msg_type,OFP_HEADER.size+len(body),xid) + body
+                        connection.send(OFPT_ERROR,OFP_ERROR.pack(OFPET_FLOW_MOD_FAILED,error_code)+request[:64],xid)
+                elif msg_type == OFPT_STATS_REQUEST and OFP_STATS_REPLY.unpack_from(body)[0] == OFPST_FLOW:
+                    self._flow_stats(connection,xid)
+                else:
+                    connection.send(OFPT_ERROR,OFP_ERROR.pack(OFPET_BAD_REQUEST,OFPBRC_BAD_TYPE)+body[:64],xid)
+
+    def _flow_mod(self,body):
+        """Execute an ofp_flow_mod (without header) on the switch.
+        Returns the OFPET_FLOW_MOD_FAILED code to answer with, None if it succeeded.
+        :rtype: int
+        """
+        match = _of_decode_match(body[:OFP_MATCH.size])
+        cookie,command,idle_timeout,hard_timeout,priority,buffer_id,out_port,flags = \
+            OFP_FLOW_MOD.unpack_from(body,OFP_MATCH.size)
+        actions = _of_decode_actions(body[OFP_MATCH.size+OFP_FLOW_MOD.size:])
+        fields = ['table=0', 'priority={0}'.format(priority)]
+        if str(match):
+            fields.append(str(match))
+        if flags & OFPFF_CHECK_OVERLAP:
+            fields.append('check_overlap')
+        if out_port != OFPP_NONE:
+            fields.append('out_port={0}'.format(out_port))
+        if command not in self.FLOW_MOD_COMMANDS:
+            return OFPFMFC_BAD_COMMAND
+        cmd_type,strict = self.FLOW_MOD_COMMANDS[command]
+        flowdesc = FlowDescription(', '.join(fields) + ' actions=' + actions)
+        if self.switch.executeCommand(Command(cmd_type,flowdesc,strict=strict)).overlap_error:
+            return OFPFMFC_OVERLAP
+        return None
+
+    def _flow_stats(self,connection,xid):
+        flows = self.switch.executeCommand(Command(Cmd.DUMP)).dumped_flows
+        parts = [flows[i:i+self.STATS_PER_REPLY] for i in xrange(0,len(flows),self.STATS_PER_REPLY)] or [[]]
+        for n,part in enumerate(parts):
+            body = OFP_STATS_REPLY.pack(OFPST_FLOW,OFPSF_REPLY_MORE if n < len(parts)-1 else 0)
+            for f in part:
+                priority = f.get_priority()
+                actions = _of_encode_actions(f.get_actions())
+                body += OFP_FLOW_STATS.pack(OFP_FLOW_STATS.size+len(actions),int(f.fields.get('table','0')),
+                                            _of_encode_match(FlowMatch(f)),0,0,
+                                            OFP_DEFAULT_PRIORITY if priority is None else priority,
+                                            0,0,0,0,0) + actions
+            connection.send(OFPT_STATS_REPLY,body,xid)
+
+def _flow(text):
+    return FlowDescription('table=0, ' + text)
+
+class OpenFlowSwitchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved_rundir = os.environ.get('OVS_RUNDIR')
+        os.environ['OVS_RUNDIR'] = self.dir
+        self.server = FakeOpenFlowServer(os.path.join(self.dir,'br0.mgmt'),SimulatedSwitch(SwitchDesc('br0',2)))
+        # the bridge itself is not created, that would take ovs-vsctl
+        self.switch = OpenFlowSwitch(SwitchDesc('br0',2))
+        self.reference = SimulatedSwitch(SwitchDesc('br0',2))
+
+    def tearDown(self):
+        if self.switch.connection is not None:
+            self.switch.connection.close()
+        self.server.close()
+        if self.saved_rundir is None:
+            del os.environ['OVS_RUNDIR']
+        else:
+            os.environ['OVS_RUNDIR'] = self.saved_rundir
+        shutil.rmtree(self.dir)
+
+    def _dump(self,switch):
+        return sorted(str(f) for f in switch.executeCommand(Command(Cmd.DUMP,dump_removeStatistics=True)).dumped_flows)
+
+    def _check(self,cmds):
+        """Execute cmds on the switch and on the reference, compare the overlap errors and the flow tables"""
+        results = self.switch.executeCommands(cmds)
+        expected = self.reference.executeCommands([cmd.copy() for cmd in cmds])
+        self.assertEqual([bool(r.overlap_error) for r in results], [bool(r.overlap_error) for r in expected])
+        self.assertEqual(self._dump(self.switch), self._dump(self.reference))
+        return results
+
+    def test_add_del_mod(self):
+        self._check([Command(Cmd.CLEAR),
+                     Command(Cmd.OF_ADD,_flow('priority=5, tcp,nw_dst=10.0.0.1 actions=output:1')),
+                     Command(Cmd.OF_ADD,_flow('priority=5, tcp,nw_dst=10.0.0.2 actions=output:1')),
+                     Command(Cmd.OF_ADD,_flow('priority=7, tcp actions=output:2')),
+                     Command(Cmd.OF_ADD,_flow('priority=3, ip actions=drop'))])
+        # non-strict: every flow the match covers, strict: the same match and priority only
+        self._check([Command(Cmd.OF_MOD,_flow('priority=5, tcp actions=output:2')),
+                     Command(Cmd.OF_MOD,_flow('priority=3, ip actions=output:1'),strict=True),
+                     Command(Cmd.OF_MOD,_flow('priority=9, udp actions=output:1'),strict=True)])
+        self._check([Command(Cmd.OF_DEL,_flow('priority=5, tcp,nw_dst=10.0.0.1'),strict=True),
+                     Command(Cmd.OF_DEL,_flow('priority=9, ip'),strict=True)])
+        self._check([Command(Cmd.OF_DEL,_flow('tcp,out_port=1'))])
+        self._check([Command(Cmd.OF_DEL,_flow('ip'))])
+        self.assertEqual(self._dump(self.switch), [])
+
+    def test_check_overlap(self):
+        results = self._check([Command(Cmd.CLEAR),
+                               Command(Cmd.OF_ADD,_flow('priority=5, tcp,nw_dst=10.0.0.1 actions=output:1')),
+                               Command(Cmd.OF_ADD,_flow('priority=5, tcp actions=output:1')),
+                               Command(Cmd.OF_ADD,_flow('priority=5, ip,nw_dst=10.0.0.1, check_overlap actions=output:2')),
+                               Command(Cmd.OF_ADD,_flow('priority=6, ip,nw_dst=10.0.0.1, check_overlap actions=output:2')),
+                               Command(Cmd.OF_ADD,_flow('priority=5, udp, check_overlap actions=output:2')),
+                               Command(Cmd.OF_ADD,_flow('priority=5, ip,nw_dst=10.0.0.1 actions=output:2'))])
+        # the error reply went to the flow mod it was for, the others were confirmed by barriers
+        self.assertEqual([bool(r.overlap_error) for r in results], [False, False, False, True, False, False, False])
+        self.assertEqual(len(self.switch._unconfirmed), 0)
+
+    def test_error_raised_at_sync(self):
+        self.switch.executeCommand(Command(Cmd.OF_ADD,_flow('priority=5, tcp actions=output:1')))
+        cmd = Command(Cmd.OF_MOD,_flow('priority=5, tcp actions=output:2'))
+        self.switch._send_flow_mod(cmd,99,FlowMatch(cmd.flowdesc),5,'output:2',0)
+        self.switch.executeCommand(Command(Cmd.OF_ADD,_flow('priority=6, udp actions=output:1')))
+        with self.assertRaises(Exception) as raised:
+            self.switch.executeCommand(Command(Cmd.OF_BAR))
+        self.assertEqual(raised.exception.args[0],
+                         ['OFPT_ERROR (type {0}, code {1}) for {2}'.format(OFPET_FLOW_MOD_FAILED,OFPFMFC_BAD_COMMAND,cmd)])
+        # the flow mods around the failed one were executed
+        self.assertEqual(len(self._dump(self.switch)), 2)
+
+    def test_multipart_flow_stats(self):
+        self.assertEqual(self._dump(self.switch), [])
+        for count in (FakeOpenFlowServer.STATS_PER_REPLY, 2*FakeOpenFlowServer.STATS_PER_REPLY + 5):
+            self._check([Command(Cmd.CLEAR)] +
+                        [Command(Cmd.OF_ADD,_flow('priority={0}, tcp,nw_dst=10.0.0.{1} actions=output:1'.format(i%3+1,i)))
+                         for i in range(count)])
+            self.assertEqual(len(self._dump(self.switch)), count)
+
+    def test_connection_closed(self):
+        self.switch.executeCommand(Command(Cmd.OF_ADD,_flow('priority=5, tcp actions=output:1')))
+        self.server.close_at_barrier = True
+        with self.assertRaises(Exception) as raised:
+            self.switch.executeCommand(Command(Cmd.OF_BAR))
+        self.assertEqual(raised.exception.args[0], 'OpenFlow connection closed')
+
+if __name__ == '__main__':
+    unittest.main()
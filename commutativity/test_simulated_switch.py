@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Tests of SimulatedSwitch. Run from this directory:
+
+  python -m unittest discover -p 'test_*.py'
+"""
+import unittest
+import random
+
+from test import FlowDescription, Command, Cmd, SwitchDesc, SimulatedSwitch
+
+def _flow(text):
+    return FlowDescription('table=0, ' + text)
+
+class RollbackTest(unittest.TestCase):
+    def setUp(self):
+        self.switch = SimulatedSwitch(SwitchDesc('br0',2))
+
+    def _trace(self,packet):
+        return self.switch.executeCommand(Command(Cmd.TRACE,_flow(packet))).traced_actions
+
+    def test_equal_priority_order_kept(self):
+        self.switch.executeCommand(Command(Cmd.OF_ADD,_flow('priority=5, tcp,nw_dst=10.0.0.0/24 actions=output:8')))
+        self.assertEqual(self._trace('tcp,nw_dst=10.0.0.1'), 'output:8')
+        before = self.switch.snapshot()
+        self.switch.start_undo_log()
+        self.switch.executeCommand(Command(Cmd.OF_ADD,_flow('priority=5, tcp,nw_dst=10.0.0.0/8 actions=output:2')))
+        self.switch.executeCommand(Command(Cmd.OF_MOD,_flow('tcp,nw_dst=10.0.0.0/24 actions=output:7')))
+        self.assertEqual(self._trace('tcp,nw_dst=10.0.0.1'), 'output:7')
+        self.switch.rollback(1)
+        # the older /24 flow still wins the tie with the /8 one
+        self.assertEqual(self._trace('tcp,nw_dst=10.0.0.1'), 'output:8')
+        self.switch.rollback(1)
+        self.switch.stop_undo_log()
+        self.assertEqual(self.switch.snapshot(), before)
+
+    def test_rollback_restores_snapshot(self):
+        rnd = random.Random(3)
+        flows = ['priority={0}, tcp,nw_dst=10.0.{1}.0/{2}'.format(rnd.choice([5,6]), rnd.randint(0,1), rnd.choice([16,24]))
+                 for _ in xrange(12)]
+        for f in flows[:6]:
+            self.switch.executeCommand(Command(Cmd.OF_ADD,_flow(f + ' actions=output:1')))
+        for _ in xrange(20):
+            snapshots = []
+            self.switch.start_undo_log()
+            for _ in xrange(4):
+                snapshots.append(self.switch.snapshot())
+                f = rnd.choice(flows)
+                cmd = rnd.choice([Command(Cmd.OF_ADD,_flow(f + ' actions=output:{0}'.format(rnd.randint(1,3)))),
+                                  Command(Cmd.OF_DEL,_flow(f),strict=rnd.random() < 0.5),
+                                  Command(Cmd.OF_MOD,_flow(f + ' actions=output:4'),strict=rnd.random() < 0.5),
+                                  Command(Cmd.CLEAR)])
+                self.switch.executeCommand(cmd)
+            for snapshot in reversed(snapshots):
+                self.switch.rollback(1)
+                self.assertEqual(self.switch.snapshot(), snapshot)
+            self.switch.stop_undo_log()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Tests of the unixctl client (UnixctlClient, OvsSwitch.trace_many) against FakeUnixctlServer.
+Run from this directory:
+
+  python -m unittest discover -p 'test_*.py'
+"""
+import unittest
+import os
+import json
+import socket
+import shutil
+import tempfile
+import threading
+
+from test import (FlowDescription, Command, Cmd, SwitchDesc, OvsSwitch, SimulatedSwitch,
+                  JsonRpcStream, UnixctlClient)
+
+class FakeUnixctlServer(object):
+    """
+    Local stand-in for the unixctl socket of ovs-vswitchd, answering ofproto/trace requests
+    for the bridges of SimulatedSwitch objects with OVS-like output. Serves each connection
+    in its own thread, until close().
+    """
+    def __init__(self,path,switches):
+        """Listen at path
+        :type switches: list[SimulatedSwitch]
+        """
+        self.path = path
+        self.switches = dict([(sw.switchdesc.name, sw) for sw in switches])
+        self._lock = threading.Lock() # the switches are shared by the connections
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept(self):
+        while True:
+            try:
+                conn,unused_addr = self.sock.accept()
+            except socket.error:
+                return # closed
+            thread = threading.Thread(target=self._serve,args=(JsonRpcStream(conn),))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self,stream):
+        while True:
+            msg = stream.recv()
+            if msg is None:
+                stream.close()
+                return
+            try:
+                result = self._run(msg['method'],msg['params'])
+                stream.send({'result' : result, 'error' : None, 'id' : msg['id']})
+            except Exception as e:
+                stream.send({'result' : None, 'error' : str(e) + '\n', 'id' : msg['id']})
+
+    def _run(self,method,params):
+        if method != 'ofproto/trace':
+            raise Exception('"'+method+'" is not a valid command')
+        if params[0] not in self.switches:
+            raise Exception('no bridge named '+params[0])
+        with self._lock:
+            result = self.switches[params[0]].executeCommand(Command(Cmd.TRACE,FlowDescription(params[1])))
+        return ('Bridge: '+params[0]+'\nFlow: '+params[1]+'\n\nRule: '+result.traced_rule+'\n'
+                'OpenFlow actions='+result.traced_actions+'\n')
+
+class ScriptedServer(object):
+    """Unixctl socket serving a single connection with script(stream, sock) in a thread"""
+    def __init__(self,path,script):
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(1)
+        self.script = script
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        conn,unused_addr = self.sock.accept()
+        try:
+            self.script(JsonRpcStream(conn),conn)
+        except Exception as e:
+            self.error = e
+        finally:
+            conn.close()
+
+    def close(self):
+        self.thread.join(5)
+        self.sock.close()
+
+class UnixctlClientTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir,'ovs-vswitchd.ctl')
+        self.switch = SimulatedSwitch(SwitchDesc('br0',2))
+        self.switch.executeCommand(Command(Cmd.OF_ADD,FlowDescription('priority=5,tcp,nw_dst=10.0.0.0/8 actions=output:1')))
+        self.switch.executeCommand(Command(Cmd.OF_ADD,FlowDescription('priority=9,tcp,nw_dst=10.0.0.1 actions=output:2')))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_transact(self):
+        server = FakeUnixctlServer(self.path,[self.switch])
+        client = UnixctlClient(self.path)
+        try:
+            reply = client.transact('ofproto/trace',['br0','tcp,nw_dst=10.0.0.1'])
+        finally:
+            client.close()
+            server.close()
+        self.assertIn('Rule: table=0 cookie=0 priority=9,tcp,nw_dst=10.0.0.1\n',reply)
+        self.assertIn('OpenFlow actions=output:2\n',reply)
+
+    def test_pipelined_within_window(self):
+        window = 4
+        total = 10
+        seen = []
+        def script(stream,sock):
+            while len(seen) < total:
+                batch = []
+                # the client sends a whole window without waiting for replies ...
+                while len(batch) < min(window,total - len(seen)):
+                    batch.append(stream.recv())
+                # ... and no more than that (neither buffered in the stream nor still on the socket)
+                extra = stream._buffer.strip()
+                if not extra:
+                    sock.settimeout(0.2)
+                    try:
+                        extra = sock.recv(1)
+                    except socket.timeout:
+                        pass
+                    sock.settimeout(None)
+                if extra:
+                    raise Exception('more than a window in flight')
+                seen.extend(batch)
+                for msg in reversed(batch): # replies may come in any order
+                    stream.send({'result' : 'reply ' + msg['params'][0], 'error' : None, 'id' : msg['id']})
+        server = ScriptedServer(self.path,script)
+        client = UnixctlClient(self.path)
+        client.WINDOW = window
+        try:
+            replies = client.transact_many([('echo', [str(i)]) for i in xrange(total)])
+        finally:
+            client.close()
+            server.close()
+        self.assertIsNone(server.error)
+        self.assertEqual(replies, ['reply ' + str(i) for i in xrange(total)])
+        self.assertEqual(len(seen), total)
+
+    def test_more_requests_than_window(self):
+        server = FakeUnixctlServer(self.path,[self.switch])
+        client = UnixctlClient(self.path)
+        packets = ['tcp,nw_dst=10.0.0.%d' % (i % 3) for i in xrange(3 * UnixctlClient.WINDOW + 5)]
+        try:
+            replies = client.transact_many([('ofproto/trace', ['br0', p]) for p in packets])
+        finally:
+            client.close()
+            server.close()
+        for p,reply in zip(packets,replies):
+            self.assertIn('Flow: ' + p + '\n',reply)
+        self.assertEqual(len(replies),len(packets))
+
+    def test_error_reply(self):
+        server = FakeUnixctlServer(self.path,[self.switch])
+        client = UnixctlClient(self.path)
+        try:
+            with self.assertRaises(Exception) as cm:
+                client.transact_many([('ofproto/trace', ['br0', 'tcp']), ('ofproto/trace', ['br9', 'tcp'])])
+            self.assertIn('ofproto/trace br9 tcp: no bridge named br9',str(cm.exception))
+            with self.assertRaises(Exception) as cm:
+                client.transact('dpif/show',[])
+            self.assertIn('"dpif/show" is not a valid command',str(cm.exception))
+            # the connection is still usable after an error
+            self.assertIn('Rule: ',client.transact('ofproto/trace',['br0','tcp']))
+        finally:
+            client.close()
+            server.close()
+
+    def test_server_closes_connection(self):
+        def script(stream,sock):
+            stream.recv()
+        server = ScriptedServer(self.path,script)
+        client = UnixctlClient(self.path)
+        try:
+            with self.assertRaises(Exception) as cm:
+                client.transact('ofproto/trace',['br0','tcp'])
+            self.assertIn('unixctl connection closed',str(cm.exception))
+        finally:
+            client.close()
+            server.close()
+
+    def test_incomplete_message(self):
+        def script(stream,sock):
+            stream.recv()
+            sock.sendall(json.dumps({'result' : 'x', 'error' : None, 'id' : 1})[:-3])
+        server = ScriptedServer(self.path,script)
+        client = UnixctlClient(self.path)
+        try:
+            with self.assertRaises(Exception) as cm:
+                client.transact('ofproto/trace',['br0','tcp'])
+            self.assertIn('Incomplete JSON-RPC message',str(cm.exception))
+        finally:
+            client.close()
+            server.close()
+
+    def test_trace_many(self):
+        server = FakeUnixctlServer(self.path,[self.switch])
+        ovs = OvsSwitch(SwitchDesc('br0',2),unixctl=True)
+        ovs.unixctl = UnixctlClient(self.path)
+        cmds = [Command(Cmd.TRACE,FlowDescription(p)) for p in ('tcp,nw_dst=10.0.0.1', 'tcp,nw_dst=10.2.0.1', 'udp')]
+        try:
+            results = ovs.trace_many(cmds,return_affected=True)
+        finally:
+            ovs.unixctl.close()
+            server.close()
+        for cmd,result in zip(cmds,results):
+            expected = self.switch.executeCommand(cmd)
+            self.assertEqual((result.traced_rule, result.traced_actions), (expected.traced_rule, expected.traced_actions))
+            self.assertEqual((result.added_flows, result.removed_flows, result.affected_flows), (set(), set(), set()))
+
+if __name__ == '__main__':
+    unittest.main()